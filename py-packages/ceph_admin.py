@@ -51,18 +51,36 @@ def lsuser_handler(**kwargs):
         print('list user error:', e)
         return 1
 
+def _print_user_usage(user, key, usage, prefix):
+    print('user {0}\n\tkey: {1}\n\tpath prefix: {2}\nusage:'
+        .format(user, key, prefix))
+    for used, quota, path in usage:
+        print('\tpath: ' + path)
+        retio = '%.2f' % (float(used)/float(quota)) if quota != '0' else 0
+        print('\t\tused: {0}\n\t\t%used: {1}%\n\t\tquota: {2}'
+            .format(adminI.format_bytes(used), retio, adminI.format_bytes(quota)))
+
+def _get_users_args(kwargs):
+    users = kwargs.pop('user')
+    if kwargs.pop('all_users'):
+        return None
+    if not users:
+        raise ValueError('require user names or --all')
+    return users
+
 def getuser_handler(**kwargs):
     try:
         kwargs['showpath'] = True
-        key, usage = adminI.getuser(**kwargs)
-        user = kwargs.get('user')
-        print('user {0}\n\tkey: {1}\n\tpath prefix: {2}\nusage:'
-            .format(user, key, adminI.root_prefix))
-        for used, quota, path in usage:
-            print('\tpath: ' + path)
-            retio = '%.2f' % (float(used)/float(quota)) if quota != '0' else 0
-            print('\t\tused: {0}\n\t\t%used: {1}%\n\t\tquota: {2}'
-                .format(adminI.format_bytes(used), retio, adminI.format_bytes(quota)))
+        users = _get_users_args(kwargs)
+        if users and len(users) == 1:
+            key, usage = adminI.getuser(user=users[0], **kwargs)
+            _print_user_usage(users[0], key, usage, adminI.root_prefix)
+            return 0
+        for user, key, usage in adminI.getusers(users=users, **kwargs):
+            prefix = adminI.root_prefix
+            if usage:
+                prefix = os.path.join(os.path.dirname(usage[-1][2]), '')
+            _print_user_usage(user, key, usage, prefix)
         return 0
     except Exception as e:
         print('get user error:', e)
@@ -70,17 +88,39 @@ def getuser_handler(**kwargs):
 
 def exportuser_handler(**kwargs):
     try:
-        info = adminI.exportuser(**kwargs)
-        print(info)
+        users = _get_users_args(kwargs)
+        if users and len(users) == 1:
+            infos = [(users[0], adminI.exportuser(user=users[0], **kwargs))]
+        else:
+            infos = adminI.exportusers(users=users, **kwargs)
+        outdir = kwargs.get('outdir')
+        for user, info in infos:
+            print(info)
+            if outdir:
+                with open(os.path.join(outdir, user + '.json'), 'w') as f:
+                    f.write(info)
         f = kwargs.get('infofile')
         if f:
-            f.write(info)
+            f.write('\n'.join([info for _, info in infos]))
             f.close()
         return 0
     except Exception as e:
         print('export user error:', e)
         return 1
 
+def compactcaps_handler(**kwargs):
+    try:
+        compacted = adminI.compact_caps(**kwargs)
+        for user, old, new in compacted:
+            print('user {0}\n\told mds caps: {1}\n\tnew mds caps: {2}'
+                .format(user, old, new))
+        print('compact caps of {0} users{1}'.format(len(compacted),
+            ' (dry run)' if kwargs.get('dry_run') else ''))
+        return 0
+    except Exception as e:
+        print('compact caps error:', e)
+        return 1
+
 def show_handler(**kwargs):
     try:
         cfg, info = adminI.show_info(**kwargs)
@@ -110,8 +150,10 @@ def parse_cmdargs(args=None):
     listuser = sub.add_parser('ls', help='list user')
     listuser.set_defaults(func=lsuser_handler)
 
-    getuser = sub.add_parser('get', help='get user')
-    getuser.add_argument('user', help='user name')
+    getuser = sub.add_parser('get', help='get users')
+    getuser.add_argument('user', help='user names', nargs='*')
+    getuser.add_argument('--all', dest='all_users', action='store_true',
+        help='get all users')
     getuser.set_defaults(func=getuser_handler)
 
     adduser = sub.add_parser('add', help='add user to cephfs')
@@ -124,14 +166,18 @@ def parse_cmdargs(args=None):
         type=argparse.FileType('w'))
     adduser.set_defaults(func=adduser_handler)
 
-    exportuser = sub.add_parser('export', help='export user info')
-    exportuser.add_argument('user', help='user name')
+    exportuser = sub.add_parser('export', help='export users info')
+    exportuser.add_argument('user', help='user names', nargs='*')
+    exportuser.add_argument('--all', dest='all_users', action='store_true',
+        help='export all users')
     exportuser.add_argument('-r', '--root',
         help='root path')
     exportuser.add_argument('-i', '--rootindex', type=int, default=-1,
         help='index of root path, default -1')
     exportuser.add_argument('-o', '--infofile', type=argparse.FileType('w'),
-        help='user info file')
+        help='user info file, one line per user')
+    exportuser.add_argument('-d', '--outdir',
+        help='directory to write <user>.json per user')
     exportuser.set_defaults(func=exportuser_handler)
 
     updateuser = sub.add_parser('update', help='update user to cephfs, \
@@ -151,6 +197,14 @@ def parse_cmdargs(args=None):
     deluser.add_argument('user', help='user name')
     deluser.set_defaults(func=deluser_handler)
 
+    compactcaps = sub.add_parser('compact-caps', help='compact mds caps of \
+            users, drop duplicated paths and paths under another path')
+    compactcaps.add_argument('users', help='user names, all users if not set',
+            nargs='*')
+    compactcaps.add_argument('--dry-run', action='store_true',
+            help='only show the caps to compact')
+    compactcaps.set_defaults(func=compactcaps_handler)
+
     show = sub.add_parser('show', help='show current admin info')
     show.set_defaults(func=show_handler)
 
@@ -8,14 +8,19 @@ import os
 import json
 import logging
 import logging.config
+import posixpath
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from errno import EINVAL, EPERM, ENOENT
 
 import rados
 import cephfs
 
+from ceph_caps import Caps, Grant, normalize_path
+
 __all__ = ['set_log_conf_file','version','connect','lsuser','getuser',
-    'adduser','updateuser','deluser','getuser_usage','get_cluster_usage',
-    'set_root_prefix']
+    'getusers','exportusers','adduser','updateuser','deluser',
+    'getuser_usage','get_cluster_usage','set_root_prefix','compact_caps']
 
 home_dir = os.getenv('CEPH_ADMIN_HOME', '.')
 version_str = os.getenv('CEPH_ADMIN_VERSION', '0.0.1')
@@ -26,6 +31,7 @@ default_admin_conf = os.path.join(home_dir, 'conf', 'admin.info')
 units = {'b':1,'k':1024,'m':1024*1024,'g':1024*1024*1024,'t':1024*1024*1024*1024}
 default_unit = 'g'
 root_prefix = '/'
+usage_workers = 16
 
 if sys.version_info[0] == 2:
     import codecs
@@ -202,25 +208,33 @@ def lsuser(**kwargs):
     rd = kwargs.pop('rados')
     reuse = kwargs.get('reuse', False)
     try:
-        cmd = {'prefix':'auth ls',
-               'format':'json'}
-        ret, buf, out = rd.mon_command(json.dumps(cmd), '')
-        if ret != 0:
-            log.error('ls user error: %s', out)
-            raise ListUserError(out)
-        users = json.loads(buf.decode('utf8'))['auth_dump']
-        ret = []
-        for u in users:
-            name = u['entity']
-            if (name.startswith('client') and 
-                not name.startswith('client.bootstrap') and
-                name != 'client.admin'):
-                ret.append(name[7:])
-        return ret
+        return [user for user, _ in __auth_ls(rd)]
     finally:
         if not reuse:
             rd.shutdown()
 
+def __auth_ls(rd):
+    '''
+    list the cephfs users with a single auth ls, leaving out the
+    bootstrap and admin clients
+
+    return list of (user, auth entry), user without the client. prefix
+    '''
+    cmd = {'prefix':'auth ls',
+           'format':'json'}
+    ret, buf, out = rd.mon_command(json.dumps(cmd), '')
+    if ret != 0:
+        log.error('ls user error: %s', out)
+        raise ListUserError(out)
+    users = []
+    for u in json.loads(buf.decode('utf8'))['auth_dump']:
+        name = u['entity']
+        if (name.startswith('client') and
+            not name.startswith('client.bootstrap') and
+            name != 'client.admin'):
+            users.append((name[7:], u))
+    return users
+
 def __get_user_info(rd, user, verbose):
     cmd = {'prefix':'auth get',
            'entity':'client.'+user,
@@ -235,6 +249,29 @@ def __get_user_info(rd, user, verbose):
     mds = info['caps']['mds'] if info.get('caps') and info['caps'].get('mds') else None
     return mds, info['key']
 
+def __get_users_info(rd, users, verbose):
+    '''
+    get mds caps and key of users from a single auth ls
+    all users if users is empty
+
+    return list of (user, mds, key)
+    '''
+    infos = OrderedDict()
+    for user, u in __auth_ls(rd):
+        caps = u.get('caps') or {}
+        infos[user] = (caps.get('mds') or None, u['key'])
+    if verbose:
+        log.info('get {0} users from auth ls'.format(len(infos)))
+    if not users:
+        return [(user, mds, key) for user, (mds, key) in infos.items()]
+    users = _uniq([u for u in users if u != 'admin'])
+    missing = [u for u in users if u not in infos]
+    if missing:
+        msg = 'failed to find client.{0}'.format(', client.'.join(missing))
+        log.error('get user error: %s', msg)
+        raise GetUserError(msg)
+    return [(u,) + infos[u] for u in users]
+
 #login cephfs to set quota
 def _set_quota_path(rados_instanse, path, quota, unit, verbose):
     try:
@@ -295,6 +332,31 @@ def _get_users_used(rados_instanse, mds):
         log.error('connect cephfs error: {0}'.format(e))
         raise AttrError(e)
 
+def _get_paths_used(rados_instanse, paths, workers=None):
+    '''
+    get used of paths, each path read once
+    login cephfs once and read in parallel
+    required rados
+
+    return dict of {path: (used, quota, path)}
+    '''
+    paths = _uniq(paths)
+    if not paths:
+        return {}
+    try:
+        fs = cephfs.LibCephFS(rados_inst=rados_instanse)
+        fs.mount()
+    except Exception as e:
+        log.error('connect cephfs error: {0}'.format(e))
+        raise AttrError(e)
+    pool = ThreadPool(min(workers or usage_workers, len(paths)))
+    try:
+        used = pool.map(lambda p: _get_path_used(fs, p), paths)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(paths, used))
+
 def _get_user_used(rados_instanse, user):
     '''
     get one user used
@@ -311,9 +373,7 @@ def _get_user_used(rados_instanse, user):
         raise AttrError(e)
 
 def _get_paths_from_mds(mds):
-    groups = mds.split(', ')
-    pre = 'allow rw path='
-    return [g[len(pre):] for g in groups if g.startswith(pre)]
+    return Caps.parse(mds).paths('rw')
 
 def _get_groups_from_mds(mds):
     groups = mds.split(', ')
@@ -321,12 +381,60 @@ def _get_groups_from_mds(mds):
     return [os.path.basename(g) for g in groups if g.startswith(pre_path)]
 
 def _get_mds_from_groups(groups):
-    def __get_path(g):
-        return 'allow rw path=' + os.path.join(root_prefix, g)
-    return ', '.join([__get_path(g) for g in groups if len(g) > 0])
+    return _get_mds_from_paths(
+            [os.path.join(root_prefix, g) for g in groups if len(g) > 0])
 
 def _get_mds_from_paths(paths):
-    return ', '.join(['allow rw path=' + p for p in paths if len(p) > 0])
+    return ', '.join(['allow rw path=' + p for p in _compact_paths(paths)])
+
+def _compact_paths(paths):
+    '''
+    normalize paths, drop duplicates and paths under another path in
+    the list, the mds checks every grant of a client on each request
+    group and user paths (root_prefix/<name>) are always kept, the caps
+    are the only record of group membership
+    a dropped path is not restored by removing its ancestor later
+    return the rest in order
+    '''
+    paths = _uniq([normalize_path(p) for p in paths if p])
+    granted = set(paths)
+    prefix = normalize_path(root_prefix)
+    def __covered_by(p):
+        parent = posixpath.dirname(p)
+        while parent != p:
+            if parent in granted:
+                return parent
+            p, parent = parent, posixpath.dirname(parent)
+        return None
+    ret = []
+    for p in paths:
+        ancestor = None
+        if posixpath.dirname(p) != prefix:
+            ancestor = __covered_by(p)
+        if ancestor is None:
+            ret.append(p)
+        else:
+            log.warning('drop path {0} covered by {1}, removing {1} '
+                'will not restore it'.format(p, ancestor))
+    return ret
+
+def _is_path_grant(grant):
+    return (isinstance(grant, Grant) and grant.access == 'rw' and
+            len(grant.attrs) == 1 and grant.path is not None)
+
+def _compact_mds(mds):
+    '''
+    compact the 'allow rw path=' grants of mds caps, keep other grants
+
+    return the new mds caps, None if nothing to compact
+    '''
+    caps = Caps.parse(mds)
+    keep = set(_compact_paths([g.path for g in caps if _is_path_grant(g)]))
+    compacted = Caps([g for g in caps
+        if not _is_path_grant(g) or g.path in keep])
+    if len(compacted) == len(mds.split(',')):
+        return None
+    return compacted.to_string(', ')
 
 '''
 param: see connect function
@@ -337,22 +445,9 @@ def get_all_users(**kwargs):
     rd = kwargs.pop('rados')
     reuse = kwargs.get('reuse', False)
     try:
-        cmd = {'prefix':'auth ls',
-               'format':'json'}
-        ret, buf, out = rd.mon_command(json.dumps(cmd), '')
-        if ret != 0:
-            log.error('ls user error: %s', out)
-            raise ListUserError(out)
-        users = json.loads(buf.decode('utf8'))['auth_dump']
+        names = [user for user, _ in __auth_ls(rd)]
         fs = cephfs.LibCephFS(rados_inst=rd)
         fs.mount()
-        names = []
-        for u in users:
-            name = u['entity']
-            if (name.startswith('client') and 
-                not name.startswith('client.bootstrap') and
-                name != 'client.admin'):
-                names.append(name[7:])
         def to_dict(name, used):
             return {'user':name, 'used':used[0], 'quota':used[1]}
         return [to_dict(n, _get_used_one_user(fs, n)) for n in names]
@@ -400,6 +495,46 @@ def getuser(**kwargs):
         if not reuse:
             rd.shutdown()
 
+'''
+param users: list users in cephfs, all users if not set
+showpath: show path not groups
+param workers: threads to read usage
+other params see connect function
+
+return list of (user,key,groups,used) if showpath is false
+return list of (user,key,used) if showpath is true
+used is list of {used, quota, path}
+'''
+@login
+def getusers(**kwargs):
+    rd = kwargs.pop('rados')
+    verbose = kwargs.pop('verbose', False)
+    reuse = kwargs.get('reuse', False)
+    showpath = kwargs.get('showpath', False)
+    try:
+        infos = __get_users_info(rd, kwargs.get('users'), verbose)
+        users_paths = [_get_paths_from_mds(mds) if mds else []
+                for _, mds, _ in infos]
+        # users of a group share its path, read it once
+        used = _get_paths_used(rd, [p for paths in users_paths for p in paths],
+                kwargs.get('workers'))
+        ret = []
+        for (user, mds, key), paths in zip(infos, users_paths):
+            usage = [used[p] for p in paths]
+            if showpath:
+                ret.append((user, key, usage))
+                continue
+            groups = _get_groups_from_mds(mds) if mds else []
+            try:
+                groups.remove(user)
+            except ValueError:
+                pass
+            ret.append((user, key, groups, usage))
+        return ret
+    finally:
+        if not reuse:
+            rd.shutdown()
+
 @login
 def get_cluster_usage(**kwargs):
     rd = kwargs.pop('rados')
@@ -442,20 +577,47 @@ def exportuser(**kwargs):
         if user == 'admin':
             return '', [], []
         mds, key = __get_user_info(rd, user, verbose)
-        paths = _get_paths_from_mds(mds)
-        if paths and root not in paths:
-            try:
-                root = paths[rootindex]
-            except IndexError:
-                root = os.path.join(root_prefix, user)
-                pass
-        userinfo = {'cephconf': None,
-                'root': root, 
-                'name': user,
-                'key': key,
-                'cephaddr': kwargs.get('config').cephaddr 
-                }
-        return json.dumps(userinfo)
+        return _get_export_info(user, mds, key, root, rootindex,
+                kwargs.get('config').cephaddr)
+    finally:
+        if not reuse:
+            rd.shutdown()
+
+def _get_export_info(user, mds, key, root, rootindex, cephaddr):
+    paths = _get_paths_from_mds(mds)
+    if paths and root not in paths:
+        try:
+            root = paths[rootindex]
+        except IndexError:
+            root = os.path.join(root_prefix, user)
+            pass
+    userinfo = {'cephconf': None,
+            'root': root, 
+            'name': user,
+            'key': key,
+            'cephaddr': cephaddr 
+            }
+    return json.dumps(userinfo)
+
+'''
+param users: list users in cephfs, all users if not set
+other params see exportuser function
+
+return list of (user, user info config for cephcli)
+'''
+@login
+def exportusers(**kwargs):
+    rd = kwargs.pop('rados')
+    verbose = kwargs.pop('verbose', False)
+    reuse = kwargs.get('reuse', False)
+    root = kwargs.get('root')
+    rootindex = kwargs.get('rootindex')
+    rootindex = rootindex if rootindex else -1
+    try:
+        cephaddr = kwargs.get('config').cephaddr
+        infos = __get_users_info(rd, kwargs.get('users'), verbose)
+        return [(user, _get_export_info(user, mds, key, root, rootindex,
+                    cephaddr)) for user, mds, key in infos]
     finally:
         if not reuse:
             rd.shutdown()
@@ -486,17 +648,17 @@ def adduser(**kwargs):
         paths = kwargs.get('paths')
         if not paths and root_prefix == '/':
             log.warning('use default root prefix /')
-        mds = None
+        mds_paths = []
         if paths:
             paths = _uniq(paths)
-            mds_tmp = _get_mds_from_paths(paths)
-            mds = mds + ', ' + mds_tmp if mds else mds_tmp
+            mds_paths.extend(paths)
         if groups:
             groups.append(user)
             groups = _uniq(groups)
-            mds_tmp = _get_mds_from_groups(groups)
-            mds = mds + ', ' + mds_tmp if mds else mds_tmp
-        if not mds:
+            mds_paths.extend([os.path.join(root_prefix, g) for g in groups if g])
+        if mds_paths:
+            mds = _get_mds_from_paths(mds_paths)
+        else:
             mds = _get_mds_from_groups([user])
         cmd['caps'].append(mds)
         ret, buf, out = rd.mon_command(json.dumps(cmd), '')
@@ -536,6 +698,10 @@ param quota: quota
 param unit: quota unit
 other params see connect function
 
+paths under another granted path are dropped from the caps, except
+group and user paths, so pathrm of the ancestor does not give back
+access to them
+
 return 0
 '''
 @login
@@ -560,7 +726,9 @@ def updateuser(**kwargs):
                 paths = _uniq(paths)
                 for i, p in enumerate(paths):
                     if p and p[0] != '/':
-                        paths[i] = '/' + p;
+                        p = '/' + p
+                    paths[i] = normalize_path(p)
+                paths = _uniq(paths)
             return paths
         if paths:
             paths = proc_paths(paths)
@@ -652,6 +820,57 @@ def deluser(**kwargs):
         if not reuse:
             rd.shutdown()
 
+'''
+compact the mds caps of users, drop duplicated paths and paths covered
+by another path of the same user
+
+param users: list users to compact, all users if not set
+param dry_run: only report the users to compact, not update caps
+other params see connect function
+
+return list of (user, old mds caps, new mds caps) compacted
+'''
+@login
+def compact_caps(**kwargs):
+    rd = kwargs.pop('rados')
+    verbose = kwargs.pop('verbose', False)
+    reuse = kwargs.get('reuse', False)
+    dry_run = kwargs.get('dry_run', False)
+    try:
+        users = kwargs.get('users')
+        users = set(users) if users else None
+        compacted = []
+        for user, u in __auth_ls(rd):
+            if users is not None and user not in users:
+                continue
+            caps = u.get('caps') or {}
+            mds = caps.get('mds')
+            new_mds = _compact_mds(mds) if mds else None
+            if new_mds is None:
+                continue
+            compacted.append((user, mds, new_mds))
+            if verbose:
+                log.info('compact user {0} mds caps: {1} -> {2}'
+                    .format(user, mds, new_mds))
+            if dry_run:
+                continue
+            cmd = {'prefix':'auth caps',
+                   'entity':'client.'+user,
+                   'caps':[],
+                   'format':'json'}
+            for service, cap in caps.items():
+                cmd['caps'].extend(
+                    [service, new_mds if service == 'mds' else cap])
+            ret, buf, out = rd.mon_command(json.dumps(cmd), '')
+            if ret != 0 or 'updated caps' not in out:
+                log.error('update user error: %s', out)
+                raise UpdateUserError(out)
+        log.info('compact caps of {0} users'.format(len(compacted)))
+        return compacted
+    finally:
+        if not reuse:
+            rd.shutdown()
+
 '''
 show current admin info
 
@@ -0,0 +1,196 @@
+"""
+Model of Ceph auth cap strings.
+
+A cap string such as "allow rw path=/a, allow r path=/b" is a list of
+grants separated by commas.  Caps parses it once into grants, keeps them
+in an ordered set keyed by their normalized text, and turns them back
+into a string when the caps are written.  Adding or removing a grant
+costs O(1), so merging m grants into caps holding n grants costs
+O(n + m) rather than a split and join of the whole string per grant.
+"""
+
+from collections import OrderedDict
+import posixpath
+
+
+def normalize_path(path):
+    """
+    "/a//b/" -> "/a/b", which is how the MDS matches cap paths.
+    """
+    if not path:
+        return path
+    path = posixpath.normpath(path)
+    if path.startswith("//"):
+        path = "/" + path.lstrip("/")
+    return path
+
+
+class Grant(object):
+    """
+    One "allow <access> [key=value ...]" grant, e.g. "allow rw path=/a" or
+    "allow r pool=data namespace=ns".  Grants with the same access and
+    attributes compare equal however they were spaced.
+    """
+    __slots__ = ('access', 'attrs', '_text')
+
+    def __init__(self, access, attrs=None):
+        """
+        :param access: "r", "rw", "*" ... or "" for a bare "allow"
+        :param attrs: list of (key, value) tuples, in order
+        """
+        self.access = access
+        self.attrs = tuple(
+            (key, normalize_path(value) if key == 'path' else value)
+            for key, value in (attrs or []))
+        words = ["allow"]
+        if access:
+            words.append(access)
+        words.extend("{0}={1}".format(key, value) for key, value in self.attrs)
+        self._text = " ".join(words)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        :return: a Grant, or None if text isn't an "allow" grant
+        """
+        words = text.split()
+        if not words or words[0] != "allow":
+            return None
+        access = ""
+        attrs = []
+        for word in words[1:]:
+            if "=" in word:
+                key, value = word.split("=", 1)
+                attrs.append((key, value))
+            elif not attrs and not access:
+                access = word
+            else:
+                return None
+        return cls(access, attrs)
+
+    def get(self, key, default=None):
+        for k, value in self.attrs:
+            if k == key:
+                return value
+        return default
+
+    @property
+    def path(self):
+        return self.get('path')
+
+    def __str__(self):
+        return self._text
+
+    def __repr__(self):
+        return "Grant({0!r})".format(self._text)
+
+    def __eq__(self, other):
+        return isinstance(other, Grant) and self._text == other._text
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._text)
+
+
+class Caps(object):
+    """
+    Ordered set of the grants of one service's caps (mds, osd, ...).
+
+    Members may be given as Grant instances or as grant text.  Text that
+    isn't an "allow" grant is kept verbatim, so nothing is lost when the
+    caps are written back.
+    """
+
+    def __init__(self, grants=None):
+        self._grants = OrderedDict()
+        if grants:
+            self.update(grants)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse a cap string, whose grants may be separated by "," or ", ".
+        """
+        caps = cls()
+        if text:
+            caps.update(part for part in text.split(","))
+        return caps
+
+    @staticmethod
+    def _key(grant):
+        if isinstance(grant, Grant):
+            return str(grant), grant
+        text = " ".join(grant.split())
+        parsed = Grant.parse(text)
+        if parsed is None:
+            return text, text
+        return str(parsed), parsed
+
+    def add(self, grant):
+        key, value = self._key(grant)
+        if key and key not in self._grants:
+            self._grants[key] = value
+
+    def discard(self, grant):
+        self._grants.pop(self._key(grant)[0], None)
+
+    def update(self, grants):
+        for grant in grants:
+            self.add(grant)
+
+    def difference_update(self, grants):
+        for grant in grants:
+            self.discard(grant)
+
+    def copy(self):
+        caps = Caps()
+        caps._grants = self._grants.copy()
+        return caps
+
+    def paths(self, access=None):
+        """
+        The paths of the path-restricted grants, in order, optionally only
+        those with the given access.
+        """
+        return [grant.path for grant in self
+                if isinstance(grant, Grant) and grant.path is not None and
+                (access is None or grant.access == access)]
+
+    def to_string(self, sep=","):
+        return sep.join(self._grants.keys())
+
+    def __contains__(self, grant):
+        return self._key(grant)[0] in self._grants
+
+    def __iter__(self):
+        return iter(self._grants.values())
+
+    def __len__(self):
+        return len(self._grants)
+
+    def __eq__(self, other):
+        # Order doesn't matter to Ceph
+        return isinstance(other, Caps) and \
+            set(self._grants.keys()) == set(other._grants.keys())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return self.to_string()
+
+    def __repr__(self):
+        return "Caps({0!r})".format(self.to_string())
+
+
+def mds_grant(access, path):
+    return Grant(access, [('path', path)])
+
+
+def osd_grant(access, pool, namespace=None):
+    attrs = [('pool', pool)]
+    if namespace is not None:
+        attrs.append(('namespace', namespace))
+    return Grant(access, attrs)
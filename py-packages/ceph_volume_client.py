@@ -4,20 +4,31 @@ Copyright (C) 2015 Red Hat, Inc.
 LGPL2.  See file COPYING.
 """
 
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+import copy
+import datetime
 import errno
 import fcntl
+import hashlib
 import json
 import logging
 import os
 import re
+import shutil
 import struct
 import sys
 import threading
 import time
 import uuid
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 from ceph_argparse import json_command
+from ceph_caps import Caps, mds_grant, osd_grant
 
 import cephfs
 import rados
@@ -42,6 +53,28 @@ NO_GROUP_NAME = "_nogroup"
 # Filename extensions for meta files.
 META_FILE_EXT = ".meta"
 
+# Directory (under the volume prefix) that deleted volumes are moved into
+# until they are purged.
+TRASH_DIR_NAME = "_deleting"
+
+# Directory (under the volume prefix) holding an empty marker file for each
+# auth ID whose metadata may be dirty.  Group IDs can't end in
+# META_FILE_EXT, so it can't collide with a group.
+DIRTY_INDEX_DIR = "_dirty_auth_ids" + META_FILE_EXT
+
+# Empty file (under the volume prefix) recording that the dirty index is
+# complete.  Until recover() has been through every auth ID once, the index
+# only holds the auth IDs dirtied since it was created.
+DIRTY_INDEX_READY = "_dirty_auth_ids_ready" + META_FILE_EXT
+
+# Directory (under the volume prefix) holding the auth and volume meta
+# files in the sharded layout, see CephFSVolumeClient._metadata_file_path.
+SHARD_DIR_NAME = "_shards" + META_FILE_EXT
+
+# Metadata file layouts
+META_LAYOUT_FLAT = "flat"
+META_LAYOUT_SHARDED = "sharded"
+
 class VolumePath(object):
     """
     Identify a volume's path as group->volume
@@ -57,6 +90,22 @@ class VolumePath(object):
     def __str__(self):
         return "{0}/{1}".format(self.group_id, self.volume_id)
 
+    # Compared by value, so the results of the bulk calls
+    # (get_used_bytes_many, create_volumes...) can be looked up with a
+    # fresh VolumePath for the same volume.
+    def __eq__(self, other):
+        if not isinstance(other, VolumePath):
+            return NotImplemented
+        return (self.group_id, self.volume_id) == \
+            (other.group_id, other.volume_id)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash((self.group_id, self.volume_id))
+
 
 class ClusterTimeout(Exception):
     """
@@ -83,260 +132,1894 @@ class ClusterError(Exception):
             self._result_code, self._result_str, self._action)
 
 
-class RankEvicter(threading.Thread):
+class WorkerPool(object):
     """
-    Thread for evicting client(s) from a particular MDS daemon instance.
+    A fixed set of daemon threads draining a shared task queue.
 
-    This is more complex than simply sending a command, because we have to
-    handle cases where MDS daemons might not be fully up yet, and/or might
-    be transiently unresponsive to commands.
+    Tasks may submit further tasks, which lets tree walks fan out across
+    directories without recursing in python.  wait() returns once every
+    submitted task has run and re-raises the first exception raised by
+    any of them; tasks still queued behind a failure are discarded.
     """
-    class GidGone(Exception):
-        pass
+    def __init__(self, workers, name="worker"):
+        self._queue = queue.Queue()
+        self._error = None
+        self._error_lock = threading.Lock()
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._run,
+                                      name="{0}-{1}".format(name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                if self._error is None:
+                    fn, args = task
+                    fn(*args)
+            except Exception as e:
+                log.debug("Worker task failed", exc_info=True)
+                with self._error_lock:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._queue.task_done()
 
-    POLL_PERIOD = 5
+    def submit(self, fn, *args):
+        self._queue.put((fn, args))
 
-    def __init__(self, volume_client, client_spec, rank, gid, mds_map, ready_timeout):
+    def map_unordered(self, fn, items, in_flight=None):
         """
-        :param client_spec: list of strings, used as filter arguments to "session evict"
-                            pass ["id=123"] to evict a single client with session id 123.
+        Call fn on each of `items` in the pool, yielding (item, result, None)
+        or (item, None, exception) tuples as the calls finish.  At most
+        `in_flight` calls (twice the number of workers by default) are
+        outstanding at once, so `items` may be a generator that's consumed
+        no faster than results are.
         """
-        self.rank = rank
-        self.gid = gid
-        self._mds_map = mds_map
-        self._client_spec = client_spec
-        self._volume_client = volume_client
-        self._ready_timeout = ready_timeout
-        self._ready_waited = 0
-
-        self.success = False
-        self.exception = None
+        if in_flight is None:
+            in_flight = 2 * len(self._threads)
+        results = queue.Queue()
 
-        super(RankEvicter, self).__init__()
+        def call(item):
+            try:
+                results.put((item, fn(item), None))
+            except Exception as e:
+                results.put((item, None, e))
+
+        outstanding = 0
+        for item in items:
+            if outstanding >= in_flight:
+                yield results.get()
+                outstanding -= 1
+            self.submit(call, item)
+            outstanding += 1
+
+        while outstanding:
+            yield results.get()
+            outstanding -= 1
+
+    def wait(self):
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class RateLimiter(object):
+    """
+    Token bucket: acquire() blocks so that on average no more than `rate`
+    operations per second get through, with bursts of up to `burst`.
+    A rate of None (or 0) disables limiting.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self._capacity = float(burst if burst else max(1, rate or 0))
+        self._tokens = self._capacity
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._capacity,
+                               self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            # Take the tokens now and sleep off any debt outside the lock,
+            # so that waiters queue up behind each other fairly.
+            self._tokens -= count
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PurgeJob(object):
+    """
+    Remove a directory tree iteratively, using a pool of worker threads.
 
-    def _ready_to_evict(self):
-        if self._mds_map['up'].get("mds_{0}".format(self.rank), None) != self.gid:
-            log.info("Evicting {0} from {1}/{2}: rank no longer associated with gid, done.".format(
-                self._client_spec, self.rank, self.gid
-            ))
-            raise RankEvicter.GidGone()
+    Each directory is a task: the worker that lists it unlinks its files
+    and queues its subdirectories, so unlinks proceed in parallel across
+    directories.  Once the walk is done, the (now empty) directories are
+    removed deepest level first.
 
-        info = self._mds_map['info']["gid_{0}".format(self.gid)]
-        log.debug("_ready_to_evict: state={0}".format(info['state']))
-        return info['state'] in ["up:active", "up:clientreplay"]
+    Progress is periodically persisted to a checkpoint file, so that a
+    purge interrupted by a crash is resumed rather than accounted from
+    scratch: whatever was already unlinked is simply gone, and the
+    entry count and elapsed time carry over.
+    """
 
-    def _wait_for_ready(self):
-        """
-        Wait for that MDS rank to reach an active or clientreplay state, and
-        not be laggy.
-        """
-        while not self._ready_to_evict():
-            if self._ready_waited > self._ready_timeout:
-                raise ClusterTimeout()
+    # Seconds between progress checkpoints
+    CHECKPOINT_INTERVAL = 10
 
-            time.sleep(self.POLL_PERIOD)
-            self._ready_waited += self.POLL_PERIOD
+    class Interrupted(Exception):
+        pass
 
-            self._mds_map = self._volume_client._rados_command("mds dump", {})
+    def __init__(self, volume_client, root_path, checkpoint_path, workers,
+                 rate_limiter=None, stop_event=None):
+        self._volume_client = volume_client
+        self._fs = volume_client.fs
+        self.root_path = root_path
+        self._checkpoint_path = checkpoint_path
+        self._workers = workers
+        self._rate_limiter = rate_limiter if rate_limiter else RateLimiter(None)
+        self._stop_event = stop_event if stop_event else threading.Event()
+        self._pool = None
+
+        # Checkpoint contents, including anything recorded by delete_volume
+        self.checkpoint = {}
+
+        self._lock = threading.Lock()
+        self._dirs = []
+        self._entries = 0
+        self._prior_entries = 0
+        self._prior_elapsed = 0.0
+        self._start = None
+        self._last_checkpoint = None
+
+    def _load_checkpoint(self):
+        try:
+            checkpoint = self._volume_client._metadata_get(self._checkpoint_path)
+        except cephfs.ObjectNotFound:
+            return
+        if checkpoint:
+            self.checkpoint = checkpoint
+            self._prior_entries = checkpoint.get('entries_purged', 0)
+            self._prior_elapsed = checkpoint.get('elapsed', 0.0)
+            if self._prior_entries:
+                log.info("Resuming purge of {0}: {1} entries purged previously".format(
+                    self.root_path, self._prior_entries))
+
+    def _stats(self):
+        elapsed = self._prior_elapsed + (time.time() - self._start)
+        entries = self._prior_entries + self._entries
+        return {
+            'entries': entries,
+            'elapsed': elapsed,
+            'entries_per_sec': entries / elapsed if elapsed > 0 else 0.0
+        }
 
-    def _evict(self):
+    def _write_checkpoint(self):
         """
-        Run the eviction procedure.  Return true on success, false on errors.
+        Call me with self._lock held.
         """
+        stats = self._stats()
+        self.checkpoint.update({
+            'root': self.root_path,
+            'entries_purged': stats['entries'],
+            'elapsed': stats['elapsed'],
+        })
+        self._volume_client._metadata_set(self._checkpoint_path, self.checkpoint)
+        self._last_checkpoint = time.time()
+        log.info("purge {0}: {1} entries, {2:.0f} entries/s".format(
+            self.root_path, stats['entries'], stats['entries_per_sec']))
+
+    def _progress(self, count=1):
+        with self._lock:
+            self._entries += count
+            if time.time() - self._last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                self._write_checkpoint()
+
+    def _check_stop(self):
+        if self._stop_event.is_set():
+            raise PurgeJob.Interrupted()
+
+    def _unlink(self, path):
+        self._check_stop()
+        self._rate_limiter.acquire()
+        try:
+            self._fs.unlink(path)
+        except cephfs.ObjectNotFound:
+            return
+        self._progress()
 
-        # Wait til the MDS is believed by the mon to be available for commands
+    def _rmdir(self, path):
+        self._check_stop()
+        self._rate_limiter.acquire()
         try:
-            self._wait_for_ready()
-        except self.GidGone:
-            return True
+            self._fs.rmdir(path)
+        except cephfs.ObjectNotFound:
+            return
+        self._progress()
 
-        # Then send it an evict
-        ret = errno.ETIMEDOUT
-        while ret == errno.ETIMEDOUT:
-            log.debug("mds_command: {0}, {1}".format(
-                "%s" % self.gid, ["session", "evict"] + self._client_spec
-            ))
-            ret, outb, outs = self._volume_client.fs.mds_command(
-                "%s" % self.gid,
-                [json.dumps({
-                                "prefix": "session evict",
-                                "filters": self._client_spec
-                })], "")
-            log.debug("mds_command: complete {0} {1}".format(ret, outs))
+    def _purge_dir(self, path, depth):
+        log.debug("purge {0}".format(path))
+        try:
+            dir_handle = self._fs.opendir(path)
+        except cephfs.ObjectNotFound:
+            return
 
-            # If we get a clean response, great, it's gone from that rank.
-            if ret == 0:
-                return True
-            elif ret == errno.ETIMEDOUT:
-                # Oh no, the MDS went laggy (that's how libcephfs knows to emit this error)
-                self._mds_map = self._volume_client._rados_command("mds dump", {})
-                try:
-                    self._wait_for_ready()
-                except self.GidGone:
-                    return True
-            else:
-                raise ClusterError("Sending evict to mds.{0}".format(self.gid), ret, outs)
+        with self._lock:
+            self._dirs.append((depth, path))
+
+        try:
+            d = self._fs.readdir(dir_handle)
+            while d:
+                if d.d_name not in [".", ".."]:
+                    # Do not use os.path.join because it is sensitive
+                    # to string encoding, we just pass through dnames
+                    # as byte arrays
+                    d_full = "{0}/{1}".format(path, d.d_name)
+                    if d.is_dir():
+                        self._pool.submit(self._purge_dir, d_full, depth + 1)
+                    else:
+                        self._unlink(d_full)
+
+                d = self._fs.readdir(dir_handle)
+        finally:
+            self._fs.closedir(dir_handle)
 
     def run(self):
+        """
+        Purge the tree.  The checkpoint file is left for the caller to
+        remove once it's done with the volume, since it may record more
+        than progress.  If stop_event gets set, checkpoint and raise
+        PurgeJob.Interrupted instead.
+
+        :return: dict of 'entries', 'elapsed' and 'entries_per_sec'
+        """
+        self._load_checkpoint()
+        self._start = time.time()
+        self._last_checkpoint = self._start
+
+        self._pool = WorkerPool(self._workers, name="purge")
         try:
-            self._evict()
-        except Exception as e:
-            self.success = False
-            self.exception = e
-        else:
-            self.success = True
+            self._pool.submit(self._purge_dir, self.root_path, 0)
+            self._pool.wait()
+
+            # A directory is only empty once all of its descendants are
+            # gone, so remove them one depth level at a time, deepest first.
+            levels = {}
+            for depth, path in self._dirs:
+                levels.setdefault(depth, []).append(path)
+            for depth in sorted(levels, reverse=True):
+                for path in levels[depth]:
+                    self._pool.submit(self._rmdir, path)
+                self._pool.wait()
+        except Exception:
+            try:
+                with self._lock:
+                    self._write_checkpoint()
+            except Exception as e:
+                log.warning("Unable to checkpoint purge of {0}: {1}".format(
+                    self.root_path, e))
+            raise
+        finally:
+            self._pool.shutdown()
+            self._pool = None
 
+        stats = self._stats()
+        log.info("purged {0}: {1} entries in {2:.1f}s, {3:.0f} entries/s".format(
+            self.root_path, stats['entries'], stats['elapsed'],
+            stats['entries_per_sec']))
+        return stats
 
-class EvictionError(Exception):
-    pass
 
+# Striping fields of a CephFS layout.  The pool and namespace are not in
+# this list: a copy keeps those of its destination, which is what isolates
+# one volume's data from another's.
+LAYOUT_STRIPING_FIELDS = ("stripe_unit", "stripe_count", "object_size")
 
-class CephFSVolumeClientError(Exception):
+
+def _parse_layout(layout):
     """
-    Something went wrong talking to Ceph using CephFSVolumeClient.
+    Split a "ceph.file.layout" / "ceph.dir.layout" value of the form
+    "stripe_unit=4194304 stripe_count=1 ... pool=foo" into a dict.
     """
-    pass
-
+    if not isinstance(layout, str):
+        layout = layout.decode("utf-8")
+    fields = {}
+    for token in layout.split():
+        if "=" in token:
+            key, value = token.split("=", 1)
+            fields[key] = value
+    return fields
 
-CEPHFSVOLUMECLIENT_VERSION_HISTORY = """
 
-    CephFSVolumeClient Version History:
+def _timestamp(value):
+    """
+    Seconds since the epoch of a stat time, which the bindings give us as
+    a (local time) datetime.
+    """
+    if hasattr(value, "timetuple"):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    return float(value)
 
-    * 1 - Initial version
-    * 2 - Added get_object, put_object, delete_object methods to CephFSVolumeClient
 
-"""
+class CopyJob(object):
+    """
+    Copy a directory tree, typically a snapshot, into an existing
+    directory using a pool of worker threads.
+
+    Directories are walked with opendir/readdir, each one a task that
+    creates its destination and queues its entries; every regular file is
+    then its own task, streamed through open/read/write in buffers of
+    BUFFER_SIZE bytes.  All-zero buffers are skipped rather than written,
+    so sparse files stay sparse.  Modes, user xattrs and layout striping
+    are preserved.
+    """
 
+    BUFFER_SIZE = 8 * 1024 * 1024
 
-class CephFSVolumeClient(object):
-    """
-    Combine libcephfs and librados interfaces to implement a
-    'Volume' concept implemented as a cephfs directory and
-    client capabilities which restrict mount access to this
-    directory.
+    # Seconds between progress reports
+    REPORT_INTERVAL = 10
 
-    Additionally, volumes may be in a 'Group'.  Conveniently,
-    volumes are a lot like manila shares, and groups are a lot
-    like manila consistency groups.
+    def __init__(self, volume_client, src, dst, workers):
+        self._fs = volume_client.fs
+        self.src = src
+        self.dst = dst
+        self._workers = workers
+        self._pool = None
 
-    Refer to volumes with VolumePath, which specifies the
-    volume and group IDs (both strings).  The group ID may
-    be None.
+        self._lock = threading.Lock()
+        self._files = 0
+        self._dirs = 0
+        self._bytes = 0
+        self._start = None
+        self._last_report = None
 
-    In general, functions in this class are allowed raise rados.Error
-    or cephfs.Error exceptions in unexpected situations.
-    """
+    def _stats(self):
+        elapsed = time.time() - self._start
+        return {
+            'files': self._files,
+            'dirs': self._dirs,
+            'bytes': self._bytes,
+            'elapsed': elapsed,
+            'bytes_per_sec': self._bytes / elapsed if elapsed > 0 else 0.0
+        }
 
-    # Current version
-    version = 2
+    def _progress(self, files=0, dirs=0, nbytes=0):
+        with self._lock:
+            self._files += files
+            self._dirs += dirs
+            self._bytes += nbytes
+            if time.time() - self._last_report >= self.REPORT_INTERVAL:
+                self._last_report = time.time()
+                stats = self._stats()
+                log.info("copy {0} -> {1}: {2} files, {3} dirs, {4} bytes, "
+                         "{5:.0f} bytes/s".format(
+                             self.src, self.dst, stats['files'], stats['dirs'],
+                             stats['bytes'], stats['bytes_per_sec']))
+
+    def _copy_xattrs(self, src, dst):
+        listxattr = getattr(self._fs, "listxattr", None)
+        if listxattr is None:
+            # Older bindings can't enumerate xattrs
+            return
+        _, names = listxattr(src)
+        for name in names.split(b"\0"):
+            if not name:
+                continue
+            name = name.decode("utf-8")
+            # Virtual xattrs are handled through the layout below
+            if name.startswith("ceph."):
+                continue
+            self._fs.setxattr(dst, name, self._fs.getxattr(src, name), 0)
 
-    # Where shall we create our volumes?
-    POOL_PREFIX = "fsvolume_"
-    DEFAULT_VOL_PREFIX = "/volumes"
-    DEFAULT_NS_PREFIX = "fsvolumens_"
+    def _chmod(self, path, mode):
+        chmod = getattr(self._fs, "chmod", None)
+        if chmod is None:
+            # Older bindings can't chmod: the mode given to open/mkdir is
+            # used, less the client umask
+            return
+        chmod(path, mode)
+
+    def _set_layout(self, path, attr, fields):
+        # All the fields in one go: Ceph validates the layout after every
+        # setxattr, and setting them one at a time can pass through an
+        # invalid layout, e.g. an 8M stripe unit while the object size is
+        # still 4M.
+        if fields:
+            self._fs.setxattr(path, attr, " ".join(
+                "{0}={1}".format(field, value) for field, value in fields), 0)
+
+    def _copy_dir_layout(self, src, dst):
+        fields = []
+        for field in LAYOUT_STRIPING_FIELDS:
+            try:
+                value = self._fs.getxattr(src, "ceph.dir.layout.{0}".format(field))
+            except cephfs.NoData:
+                continue
+            if not isinstance(value, str):
+                value = value.decode("utf-8")
+            if value:
+                fields.append((field, value))
+        self._set_layout(dst, "ceph.dir.layout", fields)
 
-    def __init__(self, auth_id, conf_path, cluster_name, volume_prefix=None, pool_ns_prefix=None):
-        self.fs = None
-        self.rados = None
-        self.connected = False
-        self.conf_path = conf_path
-        self.cluster_name = cluster_name
-        self.auth_id = auth_id
-        self.volume_prefix = volume_prefix if volume_prefix else self.DEFAULT_VOL_PREFIX
-        self.pool_ns_prefix = pool_ns_prefix if pool_ns_prefix else self.DEFAULT_NS_PREFIX
-        # For flock'ing in cephfs, I want a unique ID to distinguish me
-        # from any other manila-share services that are loading this module.
-        # We could use pid, but that's unnecessary weak: generate a
-        # UUID
-        self._id = struct.unpack(">Q", uuid.uuid1().get_bytes()[0:8])[0]
+    def _copy_file_layout(self, src, dst):
+        """
+        Must be called while dst is still empty.
 
-        # TODO: version the on-disk structures
+        :return: the object size of the source layout
+        """
+        src_layout = _parse_layout(self._fs.getxattr(src, "ceph.file.layout"))
+        dst_layout = _parse_layout(self._fs.getxattr(dst, "ceph.file.layout"))
+        self._set_layout(dst, "ceph.file.layout", [
+            (field, src_layout[field]) for field in LAYOUT_STRIPING_FIELDS
+            if field in src_layout and src_layout[field] != dst_layout.get(field)])
+        return int(src_layout.get("object_size", 0))
+
+    def _copy_file(self, src, dst, mode):
+        src_fd = self._fs.open(src, os.O_RDONLY)
+        try:
+            size = self._fs.fstat(src_fd).st_size
+            dst_fd = self._fs.open(dst, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode)
+            try:
+                object_size = self._copy_file_layout(src, dst)
+                # Read whole objects at a time where the layout allows
+                buffer_size = max(self.BUFFER_SIZE, object_size)
+                offset = 0
+                skipped_tail = False
+                while offset < size:
+                    buf = self._fs.read(src_fd, offset, buffer_size)
+                    if not buf:
+                        break
+                    skipped_tail = buf.count(b"\0") == len(buf)
+                    if not skipped_tail:
+                        self._fs.write(dst_fd, buf, offset)
+                    offset += len(buf)
+                    self._progress(nbytes=len(buf))
+                if skipped_tail:
+                    # The file ends in a hole: write its last byte so that
+                    # the copy has the right size.
+                    self._fs.write(dst_fd, b"\0", offset - 1)
+            finally:
+                self._fs.close(dst_fd)
+        finally:
+            self._fs.close(src_fd)
+
+        self._chmod(dst, mode)
+        self._copy_xattrs(src, dst)
+        self._progress(files=1)
+
+    def _copy_dir(self, src, dst, create):
+        log.debug("copy {0} -> {1}".format(src, dst))
+        if create:
+            mode = self._fs.stat(src).st_mode & 0o7777
+            self._fs.mkdir(dst, mode)
+            self._chmod(dst, mode)
+            self._copy_dir_layout(src, dst)
+            self._copy_xattrs(src, dst)
+            self._progress(dirs=1)
+
+        dir_handle = self._fs.opendir(src)
+        try:
+            d = self._fs.readdir(dir_handle)
+            while d:
+                if d.d_name not in [".", ".."]:
+                    # Pass dnames through untouched, as purge does
+                    d_src = "{0}/{1}".format(src, d.d_name)
+                    d_dst = "{0}/{1}".format(dst, d.d_name)
+                    if d.is_dir():
+                        self._pool.submit(self._copy_dir, d_src, d_dst, True)
+                    elif d.is_symbol_file():
+                        target = self._fs.readlink(d_src, 4096)
+                        self._fs.symlink(target, d_dst)
+                        self._progress(files=1)
+                    elif d.is_file():
+                        mode = self._fs.stat(d_src).st_mode & 0o7777
+                        self._pool.submit(self._copy_file, d_src, d_dst, mode)
+                    else:
+                        # Opening a FIFO would block the worker, and
+                        # sockets and devices have no data to copy
+                        log.warning("copy {0}: skipping special file".format(
+                            d_src))
 
-    def recover(self):
-        # Scan all auth keys to see if they're dirty: if they are, they have
-        # state that might not have propagated to Ceph or to the related
-        # volumes yet.
+                d = self._fs.readdir(dir_handle)
+        finally:
+            self._fs.closedir(dir_handle)
 
-        # Important: we *always* acquire locks in the order auth->volume
-        # That means a volume can never be dirty without the auth key
-        # we're updating it with being dirty at the same time.
+    def run(self):
+        """
+        Copy the contents of src into dst, which must already exist.
 
-        # First list the auth IDs that have potentially dirty on-disk metadata
-        log.debug("Recovering from partial auth updates (if any)...")
+        :return: dict of 'files', 'dirs', 'bytes', 'elapsed' and
+                 'bytes_per_sec'
+        """
+        self._start = time.time()
+        self._last_report = self._start
 
+        self._pool = WorkerPool(self._workers, name="copy")
         try:
-            dir_handle = self.fs.opendir(self.volume_prefix)
-        except cephfs.ObjectNotFound:
-            log.debug("Nothing to recover. No auth meta files.")
-            return
+            self._pool.submit(self._copy_dir, self.src, self.dst, False)
+            self._pool.wait()
+        finally:
+            self._pool.shutdown()
+            self._pool = None
 
-        d = self.fs.readdir(dir_handle)
-        auth_ids = []
+        stats = self._stats()
+        log.info("copied {0} -> {1}: {2} files, {3} dirs, {4} bytes in "
+                 "{5:.1f}s, {6:.0f} bytes/s".format(
+                     self.src, self.dst, stats['files'], stats['dirs'],
+                     stats['bytes'], stats['elapsed'], stats['bytes_per_sec']))
+        return stats
 
-        if not d:
-            log.debug("Nothing to recover. No auth meta files.")
 
-        while d:
-            # Identify auth IDs from auth meta filenames. The auth meta files
-            # are named as, "$<auth_id><meta filename extension>"
-            regex = "^\$(.*){0}$".format(re.escape(META_FILE_EXT))
-            match = re.search(regex, d.d_name)
-            if match:
-                auth_ids.append(match.group(1))
+class SnapshotSyncJob(object):
+    """
+    Bring a local directory up to date with a CephFS directory, typically
+    a snapshot, copying only what changed since the last sync.
+
+    CephFS keeps the newest ctime in each directory's subtree in its
+    "ceph.dir.rctime" xattr.  The state file remembers the source's rctime
+    as of the last sync, and only directories whose rctime has reached it
+    since are walked (and only files whose ctime has are copied), so a sync
+    costs in proportion to the changes rather than to the tree.  Entries
+    gone from a walked source directory are removed locally, and symlinks
+    in it are compared by target.  Times are compared to the second, erring
+    towards copying.
+
+    Files are copied into a temporary name and renamed into place, and the
+    state file is only updated once everything has been copied, so an
+    interrupted sync is simply redone by the next one.
+
+    Successive syncs into dst usually copy different snapshots of the same
+    tree, `origin`.  A state file left by a sync from another origin is
+    ignored, and the whole tree synced.
+    """
 
-            d = self.fs.readdir(dir_handle)
+    BUFFER_SIZE = 8 * 1024 * 1024
+
+    TMP_SUFFIX = ".sync-tmp"
+
+    def __init__(self, volume_client, src, dst, state_path, workers,
+                 origin=None):
+        self._fs = volume_client.fs
+        self.src = src
+        self.origin = origin if origin else src
+        self.dst = dst
+        self.state_path = state_path
+        self._workers = workers
+        self._pool = None
+        self._since = None
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'files': 0,
+            'bytes': 0,
+            'dirs': 0,
+            'skipped_dirs': 0,
+            'removed': 0,
+        }
 
-        self.fs.closedir(dir_handle)
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
 
-        # Key points based on ordering:
-        # * Anything added in VMeta is already added in AMeta
-        # * Anything added in Ceph is already added in VMeta
-        # * Anything removed in VMeta is already removed in Ceph
-        # * Anything removed in AMeta is already removed in VMeta
+    def _rctime(self, path):
+        value = self._fs.getxattr(path, "ceph.dir.rctime")
+        if not isinstance(value, str):
+            value = value.decode("utf-8")
+        return int(value.split(".")[0])
 
-        # Deauthorization: because I only update metadata AFTER the
-        # update of the next level down, I have the same ordering of
-        # -> things which exist in the AMeta should also exist
-        #    in the VMeta, should also exist in Ceph, and the same
-        #    recovery procedure that gets me consistent after crashes
-        #    during authorization will also work during deauthorization
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
 
-        # Now for each auth ID, check for dirty flag and apply updates
-        # if dirty flag is found
-        for auth_id in auth_ids:
-            with self._auth_lock(auth_id):
-                auth_meta = self._auth_metadata_get(auth_id)
-                if not auth_meta or not auth_meta['volumes']:
-                    # Clean up auth meta file
-                    self.fs.unlink(self._auth_metadata_path(auth_id))
-                    continue
-                if not auth_meta['dirty']:
-                    continue
-                self._recover_auth_meta(auth_id, auth_meta)
+    def _save_state(self, state):
+        tmp_path = self.state_path + self.TMP_SUFFIX
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.state_path)
 
-        log.debug("Recovered from partial auth updates (if any).")
+    def _changed(self, seconds):
+        return self._since is None or seconds >= self._since
 
-    def _recover_auth_meta(self, auth_id, auth_meta):
+    def _remove_local(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        self._count('removed')
+
+    def _copy_file(self, src, dst, statbuf):
+        tmp_path = dst + self.TMP_SUFFIX
+        src_fd = self._fs.open(src, os.O_RDONLY)
+        try:
+            with open(tmp_path, "wb") as f:
+                offset = 0
+                while offset < statbuf.st_size:
+                    buf = self._fs.read(src_fd, offset, self.BUFFER_SIZE)
+                    if not buf:
+                        break
+                    f.write(buf)
+                    offset += len(buf)
+                self._count('bytes', offset)
+        finally:
+            self._fs.close(src_fd)
+
+        os.chmod(tmp_path, statbuf.st_mode & 0o7777)
+        mtime = _timestamp(statbuf.st_mtime)
+        os.utime(tmp_path, (mtime, mtime))
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            self._remove_local(dst)
+        os.rename(tmp_path, dst)
+        self._count('files')
+
+    def _sync_dir(self, src, dst):
+        log.debug("sync {0} -> {1}".format(src, dst))
+        mode = self._fs.stat(src).st_mode & 0o7777
+        if os.path.lexists(dst) and (os.path.islink(dst) or
+                                     not os.path.isdir(dst)):
+            self._remove_local(dst)
+        if not os.path.isdir(dst):
+            os.mkdir(dst)
+        os.chmod(dst, mode)
+        self._count('dirs')
+
+        names = set()
+        dir_handle = self._fs.opendir(src)
+        try:
+            d = self._fs.readdir(dir_handle)
+            while d:
+                if d.d_name not in [".", ".."]:
+                    names.add(d.d_name)
+                    d_src = "{0}/{1}".format(src, d.d_name)
+                    d_dst = os.path.join(dst, d.d_name)
+                    if d.is_dir():
+                        if not os.path.isdir(d_dst) or \
+                                self._changed(self._rctime(d_src)):
+                            self._pool.submit(self._sync_dir, d_src, d_dst)
+                        else:
+                            self._count('skipped_dirs')
+                    elif d.is_symbol_file():
+                        self._sync_symlink(d_src, d_dst)
+                    elif d.is_file():
+                        statbuf = self._fs.stat(d_src)
+                        if not os.path.lexists(d_dst) or \
+                                self._changed(_timestamp(statbuf.st_ctime)):
+                            self._pool.submit(self._copy_file, d_src,
+                                              d_dst, statbuf)
+                    else:
+                        # Opening a FIFO would block the worker, and
+                        # sockets and devices have no data to copy
+                        log.warning("sync {0}: skipping special file".format(
+                            d_src))
+                d = self._fs.readdir(dir_handle)
+        finally:
+            self._fs.closedir(dir_handle)
+
+        for name in os.listdir(dst):
+            if name not in names and not name.endswith(self.TMP_SUFFIX):
+                self._remove_local(os.path.join(dst, name))
+
+    def _sync_symlink(self, src, dst):
+        # stat would follow the link, so compare targets instead of times
+        target = self._fs.readlink(src, 4096)
+        if not isinstance(target, str):
+            target = target.decode("utf-8")
+        if os.path.islink(dst) and os.readlink(dst) == target:
+            return
+        if os.path.lexists(dst):
+            self._remove_local(dst)
+        os.symlink(target, dst)
+        self._count('files')
+
+    def run(self):
         """
-        Call me after locking the auth meta file.
+        :return: dict of 'files' (and symlinks) copied, 'bytes' copied,
+                 'dirs' walked, 'skipped_dirs' (subtrees left unwalked),
+                 'removed' local entries, 'elapsed' and 'incremental'
+                 (False if there was no state to start from)
         """
-        remove_volumes = []
+        start = time.time()
+        state = self._load_state()
+        if state and state.get('origin') != self.origin:
+            log.warning("sync {0} -> {1}: state in {2} is for {3}, syncing "
+                        "everything".format(self.src, self.dst, self.state_path,
+                                            state.get('origin', state['src'])))
+            state = None
+        self._since = state['rctime'] if state else None
+
+        # Read up front, so that changes made while we copy (if src isn't
+        # a snapshot) are picked up next time.
+        rctime = self._rctime(self.src)
+
+        self._pool = WorkerPool(self._workers, name="sync")
+        try:
+            self._pool.submit(self._sync_dir, self.src, self.dst)
+            self._pool.wait()
+        finally:
+            self._pool.shutdown()
+            self._pool = None
 
-        for volume, volume_data in auth_meta['volumes'].items():
-            if not volume_data['dirty']:
-                continue
+        self._save_state({'src': self.src, 'origin': self.origin,
+                          'rctime': rctime})
 
-            (group_id, volume_id) = volume.split('/')
-            group_id = group_id if group_id is not 'None' else None
-            volume_path = VolumePath(group_id, volume_id)
-            access_level = volume_data['access_level']
+        stats = dict(self._stats, elapsed=time.time() - start,
+                     incremental=self._since is not None)
+        log.info("synced {0} -> {1}: {2}".format(self.src, self.dst, stats))
+        return stats
 
-            with self._volume_lock(volume_path):
-                vol_meta = self._volume_metadata_get(volume_path)
 
-                # No VMeta update indicates that there was no auth update
-                # in Ceph either. So it's safe to remove corresponding
-                # partial update in AMeta.
+class TrashPurger(threading.Thread):
+    """
+    Background service purging the volumes that delete_volume moved into
+    the trash folder.
+
+    The trash folder is rescanned every `scan_interval` seconds (or as soon
+    as wake() is called), and each trashed volume not already being purged
+    is handed to a pool of `workers` threads, so at most that many purges
+    run at once.  Every purge runs `purge_workers` threads of its own, and
+    all of them share a limit of `ops_per_sec` unlinks/rmdirs per second
+    to keep the MDS responsive for everybody else.
+
+    All the state lives in the trash folder itself, with PurgeJob
+    checkpoints alongside, so a restarted purger simply picks up whatever
+    is still there.
+    """
+    def __init__(self, volume_client, workers=2, purge_workers=4,
+                 ops_per_sec=None, scan_interval=60):
+        self._volume_client = volume_client
+        self._workers = workers
+        self._purge_workers = purge_workers
+        self._rate_limiter = RateLimiter(ops_per_sec)
+        self._scan_interval = scan_interval
+
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = set()
+
+        super(TrashPurger, self).__init__(name="trash-purger")
+        self.daemon = True
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        self.join()
+
+    def _trashed_volumes(self):
+        fs = self._volume_client.fs
+        try:
+            dir_handle = fs.opendir(self._volume_client._get_trash_path())
+        except cephfs.ObjectNotFound:
+            return []
+
+        volume_ids = OrderedDict()
+        try:
+            d = fs.readdir(dir_handle)
+            while d:
+                if d.d_name not in [".", ".."]:
+                    if d.is_dir():
+                        volume_ids[d.d_name] = True
+                    elif d.d_name.endswith(META_FILE_EXT):
+                        # A checkpoint outliving its tree: the volume's
+                        # pool may still need deleting
+                        volume_ids[d.d_name[:-len(META_FILE_EXT)]] = True
+                d = fs.readdir(dir_handle)
+        finally:
+            fs.closedir(dir_handle)
+        return list(volume_ids.keys())
+
+    def _purge(self, volume_id):
+        try:
+            self._volume_client._purge_trashed(
+                volume_id, workers=self._purge_workers,
+                rate_limiter=self._rate_limiter, stop_event=self._stopping)
+        except PurgeJob.Interrupted:
+            log.info("Background purge of volume {0} interrupted".format(volume_id))
+        except Exception as e:
+            # Leave it in the trash, the next scan will retry
+            log.error("Background purge of volume {0} failed: {1}".format(
+                volume_id, e))
+        finally:
+            with self._lock:
+                self._in_flight.discard(volume_id)
+
+    def run(self):
+        log.info("Trash purger started")
+        pool = WorkerPool(self._workers, name="trash-purger")
+        try:
+            while not self._stopping.is_set():
+                self._wakeup.clear()
+                try:
+                    volume_ids = self._trashed_volumes()
+                except Exception as e:
+                    log.error("Unable to scan the trash: {0}".format(e))
+                    volume_ids = []
+
+                for volume_id in volume_ids:
+                    with self._lock:
+                        if volume_id in self._in_flight:
+                            continue
+                        self._in_flight.add(volume_id)
+                    pool.submit(self._purge, volume_id)
+
+                self._wakeup.wait(self._scan_interval)
+        finally:
+            # Running purges checkpoint and bail out once they see
+            # self._stopping; they are resumed on restart.
+            pool.shutdown()
+            log.info("Trash purger stopped")
+
+
+class SnapshotScheduler(threading.Thread):
+    """
+    Background service snapshotting volumes and groups every `interval`
+    seconds, and pruning the snapshots it made down to the newest one in
+    each of the last `hourly` hours, `daily` days and `weekly` weeks.
+
+    Snapshots are named "<prefix>-<UTC time>", which is how the scheduler
+    recognises its own snapshots when it lists a snapdir; anything else in
+    there is left alone.  Up to `workers` volumes/groups are handled at
+    once, and all snapdir mkdirs and rmdirs share a limit of `ops_per_sec`
+    per second, since each one is a sizeable piece of work for the MDS.
+
+    run_once() does a single pass, for callers with a scheduler of their
+    own.
+    """
+
+    TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+    def __init__(self, volume_client, volume_paths=None, group_ids=None,
+                 hourly=24, daily=7, weekly=4, workers=4, ops_per_sec=None,
+                 interval=3600, prefix="scheduled"):
+        """
+        :param volume_paths: VolumePaths to snapshot, or None for every
+                             volume (listed afresh on each pass)
+        :param group_ids: group IDs to snapshot
+        """
+        self._volume_client = volume_client
+        self._volume_paths = volume_paths
+        self._group_ids = group_ids if group_ids else []
+        self._retention = (hourly, daily, weekly)
+        self._workers = workers
+        self._rate_limiter = RateLimiter(ops_per_sec)
+        self._interval = interval
+        self._prefix = prefix
+        self._regex = re.compile("^{0}-(\\d{{8}}-\\d{{6}})$".format(re.escape(prefix)))
+
+        self._stopping = threading.Event()
+
+        super(SnapshotScheduler, self).__init__(name="snapshot-scheduler")
+        self.daemon = True
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    @staticmethod
+    def retain(stamps, hourly, daily, weekly):
+        """
+        Of a list of datetimes, return the set to keep: the newest in each
+        of the `hourly` most recent hours that have one, likewise for days
+        and (ISO) weeks.
+        """
+        periods = [
+            (hourly, lambda stamp: (stamp.date(), stamp.hour)),
+            (daily, lambda stamp: stamp.date()),
+            (weekly, lambda stamp: stamp.isocalendar()[0:2]),
+        ]
+        keep = set()
+        newest_first = sorted(stamps, reverse=True)
+        for count, period in periods:
+            seen = set()
+            for stamp in newest_first:
+                if len(seen) >= count:
+                    break
+                key = period(stamp)
+                if key not in seen:
+                    seen.add(key)
+                    keep.add(stamp)
+        return keep
+
+    def _targets(self):
+        volume_client = self._volume_client
+        volume_paths = self._volume_paths
+        if volume_paths is None:
+            volume_paths = volume_client._list_all_volumes()
+        for volume_path in volume_paths:
+            yield volume_client._get_path(volume_path)
+        for group_id in self._group_ids:
+            yield volume_client._get_group_path(group_id)
+
+    def _snapshot(self, dir_path, now):
+        """
+        :return: (snapshots created, snapshots destroyed)
+        """
+        volume_client = self._volume_client
+        snapshot_name = "{0}-{1}".format(self._prefix,
+                                         now.strftime(self.TIME_FORMAT))
+        created = 0
+        self._rate_limiter.acquire()
+        try:
+            volume_client._snapshot_create(dir_path, snapshot_name)
+            created = 1
+        except cephfs.ObjectExists:
+            pass
+
+        stamps = {}
+        for name in volume_client._list_snapshots(dir_path):
+            match = self._regex.match(name)
+            if match:
+                stamps[datetime.datetime.strptime(
+                    match.group(1), self.TIME_FORMAT)] = name
+
+        keep = self.retain(list(stamps.keys()), *self._retention)
+        destroyed = 0
+        for stamp, name in stamps.items():
+            if stamp not in keep:
+                self._rate_limiter.acquire()
+                volume_client._snapshot_destroy(dir_path, name)
+                destroyed += 1
+        return created, destroyed
+
+    def run_once(self, now=None):
+        """
+        Snapshot every target and apply retention.
+
+        :param now: UTC datetime to name the snapshots after, default now
+        :return: dict of 'created', 'destroyed' and 'failed' counts
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        stats = {'created': 0, 'destroyed': 0, 'failed': 0}
+        with WorkerPool(self._workers, name="snapshot") as pool:
+            for dir_path, result, error in pool.map_unordered(
+                    lambda dir_path: self._snapshot(dir_path, now),
+                    self._targets()):
+                if error is not None:
+                    log.error("Scheduled snapshot of {0} failed: {1}".format(
+                        dir_path, error))
+                    stats['failed'] += 1
+                else:
+                    stats['created'] += result[0]
+                    stats['destroyed'] += result[1]
+        log.info("Scheduled snapshots: {0}".format(stats))
+        return stats
+
+    def run(self):
+        log.info("Snapshot scheduler started")
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                log.error("Scheduled snapshot pass failed: {0}".format(e))
+            self._stopping.wait(self._interval)
+        log.info("Snapshot scheduler stopped")
+
+
+class MetadataVersion(object):
+    """
+    A meta file's inode and change attribute, as statx gives them.  The
+    change attribute moves on with every change to the file, so unlike
+    its times it identifies the contents exactly.
+    """
+    def __init__(self, ino, change_attr):
+        self.st_ino = ino
+        self.st_version = change_attr
+
+
+class MetadataCache(object):
+    """
+    Decoded metadata files, keyed by path and tagged with the version of
+    the file they were read from (or written to), so that a caller holding
+    the file's lock can skip the read and decode when the file is unchanged.
+
+    Where the bindings have statx, the version is a MetadataVersion, and
+    entries are trusted straight away.  Otherwise it comes from fstat, and
+    CephFS hands us mtime/ctime with as little as one second of
+    resolution, so a file rewritten with the same size within the second
+    would look unchanged.  Like git's racy index entries, such an entry is
+    only trusted if the file had already been stable for RACY_WINDOW
+    seconds when it was cached; anything else is re-read (and re-cached)
+    next time.
+    """
+
+    RACY_WINDOW = 2
+
+    def __init__(self, max_entries=4096):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _version(statbuf):
+        if isinstance(statbuf, MetadataVersion):
+            return (statbuf.st_ino, statbuf.st_version)
+        return (statbuf.st_ino, statbuf.st_size,
+                _timestamp(statbuf.st_mtime),
+                _timestamp(statbuf.st_ctime))
+
+    def get(self, path, statbuf):
+        """
+        :return: (True, copy of the cached data) on a hit, else (False, None)
+        """
+        version = self._version(statbuf)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == version and entry[1]:
+                self._entries.pop(path)
+                self._entries[path] = entry
+                self.hits += 1
+                return True, copy.deepcopy(entry[2])
+            self.misses += 1
+            return False, None
+
+    def put(self, path, statbuf, data):
+        version = self._version(statbuf)
+        trusted = (isinstance(statbuf, MetadataVersion) or
+                   time.time() - version[2] >= self.RACY_WINDOW)
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = (version, trusted, copy.deepcopy(data))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+
+class LockTable(object):
+    """
+    Process-local table of the CephFS file locks held by one
+    CephFSVolumeClient.
+
+    CephFS flocks are owned by the client's id, which all of its threads
+    share, so the table is what actually keeps threads apart: one thread
+    at a time holds a path, re-entering it for free, while other threads
+    queue up locally rather than in the MDS.  When the holder exits and
+    local waiters remain, the CephFS lock is handed straight to the next
+    of them; it's only released once the last local holder exits, or
+    after MAX_HANDOFFS handoffs in a row so that other clients get a look
+    in.  A thread handed the lock first checks that it still locks the
+    file at the path, since the previous holder may have unlinked it.
+
+    The table counts acquisitions, re-entries, acquisitions that had to
+    wait for another local thread, handoffs and CephFS lock round trips.
+    """
+
+    MAX_HANDOFFS = 16
+
+    class Entry(object):
+        def __init__(self):
+            self.owner = None
+            self.depth = 0
+            self.waiters = 0
+            self.handoffs = 0
+            self.handle = None
+
+    def __init__(self, acquire, release, check=None):
+        """
+        :param acquire: callable taking a path, taking the CephFS lock on it
+                        and returning a handle for release
+        :param release: callable taking a path and handle, releasing the
+                        CephFS lock
+        :param check: callable taking a path and handle, returning whether
+                      the handle still locks the file at path
+        """
+        self._acquire = acquire
+        self._release = release
+        self._check = check
+        self._entries = {}
+        self._cond = threading.Condition()
+        self.acquisitions = 0
+        self.reentries = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.handoffs = 0
+        self.stale_handoffs = 0
+        self.cephfs_acquisitions = 0
+
+    def acquire(self, path):
+        me = threading.current_thread()
+        with self._cond:
+            self.acquisitions += 1
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = self._entries[path] = LockTable.Entry()
+            if entry.owner is me:
+                entry.depth += 1
+                self.reentries += 1
+                return
+            if entry.owner is not None:
+                self.contended += 1
+                start = time.time()
+                entry.waiters += 1
+                try:
+                    while entry.owner is not None:
+                        self._cond.wait()
+                finally:
+                    entry.waiters -= 1
+                self.wait_time += time.time() - start
+            entry.owner = me
+            entry.depth = 1
+            handle = entry.handle
+
+        # We own the entry, so nobody else will touch the CephFS lock while
+        # we check or take it.
+        try:
+            if handle is not None:
+                if self._check is None or self._check(path, handle):
+                    return
+                # Handed off a lock on a file the previous holder unlinked
+                # or replaced, which no longer keeps other clients out.
+                with self._cond:
+                    entry.handle = None
+                    entry.handoffs = 0
+                    self.stale_handoffs += 1
+                self._release(path, handle)
+            handle = self._acquire(path)
+        except:
+            with self._cond:
+                self._disown(path, entry)
+            raise
+
+        with self._cond:
+            entry.handle = handle
+            self.cephfs_acquisitions += 1
+
+    def release(self, path):
+        with self._cond:
+            entry = self._entries[path]
+            assert entry.owner is threading.current_thread()
+            entry.depth -= 1
+            if entry.depth:
+                return
+            if entry.waiters and entry.handoffs < self.MAX_HANDOFFS:
+                entry.handoffs += 1
+                self.handoffs += 1
+                entry.owner = None
+                self._cond.notify_all()
+                return
+            handle = entry.handle
+            entry.handle = None
+            entry.handoffs = 0
+
+        # Still the owner while we drop the CephFS lock, so that no other
+        # thread takes it (under the same lock owner id) in the meantime.
+        try:
+            self._release(path, handle)
+        finally:
+            with self._cond:
+                self._disown(path, entry)
+
+    def _disown(self, path, entry):
+        """
+        Call me with the table locked!
+        """
+        entry.owner = None
+        entry.depth = 0
+        if entry.waiters:
+            self._cond.notify_all()
+        elif entry.handle is None:
+            del self._entries[path]
+
+    def depth(self, path):
+        """
+        How many times the calling thread holds path (0 if it doesn't).
+        """
+        with self._cond:
+            entry = self._entries.get(path)
+            if entry is None or entry.owner is not threading.current_thread():
+                return 0
+            return entry.depth
+
+    @contextmanager
+    def hold(self, path):
+        self.acquire(path)
+        try:
+            yield
+        finally:
+            self.release(path)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'acquisitions': self.acquisitions,
+                'reentries': self.reentries,
+                'contended': self.contended,
+                'wait_time': self.wait_time,
+                'handoffs': self.handoffs,
+                'stale_handoffs': self.stale_handoffs,
+                'cephfs_acquisitions': self.cephfs_acquisitions,
+                'held': len([entry for entry in self._entries.values()
+                             if entry.owner is not None]),
+                'waiters': sum(entry.waiters
+                               for entry in self._entries.values()),
+            }
+
+
+class MDSMapWatcher(object):
+    """
+    MDS map shared by the RankEvicter threads of one eviction.
+
+    Rather than each evicter re-issuing "mds dump" on its own, they ask the
+    watcher, which runs at most one fetch at a time (everybody else waits
+    for its result) and at most one every POLL_PERIOD seconds.
+    """
+
+    POLL_PERIOD = 0.5
+
+    def __init__(self, volume_client, mds_map):
+        self._volume_client = volume_client
+        self._mds_map = mds_map
+        self._cond = threading.Condition()
+        self._fetching = False
+        self._generation = 0
+        self._last_fetch = time.time()
+
+    @property
+    def mds_map(self):
+        with self._cond:
+            return self._mds_map
+
+    def _newer(self, mds_map):
+        return (mds_map.get('epoch') is None or self._mds_map.get('epoch') is None or
+                mds_map['epoch'] > self._mds_map['epoch'])
+
+    def refresh(self):
+        """
+        Fetch the MDS map, or wait for a fetch already in flight, and return
+        the latest map.
+        """
+        with self._cond:
+            if self._fetching:
+                generation = self._generation
+                while self._generation == generation:
+                    self._cond.wait()
+                return self._mds_map
+            self._fetching = True
+            delay = self._last_fetch + self.POLL_PERIOD - time.time()
+
+        mds_map = None
+        try:
+            if delay > 0:
+                time.sleep(delay)
+            mds_map = self._volume_client._rados_command("mds dump", {})
+        finally:
+            with self._cond:
+                if mds_map is not None and self._newer(mds_map):
+                    self._mds_map = mds_map
+                self._fetching = False
+                self._last_fetch = time.time()
+                self._generation += 1
+                self._cond.notify_all()
+
+        with self._cond:
+            return self._mds_map
+
+    def wait_for_change(self, epoch, timeout):
+        """
+        Return the first MDS map with an epoch other than `epoch`, or the
+        latest map if there is none within `timeout` seconds.
+        """
+        if epoch is None:
+            # Can't tell maps apart, so anything fetched will do
+            return self.refresh()
+
+        deadline = time.time() + timeout
+        mds_map = self.mds_map
+        while mds_map.get('epoch') == epoch and time.time() < deadline:
+            mds_map = self.refresh()
+        return mds_map
+
+
+class ClusterMapCache(object):
+    """
+    Cache of the OSD and MDS maps, refreshed only when their epoch moves.
+
+    Looking at a map costs a small "osd stat"/"mds stat" to read the
+    current epoch (at most every CHECK_INTERVAL seconds), and only when
+    that differs from the cached one the full dump.  Concurrent callers
+    share a single fetch.  The OSD map also gets a pool name -> pool ID
+    index.  Call invalidate() after changing a map ourselves.
+    """
+
+    CHECK_INTERVAL = 1.0
+
+    # Map kind -> (epoch command, dump command)
+    COMMANDS = {
+        'osd': ('osd stat', 'osd dump'),
+        'mds': ('mds stat', 'mds dump'),
+    }
+
+    def __init__(self, volume_client):
+        self._volume_client = volume_client
+        self._cond = threading.Condition()
+        # Map kind -> (epoch, map, time of the last epoch check)
+        self._maps = {}
+        self._fetching = set()
+        self._pool_ids = {}
+
+    def _epoch(self, kind):
+        stat = self._volume_client._rados_command(self.COMMANDS[kind][0], {})
+        if not stat:
+            return None
+        # The epoch sits at the top level or under "osdmap"/"fsmap"
+        # depending on the Ceph release.
+        for section in (stat, stat.get('osdmap'), stat.get('fsmap')):
+            if isinstance(section, dict) and 'epoch' in section:
+                return section['epoch']
+        return None
+
+    def _get(self, kind):
+        with self._cond:
+            while kind in self._fetching:
+                self._cond.wait()
+            entry = self._maps.get(kind)
+            if entry is not None and time.time() - entry[2] < self.CHECK_INTERVAL:
+                return entry[1]
+            self._fetching.add(kind)
+
+        new_entry = None
+        pool_ids = None
+        try:
+            epoch = self._epoch(kind)
+            if entry is not None and epoch is not None and epoch == entry[0]:
+                new_entry = (epoch, entry[1], time.time())
+            else:
+                cluster_map = self._volume_client._rados_command(
+                    self.COMMANDS[kind][1], {})
+                new_entry = (epoch, cluster_map, time.time())
+                if kind == 'osd':
+                    pool_ids = dict((pool['pool_name'], pool['pool'])
+                                    for pool in cluster_map['pools'])
+        finally:
+            with self._cond:
+                self._fetching.discard(kind)
+                if new_entry is not None:
+                    self._maps[kind] = new_entry
+                if pool_ids is not None:
+                    self._pool_ids = pool_ids
+                self._cond.notify_all()
+
+        return new_entry[1]
+
+    def osd_map(self):
+        return self._get('osd')
+
+    def mds_map(self):
+        return self._get('mds')
+
+    def pool_id(self, pool_name):
+        self.osd_map()
+        with self._cond:
+            return self._pool_ids.get(pool_name)
+
+    def invalidate(self, kind=None):
+        with self._cond:
+            if kind is None:
+                self._maps.clear()
+            else:
+                self._maps.pop(kind, None)
+
+
+class RankEvicter(threading.Thread):
+    """
+    Thread for evicting client(s) from a particular MDS daemon instance.
+
+    This is more complex than simply sending a command, because we have to
+    handle cases where MDS daemons might not be fully up yet, and/or might
+    be transiently unresponsive to commands.
+    """
+    class GidGone(Exception):
+        pass
+
+    def __init__(self, volume_client, client_specs, rank, gid, mds_map_watcher, ready_timeout):
+        """
+        :param client_specs: list of client specs, each a list of strings used as filter
+                             arguments to one "session evict": pass [["id=123"]] to evict
+                             a single client with session id 123.
+        :param mds_map_watcher: MDSMapWatcher shared with the other ranks' evicters
+        """
+        self.rank = rank
+        self.gid = gid
+        self._mds_map_watcher = mds_map_watcher
+        self._mds_map = mds_map_watcher.mds_map
+        self._client_specs = client_specs
+        self._volume_client = volume_client
+        self._ready_timeout = ready_timeout
+        self._ready_waited = 0
+
+        self.success = False
+        self.exception = None
+        # For each client spec, None once evicted or the exception that
+        # prevented it
+        self.errors = [None] * len(client_specs)
+
+        super(RankEvicter, self).__init__()
+
+    def _ready_to_evict(self):
+        if self._mds_map['up'].get("mds_{0}".format(self.rank), None) != self.gid:
+            log.info("Evicting {0} from {1}/{2}: rank no longer associated with gid, done.".format(
+                self._client_specs, self.rank, self.gid
+            ))
+            raise RankEvicter.GidGone()
+
+        info = self._mds_map['info']["gid_{0}".format(self.gid)]
+        log.debug("_ready_to_evict: state={0}".format(info['state']))
+        return info['state'] in ["up:active", "up:clientreplay"]
+
+    def _wait_for_ready(self):
+        """
+        Wait for that MDS rank to reach an active or clientreplay state, and
+        not be laggy.
+        """
+        while not self._ready_to_evict():
+            if self._ready_waited > self._ready_timeout:
+                raise ClusterTimeout()
+
+            # Sleep until the map changes rather than for a fixed period
+            start = time.time()
+            self._mds_map = self._mds_map_watcher.wait_for_change(
+                self._mds_map.get('epoch'),
+                max(self._ready_timeout - self._ready_waited,
+                    MDSMapWatcher.POLL_PERIOD))
+            self._ready_waited += time.time() - start
+
+    def _evict(self, client_spec):
+        """
+        Run the eviction procedure.  Return true on success, false on errors.
+        """
+
+        # Wait til the MDS is believed by the mon to be available for commands
+        try:
+            self._wait_for_ready()
+        except self.GidGone:
+            return True
+
+        # Then send it an evict
+        ret = errno.ETIMEDOUT
+        while ret == errno.ETIMEDOUT:
+            log.debug("mds_command: {0}, {1}".format(
+                "%s" % self.gid, ["session", "evict"] + client_spec
+            ))
+            ret, outb, outs = self._volume_client.fs.mds_command(
+                "%s" % self.gid,
+                [json.dumps({
+                                "prefix": "session evict",
+                                "filters": client_spec
+                })], "")
+            log.debug("mds_command: complete {0} {1}".format(ret, outs))
+
+            # If we get a clean response, great, it's gone from that rank.
+            if ret == 0:
+                return True
+            elif ret == errno.ETIMEDOUT:
+                # Oh no, the MDS went laggy (that's how libcephfs knows to emit this error)
+                self._mds_map = self._mds_map_watcher.refresh()
+                try:
+                    self._wait_for_ready()
+                except self.GidGone:
+                    return True
+            else:
+                raise ClusterError("Sending evict to mds.{0}".format(self.gid), ret, outs)
+
+    def run(self):
+        for i, client_spec in enumerate(self._client_specs):
+            try:
+                self._evict(client_spec)
+            except ClusterTimeout as e:
+                # The rank isn't coming back in time for any of the rest
+                # either
+                for j in range(i, len(self._client_specs)):
+                    self.errors[j] = e
+                break
+            except Exception as e:
+                self.errors[i] = e
+
+        failures = [e for e in self.errors if e is not None]
+        self.success = not failures
+        self.exception = failures[0] if failures else None
+
+
+class EvictionError(Exception):
+    pass
+
+
+class CephFSVolumeClientError(Exception):
+    """
+    Something went wrong talking to Ceph using CephFSVolumeClient.
+    """
+    pass
+
+
+CEPHFSVOLUMECLIENT_VERSION_HISTORY = """
+
+    CephFSVolumeClient Version History:
+
+    * 1 - Initial version
+    * 2 - Added get_object, put_object, delete_object methods to CephFSVolumeClient
+    * 3 - Added start_purger, stop_purger methods to CephFSVolumeClient
+    * 4 - Added wait_for_recovery method and connect(defer_recover) to CephFSVolumeClient
+    * 5 - Added evict_many method to CephFSVolumeClient
+    * 6 - Added put_object_striped, get_object_striped, delete_object_striped
+          methods to CephFSVolumeClient
+    * 7 - Added put_objects, get_objects methods to CephFSVolumeClient
+    * 8 - Added authorize_many method to CephFSVolumeClient
+    * 9 - Added authorize_volumes method to CephFSVolumeClient
+    * 10 - Added lock_stats method to CephFSVolumeClient
+    * 11 - Added meta_layout option and migrate_metadata_layout method to
+           CephFSVolumeClient
+    * 12 - Added list_groups, list_volumes, list_volumes_with_usage methods
+           to CephFSVolumeClient
+    * 13 - Added get_used_bytes_many, set_max_bytes_many methods to
+           CephFSVolumeClient
+    * 14 - Added create_volumes method to CephFSVolumeClient
+    * 15 - Added start_snapshot_scheduler, stop_snapshot_scheduler methods
+           to CephFSVolumeClient
+    * 16 - Added sync_snapshot_to_local method to CephFSVolumeClient
+
+"""
+
+
+class CephFSVolumeClient(object):
+    """
+    Combine libcephfs and librados interfaces to implement a
+    'Volume' concept implemented as a cephfs directory and
+    client capabilities which restrict mount access to this
+    directory.
+
+    Additionally, volumes may be in a 'Group'.  Conveniently,
+    volumes are a lot like manila shares, and groups are a lot
+    like manila consistency groups.
+
+    Refer to volumes with VolumePath, which specifies the
+    volume and group IDs (both strings).  The group ID may
+    be None.
+
+    In general, functions in this class are allowed raise rados.Error
+    or cephfs.Error exceptions in unexpected situations.
+    """
+
+    # Current version
+    version = 16
+
+    # Where shall we create our volumes?
+    POOL_PREFIX = "fsvolume_"
+    DEFAULT_VOL_PREFIX = "/volumes"
+    DEFAULT_NS_PREFIX = "fsvolumens_"
+
+    # Metadata files are read and written in chunks of this many bytes
+    METADATA_CHUNK_SIZE = 64 * 1024
+
+    # Striped objects are split into chunk objects of (at most) this size,
+    # with up to STRIPE_IN_FLIGHT chunk reads/writes outstanding at once.
+    STRIPE_CHUNK_SIZE = 4 * 1024 * 1024
+    STRIPE_IN_FLIGHT = 8
+
+    # Xattr of a striped object's (empty) head object holding its manifest
+    STRIPE_MANIFEST_XATTR = "striped_manifest"
+
+    # Outstanding reads/writes for put_objects/get_objects, and the bytes
+    # get_objects asks for first
+    OBJECT_IN_FLIGHT = 32
+    OBJECT_READ_SIZE = 64 * 1024
+
+    # Worker threads used by recover
+    RECOVER_WORKERS = 16
+
+    # Concurrent Ceph auth updates issued by authorize_many
+    AUTHORIZE_WORKERS = 8
+
+    # Mon commands that don't change anything, so needn't wait for pending
+    # metadata writes (see _metadata_batch)
+    READ_ONLY_COMMANDS = frozenset([
+        'auth get', 'osd stat', 'osd dump', 'mds stat', 'mds dump'])
+
+    # Worker threads used by purge_volume and clone_volume_to_existing
+    PURGE_WORKERS = 8
+    COPY_WORKERS = 8
+
+    # Worker threads used by list_volumes_with_usage, get_used_bytes_many
+    # and set_max_bytes_many
+    LIST_WORKERS = 16
+
+    # Worker threads used by create_volumes
+    CREATE_WORKERS = 16
+
+    # Directory layouts remembered by _get_ancestor_xattr
+    LAYOUT_CACHE_SIZE = 4096
+
+    def __init__(self, auth_id, conf_path, cluster_name, volume_prefix=None, pool_ns_prefix=None,
+                 meta_layout=None):
+        """
+        :param meta_layout: META_LAYOUT_FLAT to keep the auth and volume meta
+                            files directly in the volume prefix, or
+                            META_LAYOUT_SHARDED to spread them over hashed
+                            subdirectories.  By default, use the sharded
+                            layout if some client has already set it up,
+                            else the flat one.  Clients lock the meta
+                            files themselves, so every client of a volume
+                            prefix must use the same layout: connect()
+                            refuses the flat layout once the sharded one is
+                            set up, and the flat layout's clients must all
+                            have disconnected before it is.
+        """
+        if meta_layout not in (None, META_LAYOUT_FLAT, META_LAYOUT_SHARDED):
+            raise ValueError("Unknown metadata layout '{0}'".format(meta_layout))
+
+        self.fs = None
+        self.rados = None
+        self.connected = False
+        self.conf_path = conf_path
+        self.cluster_name = cluster_name
+        self.auth_id = auth_id
+        self.volume_prefix = volume_prefix if volume_prefix else self.DEFAULT_VOL_PREFIX
+        self.pool_ns_prefix = pool_ns_prefix if pool_ns_prefix else self.DEFAULT_NS_PREFIX
+        # For flock'ing in cephfs, I want a unique ID to distinguish me
+        # from any other manila-share services that are loading this module.
+        # We could use pid, but that's unnecessary weak: generate a
+        # UUID
+        self._id = struct.unpack(">Q", uuid.uuid1().bytes[0:8])[0]
+
+        # Background TrashPurger, see start_purger()
+        self._purger = None
+
+        # Background SnapshotScheduler, see start_snapshot_scheduler()
+        self._snapshot_scheduler = None
+
+        # Decoded metadata files, only ever consulted under the file's lock
+        self._metadata_cache = MetadataCache()
+
+        # Pool name -> [IoCtx, users], see _ioctx()
+        self._ioctxs = {}
+        self._ioctxs_lock = threading.Lock()
+
+        # OSD/MDS maps, see ClusterMapCache
+        self._cluster_maps = ClusterMapCache(self)
+
+        # (path, xattr) -> resolved value, see _get_ancestor_xattr
+        self._layout_cache = OrderedDict()
+        self._layout_cache_lock = threading.Lock()
+
+        # Thread running a deferred recover(), see connect()
+        self._recover_thread = None
+
+        # CephFS flocks are owned by self._id, which all our threads share,
+        # so threads exclude each other (and re-enter) through LockTable.
+        self._lock_table = LockTable(self._cephfs_lock, self._cephfs_unlock,
+                                     self._cephfs_lock_check)
+
+        # Metadata writes held back by _metadata_batch, per thread
+        self._metadata_pending = threading.local()
+
+        # Resolved on first use if not given, see _get_meta_layout
+        self._meta_layout = meta_layout
+
+        # TODO: version the on-disk structures
+
+    def recover(self):
+        # Scan all auth keys to see if they're dirty: if they are, they have
+        # state that might not have propagated to Ceph or to the related
+        # volumes yet.
+
+        # Important: we *always* acquire locks in the order auth->volume
+        # That means a volume can never be dirty without the auth key
+        # we're updating it with being dirty at the same time.
+
+        # First list the auth IDs that have potentially dirty on-disk metadata
+        log.debug("Recovering from partial auth updates (if any)...")
+
+        # authorize/deauthorize add an auth ID to the dirty index before
+        # marking its metadata dirty, and take it out again once clean, so
+        # only those need looking at.  Fall back to listing every auth meta
+        # file if the index isn't complete yet.
+        auth_ids = None
+        if self._dirty_index_ready():
+            auth_ids = self._dirty_index_get()
+        full_scan = auth_ids is None
+        if full_scan:
+            # Create the index before listing, so that auth IDs dirtied from
+            # here on get a marker, but only mark it complete once every
+            # listed auth ID has been recovered: a crash before that leaves
+            # the unrecovered ones without a marker.
+            self._mkdir_p(self._dirty_index_path())
+            auth_ids = self._list_auth_ids()
+
+        if not auth_ids:
+            log.debug("Nothing to recover. No dirty auth meta files.")
+            if full_scan:
+                self._dirty_index_set_ready()
+            return
+
+        # Key points based on ordering:
+        # * Anything added in VMeta is already added in AMeta
+        # * Anything added in Ceph is already added in VMeta
+        # * Anything removed in VMeta is already removed in Ceph
+        # * Anything removed in AMeta is already removed in VMeta
+
+        # Deauthorization: because I only update metadata AFTER the
+        # update of the next level down, I have the same ordering of
+        # -> things which exist in the AMeta should also exist
+        #    in the VMeta, should also exist in Ceph, and the same
+        #    recovery procedure that gets me consistent after crashes
+        #    during authorization will also work during deauthorization
+
+        # Now for each auth ID, check for dirty flag and apply updates
+        # if dirty flag is found.  Auth IDs are independent of each other,
+        # so recover them in parallel.
+        def recover_auth_id(auth_id):
+            with self._auth_lock(auth_id), self._metadata_batch():
+                auth_meta = self._auth_metadata_get(auth_id)
+                if not auth_meta or not auth_meta['volumes']:
+                    # Clean up auth meta file
+                    try:
+                        self._metadata_unlink(self._auth_metadata_path(auth_id))
+                    except cephfs.ObjectNotFound:
+                        pass
+                elif auth_meta['dirty']:
+                    self._recover_auth_meta(auth_id, auth_meta)
+                # Still under the lock: once it's released, an authorize
+                # could mark the ID dirty again, and its marker must stay.
+                self._dirty_index_remove([auth_id])
+
+        with WorkerPool(min(self.RECOVER_WORKERS, len(auth_ids)),
+                        name="recover") as pool:
+            for auth_id in auth_ids:
+                pool.submit(recover_auth_id, auth_id)
+            pool.wait()
+
+        if full_scan:
+            self._dirty_index_set_ready()
+
+        log.debug("Recovered from partial auth updates (if any).")
+
+    def _list_auth_ids(self):
+        auth_ids = set()
+        # Identify auth IDs from auth meta filenames. The auth meta files
+        # are named as, "$<auth_id><meta filename extension>"
+        regex = re.compile("^\\$(.*){0}$".format(re.escape(META_FILE_EXT)))
+        for path in self._list_metadata_files():
+            match = regex.search(os.path.basename(path))
+            if match:
+                auth_ids.add(match.group(1))
+
+        return list(auth_ids)
+
+    def _recover_in_background(self):
+        try:
+            self.recover()
+        except Exception as e:
+            log.error("Deferred recovery failed: {0}".format(e))
+
+    def wait_for_recovery(self, timeout=None):
+        """
+        Wait for a recovery deferred by connect(defer_recover=True).
+
+        :return: True if recovery is no longer running
+        """
+        if self._recover_thread is None:
+            return True
+        self._recover_thread.join(timeout)
+        return not self._recover_thread.is_alive()
+
+    def _dirty_index_path(self, auth_id=None):
+        path = os.path.join(self.volume_prefix, DIRTY_INDEX_DIR)
+        if auth_id is None:
+            return path
+        return os.path.join(path, auth_id)
+
+    def _dirty_index_ready(self):
+        try:
+            self.fs.stat(os.path.join(self.volume_prefix, DIRTY_INDEX_READY))
+        except cephfs.ObjectNotFound:
+            return False
+        return True
+
+    def _dirty_index_set_ready(self):
+        fd = self.fs.open(os.path.join(self.volume_prefix, DIRTY_INDEX_READY),
+                          os.O_CREAT | os.O_WRONLY, 0o755)
+        self.fs.close(fd)
+
+    def _dirty_index_get(self):
+        """
+        Return the auth IDs in the dirty index, or None if the index hasn't
+        been created yet.
+        """
+        try:
+            dir_handle = self.fs.opendir(self._dirty_index_path())
+        except cephfs.ObjectNotFound:
+            return None
+
+        auth_ids = []
+        try:
+            d = self.fs.readdir(dir_handle)
+            while d:
+                if d.d_name not in [".", ".."]:
+                    auth_ids.append(d.d_name)
+                d = self.fs.readdir(dir_handle)
+        finally:
+            self.fs.closedir(dir_handle)
+        return auth_ids
+
+    def _dirty_index_add(self, auth_id):
+        """
+        Call me with the auth ID locked, before its metadata gets dirty.
+        """
+        path = self._dirty_index_path(auth_id)
+        try:
+            fd = self.fs.open(path, os.O_CREAT | os.O_WRONLY, 0o755)
+        except cephfs.ObjectNotFound:
+            self._mkdir_p(self._dirty_index_path())
+            fd = self.fs.open(path, os.O_CREAT | os.O_WRONLY, 0o755)
+        self.fs.close(fd)
+
+    def _dirty_index_remove(self, auth_ids):
+        """
+        Call me once the auth IDs' metadata is clean (or gone).
+        """
+        self._metadata_flush()
+        for auth_id in auth_ids:
+            try:
+                self.fs.unlink(self._dirty_index_path(auth_id))
+            except cephfs.ObjectNotFound:
+                pass
+
+    def _recover_auth_meta(self, auth_id, auth_meta):
+        """
+        Call me after locking the auth meta file.
+        """
+        remove_volumes = []
+
+        for volume, volume_data in auth_meta['volumes'].items():
+            if not volume_data['dirty']:
+                continue
+
+            (group_id, volume_id) = volume.split('/')
+            group_id = group_id if group_id is not 'None' else None
+            volume_path = VolumePath(group_id, volume_id)
+            access_level = volume_data['access_level']
+
+            with self._volume_lock(volume_path):
+                vol_meta = self._volume_metadata_get(volume_path)
+
+                # No VMeta update indicates that there was no auth update
+                # in Ceph either. So it's safe to remove corresponding
+                # partial update in AMeta.
                 if not vol_meta or auth_id not in vol_meta['auths']:
                     remove_volumes.append(volume)
                     continue
@@ -363,7 +2046,7 @@ class CephFSVolumeClient(object):
 
         if not auth_meta['volumes']:
             # Clean up auth meta file
-            self.fs.unlink(self._auth_metadata_path(auth_id))
+            self._metadata_unlink(self._auth_metadata_path(auth_id))
             return
 
         # Recovered from all partial auth updates for the auth ID.
@@ -371,23 +2054,21 @@ class CephFSVolumeClient(object):
         self._auth_metadata_set(auth_id, auth_meta)
 
 
-    def evict(self, auth_id, timeout=30, volume_path=None):
-        """
-        Evict all clients based on the authorization ID and optionally based on
-        the volume path mounted.  Assumes that the authorization key has been
-        revoked prior to calling this function.
-
-        This operation can throw an exception if the mon cluster is unresponsive, or
-        any individual MDS daemon is unresponsive for longer than the timeout passed in.
-        """
-
+    def _client_spec(self, auth_id, volume_path=None):
         client_spec = ["auth_name={0}".format(auth_id), ]
         if volume_path:
             client_spec.append("client_metadata.root={0}".
                                format(self._get_path(volume_path)))
+        return client_spec
 
-        log.info("evict clients with {0}".format(', '.join(client_spec)))
+    def _evict_client_specs(self, client_specs, timeout):
+        """
+        Evict the clients matching each of client_specs from every MDS
+        rank, with one thread per rank sending all of the filters.
 
+        :return: list with, for each client spec, a list of the threads
+                 (RankEvicter) that failed to evict it
+        """
         mds_map = self._rados_command("mds dump", {})
 
         up = {}
@@ -399,9 +2080,10 @@ class CephFSVolumeClient(object):
         # For all MDS ranks held by a daemon
         # Do the parallelism in python instead of using "tell mds.*", because
         # the latter doesn't give us per-mds output
+        mds_map_watcher = MDSMapWatcher(self, mds_map)
         threads = []
         for rank, gid in up.items():
-            thread = RankEvicter(self, client_spec, rank, gid, mds_map,
+            thread = RankEvicter(self, client_specs, rank, gid, mds_map_watcher,
                                  timeout)
             thread.start()
             threads.append(thread)
@@ -411,13 +2093,69 @@ class CephFSVolumeClient(object):
 
         log.info("evict: joined all")
 
-        for t in threads:
-            if not t.success:
+        return [[t for t in threads if t.errors[i] is not None]
+                for i in range(len(client_specs))]
+
+    def evict(self, auth_id, timeout=30, volume_path=None):
+        """
+        Evict all clients based on the authorization ID and optionally based on
+        the volume path mounted.  Assumes that the authorization key has been
+        revoked prior to calling this function.
+
+        This operation can throw an exception if the mon cluster is unresponsive, or
+        any individual MDS daemon is unresponsive for longer than the timeout passed in.
+        """
+
+        client_spec = self._client_spec(auth_id, volume_path)
+
+        log.info("evict clients with {0}".format(', '.join(client_spec)))
+
+        failed = self._evict_client_specs([client_spec], timeout)[0]
+        for t in failed:
+            msg = ("Failed to evict client with {0} from mds {1}/{2}: {3}".
+                   format(', '.join(client_spec), t.rank, t.gid, t.errors[0])
+                  )
+            log.error(msg)
+            raise EvictionError(msg)
+
+    def evict_many(self, auth_ids, volume_paths=None, timeout=30):
+        """
+        Evict the clients of many authorization IDs in one pass: the MDS map
+        is fetched once, and a single thread per MDS rank sends it all the
+        evictions.  Assumes that the authorization keys have been revoked
+        prior to calling this function.
+
+        :param auth_ids: list of auth IDs
+        :param volume_paths: optional list, the same length as auth_ids, of
+                             VolumePaths (or None) to restrict each eviction to
+                             clients that mounted that volume
+        :return: dict mapping each auth ID to None on success, or to an
+                 EvictionError
+        """
+        if volume_paths is None:
+            volume_paths = [None] * len(auth_ids)
+        if len(volume_paths) != len(auth_ids):
+            raise ValueError("auth_ids and volume_paths differ in length")
+
+        client_specs = [self._client_spec(auth_id, volume_path)
+                        for auth_id, volume_path in zip(auth_ids, volume_paths)]
+        log.info("evict clients of {0} auth IDs".format(len(client_specs)))
+
+        results = dict((auth_id, None) for auth_id in auth_ids)
+        if not client_specs:
+            return results
+
+        failures = self._evict_client_specs(client_specs, timeout)
+        for i, (auth_id, failed) in enumerate(zip(auth_ids, failures)):
+            for t in failed:
                 msg = ("Failed to evict client with {0} from mds {1}/{2}: {3}".
-                       format(', '.join(client_spec), t.rank, t.gid, t.exception)
+                       format(', '.join(client_specs[i]), t.rank, t.gid, t.errors[i])
                       )
                 log.error(msg)
-                raise EvictionError(msg)
+                if results[auth_id] is None:
+                    results[auth_id] = EvictionError(msg)
+
+        return results
 
     def _get_path(self, volume_path):
         """
@@ -438,13 +2176,17 @@ class CephFSVolumeClient(object):
             group_id
         )
 
-    def connect(self, premount_evict = None):
+    def connect(self, premount_evict = None, defer_recover=False):
         """
 
         :param premount_evict: Optional auth_id to evict before mounting the filesystem: callers
                                may want to use this to specify their own auth ID if they expect
                                to be a unique instance and don't want to wait for caps to time
                                out after failure of another instance of themselves.
+        :param defer_recover: If true, recover from partial auth updates in a background
+                              thread instead of before returning.  authorize and deauthorize
+                              recover any dirty auth ID they touch themselves, so this is
+                              safe; see wait_for_recovery.
         """
         log.debug("Connecting to RADOS with config {0}...".format(self.conf_path))
         self.rados = rados.Rados(
@@ -469,9 +2211,17 @@ class CephFSVolumeClient(object):
         self.fs.mount()
         log.debug("Connection to cephfs complete")
 
+        self._check_meta_layout()
+
         # Recover from partial auth updates due to a previous
         # crash.
-        self.recover()
+        if defer_recover:
+            self._recover_thread = threading.Thread(
+                target=self._recover_in_background, name="recover")
+            self._recover_thread.daemon = True
+            self._recover_thread.start()
+        else:
+            self.recover()
 
     def get_mon_addrs(self):
         log.info("get_mon_addrs")
@@ -485,6 +2235,10 @@ class CephFSVolumeClient(object):
 
     def disconnect(self):
         log.info("disconnect")
+        self.stop_purger()
+        self.stop_snapshot_scheduler()
+        self.wait_for_recovery()
+
         if self.fs:
             log.debug("Disconnecting cephfs...")
             self.fs.shutdown()
@@ -492,6 +2246,7 @@ class CephFSVolumeClient(object):
             log.debug("Disconnecting cephfs complete")
 
         if self.rados:
+            self._close_ioctxs()
             log.debug("Disconnecting rados...")
             self.rados.shutdown()
             self.rados = None
@@ -500,14 +2255,8 @@ class CephFSVolumeClient(object):
     def __del__(self):
         self.disconnect()
 
-    def _get_pool_id(self, osd_map, pool_name):
-        # Maybe borrow the OSDMap wrapper class from calamari if more helpers
-        # like this are needed.
-        for pool in osd_map['pools']:
-            if pool['pool_name'] == pool_name:
-                return pool['pool']
-
-        return None
+    def _get_pool_id(self, pool_name):
+        return self._cluster_maps.pool_id(pool_name)
 
     def _create_volume_pool(self, pool_name):
         """
@@ -515,13 +2264,12 @@ class CephFSVolumeClient(object):
 
         :return The ID of the created pool
         """
-        osd_map = self._rados_command('osd dump', {})
-
-        existing_id = self._get_pool_id(osd_map, pool_name)
+        existing_id = self._get_pool_id(pool_name)
         if existing_id is not None:
             log.info("Pool {0} already exists".format(pool_name))
             return existing_id
 
+        osd_map = self._cluster_maps.osd_map()
         osd_count = len(osd_map['osds'])
 
         # We can't query the actual cluster config remotely, but since this is
@@ -550,14 +2298,14 @@ class CephFSVolumeClient(object):
             }
         )
 
-        osd_map = self._rados_command('osd dump', {})
-        pool_id = self._get_pool_id(osd_map, pool_name)
+        self._cluster_maps.invalidate('osd')
+        pool_id = self._get_pool_id(pool_name)
 
         if pool_id is None:
             # If the pool isn't there, that's either a ceph bug, or it's some outside influence
             # removing it right after we created it.
             log.error("OSD map doesn't contain expected pool '{0}':\n{1}".format(
-                pool_name, json.dumps(osd_map, indent=2)
+                pool_name, json.dumps(self._cluster_maps.osd_map(), indent=2)
             ))
             raise RuntimeError("Pool '{0}' not present in map after creation".format(pool_name))
         else:
@@ -615,6 +2363,12 @@ class CephFSVolumeClient(object):
 
         self._mkdir_p(path)
 
+        return self._setup_volume(volume_path, path, size, data_isolated)
+
+    def _setup_volume(self, volume_path, path, size, data_isolated):
+        """
+        Everything create_volume does once the volume's directory exists.
+        """
         if size is not None:
             self.fs.setxattr(path, 'ceph.quota.max_bytes', size.__str__(), 0)
 
@@ -623,28 +2377,97 @@ class CephFSVolumeClient(object):
             pool_name = "{0}{1}".format(self.POOL_PREFIX, volume_path.volume_id)
             log.info("create_volume: {0}, create pool {1} as data_isolated =True.".format(volume_path, pool_name))
             pool_id = self._create_volume_pool(pool_name)
-            mds_map = self._rados_command("mds dump", {})
+            mds_map = self._cluster_maps.mds_map()
             if pool_id not in mds_map['data_pools']:
                 self._rados_command("mds add_data_pool", {
                     'pool': pool_name
                 })
+                self._cluster_maps.invalidate('mds')
             self.fs.setxattr(path, 'ceph.dir.layout.pool', pool_name, 0)
+            self._invalidate_layouts(path)
 
         # enforce security isolation, use seperate namespace for this volume
         namespace = "{0}{1}".format(self.pool_ns_prefix, volume_path.volume_id)
         log.info("create_volume: {0}, using rados namespace {1} to isolate data.".format(volume_path, namespace))
         self.fs.setxattr(path, 'ceph.dir.layout.pool_namespace', namespace, 0)
+        self._invalidate_layouts(path)
 
         # Create a volume meta file, if it does not already exist, to store
         # data about auth ids having access to the volume
-        fd = self.fs.open(self._volume_metadata_path(volume_path),
-                          os.O_CREAT, 0o755)
+        fd = self._open_metadata(self._volume_metadata_path(volume_path),
+                                 os.O_CREAT)
         self.fs.close(fd)
 
         return {
             'mount_path': path
         }
 
+    def create_volumes(self, specs, workers=None):
+        """
+        create_volume for many volumes.  Each group directory is created
+        once, then the volumes are created (and their quotas and layouts
+        set) up to `workers` (CREATE_WORKERS by default) at once.
+
+        A volume that fails part way is rolled back: if its directory was
+        created by this call, it is removed again along with the volume's
+        meta file.  Pools created for data_isolated volumes are left in
+        place; creating the volume again will reuse them.
+
+        :param specs: list of dicts with a 'volume_path' key, and optionally
+                      'size' and 'data_isolated' keys as for create_volume
+        :return: dict mapping each VolumePath to what create_volume would
+                 return, or to the exception that creating it raised
+        """
+        results = {}
+        if not specs:
+            return results
+
+        for parent in set(os.path.dirname(self._get_path(spec['volume_path']))
+                          for spec in specs):
+            self._mkdir_p(parent)
+
+        def create(spec):
+            volume_path = spec['volume_path']
+            path = self._get_path(volume_path)
+            log.info("create_volume: {0}".format(path))
+
+            try:
+                self.fs.mkdir(path, 0o755)
+            except cephfs.ObjectExists:
+                created = False
+            else:
+                created = True
+
+            try:
+                return self._setup_volume(volume_path, path, spec.get('size'),
+                                          spec.get('data_isolated', False))
+            except Exception:
+                if created:
+                    self._rollback_volume(volume_path, path)
+                raise
+
+        with WorkerPool(min(workers if workers else self.CREATE_WORKERS,
+                            len(specs)), name="create") as pool:
+            for spec, result, error in pool.map_unordered(create, specs):
+                if error is not None:
+                    log.error("create_volume: {0} failed: {1}".format(
+                        spec['volume_path'], error))
+                    results[spec['volume_path']] = error
+                else:
+                    results[spec['volume_path']] = result
+        return results
+
+    def _rollback_volume(self, volume_path, path):
+        try:
+            self._metadata_unlink(self._volume_metadata_path(volume_path))
+        except cephfs.ObjectNotFound:
+            pass
+        try:
+            self.fs.rmdir(path)
+        except cephfs.Error as e:
+            log.warning("create_volume: couldn't roll back {0}: {1}".format(
+                path, e))
+
     def delete_volume(self, volume_path, data_isolated=False):
         """
         Make a volume inaccessible to guests.  This function is
@@ -659,12 +2482,26 @@ class CephFSVolumeClient(object):
         log.info("delete_volume: {0}".format(path))
 
         # Create the trash folder if it doesn't already exist
-        trash = os.path.join(self.volume_prefix, "_deleting")
+        trash = self._get_trash_path()
         self._mkdir_p(trash)
 
         # We'll move it to here
         trashed_volume = os.path.join(trash, volume_path.volume_id)
 
+        # Remember whether the volume had its own pool, for the benefit of
+        # a background purge that only has the trash to go on.  This must
+        # be in place before the volume shows up in the trash, or a purge
+        # could start without it and lose it.
+        if data_isolated:
+            checkpoint_path = self._purge_checkpoint_path(volume_path.volume_id)
+            try:
+                checkpoint = self._metadata_get(checkpoint_path) or {}
+            except cephfs.ObjectNotFound:
+                checkpoint = {}
+            if not checkpoint.get('data_isolated'):
+                checkpoint['data_isolated'] = True
+                self._metadata_set(checkpoint_path, checkpoint)
+
         # Move the volume's data to the trash folder
         try:
             self.fs.stat(path)
@@ -673,148 +2510,636 @@ class CephFSVolumeClient(object):
                 path))
         else:
             self.fs.rename(path, trashed_volume)
+            self._invalidate_layouts(path)
 
         # Delete the volume meta file, if it's not already deleted
         vol_meta_path = self._volume_metadata_path(volume_path)
         try:
-            self.fs.unlink(vol_meta_path)
+            self._metadata_unlink(vol_meta_path)
+        except cephfs.ObjectNotFound:
+            pass
+
+        if self._purger is not None:
+            self._purger.wake()
+
+    def _get_trash_path(self):
+        return os.path.join(self.volume_prefix, TRASH_DIR_NAME)
+
+    def _purge_checkpoint_path(self, volume_id):
+        # Volumes in the trash are directories, so a meta file alongside
+        # one can't collide with another trashed volume.
+        return os.path.join(self._get_trash_path(), "{0}{1}".format(
+            volume_id, META_FILE_EXT))
+
+    def purge_volume(self, volume_path, data_isolated=False, workers=None):
+        """
+        Finish clearing up a volume that was previously passed to delete_volume.  This
+        function is idempotent.
+
+        The trashed tree is removed by a PurgeJob with `workers` threads
+        (PURGE_WORKERS by default), which checkpoints its progress under
+        the trash folder so an interrupted purge can be resumed.  When a
+        TrashPurger is running (see start_purger) there is no need to call
+        this at all.
+
+        :return: dict of 'entries', 'elapsed' and 'entries_per_sec', or None
+                 if the volume had already been purged
+        """
+        return self._purge_trashed(volume_path.volume_id, data_isolated, workers)
+
+    def _purge_trashed(self, volume_id, data_isolated=False, workers=None,
+                       rate_limiter=None, stop_event=None):
+        trashed_volume = os.path.join(self._get_trash_path(), volume_id)
+        checkpoint_path = self._purge_checkpoint_path(volume_id)
+
+        try:
+            self.fs.stat(trashed_volume)
+        except cephfs.ObjectNotFound:
+            log.warning("Trying to purge volume '{0}' but it's already been purged".format(
+                trashed_volume))
+            # A surviving checkpoint means the pool deletion that follows
+            # the purge didn't get done
+            try:
+                checkpoint = self._metadata_get(checkpoint_path) or {}
+            except cephfs.ObjectNotFound:
+                checkpoint = {}
+            if data_isolated or checkpoint.get('data_isolated'):
+                self._delete_volume_pool(volume_id)
+            try:
+                self.fs.unlink(checkpoint_path)
+            except cephfs.ObjectNotFound:
+                pass
+            return None
+
+        job = PurgeJob(self, trashed_volume, checkpoint_path,
+                       workers if workers else self.PURGE_WORKERS, rate_limiter,
+                       stop_event)
+        stats = job.run()
+
+        if data_isolated or job.checkpoint.get('data_isolated'):
+            self._delete_volume_pool(volume_id)
+
+        # Only now: for a background purge, the checkpoint is the only
+        # record of whether the volume had a pool of its own.
+        try:
+            self.fs.unlink(checkpoint_path)
         except cephfs.ObjectNotFound:
             pass
 
-    def purge_volume(self, volume_path, data_isolated=False):
+        return stats
+
+    def _delete_volume_pool(self, volume_id):
+        """
+        Delete a data isolated volume's pool, if it still exists.
+        """
+        pool_name = "{0}{1}".format(self.POOL_PREFIX, volume_id)
+        pool_id = self._get_pool_id(pool_name)
+        if pool_id is None:
+            log.info("Pool {0} already deleted".format(pool_name))
+            return
+        mds_map = self._cluster_maps.mds_map()
+        if pool_id in mds_map['data_pools']:
+            self._rados_command("mds remove_data_pool", {
+                'pool': pool_name
+            })
+            self._cluster_maps.invalidate('mds')
+        self._close_ioctxs(pool_name)
+        self._rados_command("osd pool delete",
+                            {
+                                "pool": pool_name,
+                                "pool2": pool_name,
+                                "sure": "--yes-i-really-really-mean-it"
+                            })
+        self._cluster_maps.invalidate('osd')
+
+    def start_purger(self, workers=2, purge_workers=4, ops_per_sec=None,
+                     scan_interval=60):
+        """
+        Start purging trashed volumes in the background (see TrashPurger),
+        so that delete_volume callers don't have to call purge_volume.
+        Idempotent; the purger is stopped by stop_purger or disconnect.
+        """
+        if self._purger is not None:
+            return
+        self._purger = TrashPurger(self, workers, purge_workers, ops_per_sec,
+                                   scan_interval)
+        self._purger.start()
+
+    def stop_purger(self):
+        """
+        Stop the background purger.  Purges in progress are checkpointed
+        and interrupted; volumes still in the trash are picked up by the
+        next start_purger, here or in another instance.
+        """
+        if self._purger is None:
+            return
+        self._purger.stop()
+        self._purger = None
+
+    def start_snapshot_scheduler(self, volume_paths=None, group_ids=None,
+                                 hourly=24, daily=7, weekly=4, workers=4,
+                                 ops_per_sec=None, interval=3600,
+                                 prefix="scheduled"):
+        """
+        Start snapshotting volumes and groups in the background, with
+        retention (see SnapshotScheduler).  Idempotent; the scheduler is
+        stopped by stop_snapshot_scheduler or disconnect.
+        """
+        if self._snapshot_scheduler is not None:
+            return
+        self._snapshot_scheduler = SnapshotScheduler(
+            self, volume_paths, group_ids, hourly, daily, weekly, workers,
+            ops_per_sec, interval, prefix)
+        self._snapshot_scheduler.start()
+
+    def stop_snapshot_scheduler(self):
+        """
+        Stop the background snapshot scheduler, after any pass in progress.
+        """
+        if self._snapshot_scheduler is None:
+            return
+        self._snapshot_scheduler.stop()
+        self._snapshot_scheduler = None
+
+    def _get_ancestor_xattr(self, path, attr):
+        """
+        Helper for reading layout information: if this xattr is missing
+        on the requested path, keep checking parents until we find it.
+
+        The value resolved for each directory on the way is cached, so
+        volumes inheriting their layout from a common ancestor only pay
+        for the walk once.  Layout changes we make ourselves go through
+        _invalidate_layouts; changes made by anybody else aren't noticed.
+        """
+        key = (path, attr)
+        with self._layout_cache_lock:
+            if key in self._layout_cache:
+                result = self._layout_cache.pop(key)
+                self._layout_cache[key] = result
+                return result
+
+        try:
+            result = self.fs.getxattr(path, attr)
+            if result == "":
+                # Annoying!  cephfs gives us empty instead of an error when attr not found
+                raise cephfs.NoData()
+        except cephfs.NoData:
+            if path == "/":
+                raise
+            else:
+                result = self._get_ancestor_xattr(os.path.split(path)[0], attr)
+
+        with self._layout_cache_lock:
+            self._layout_cache[key] = result
+            while len(self._layout_cache) > self.LAYOUT_CACHE_SIZE:
+                self._layout_cache.popitem(last=False)
+        return result
+
+    def _invalidate_layouts(self, path):
+        """
+        Forget the cached layouts of a directory and everything under it,
+        after changing its layout (or moving it).
+        """
+        prefix = path.rstrip("/") + "/"
+        with self._layout_cache_lock:
+            for key in [key for key in self._layout_cache
+                        if key[0] == path or key[0].startswith(prefix)]:
+                del self._layout_cache[key]
+
+    def _check_compat_version(self, compat_version):
+        if self.version < compat_version:
+            msg = ("The current version of CephFSVolumeClient, version {0} "
+                   "does not support the required feature. Need version {1} "
+                   "or greater".format(self.version, compat_version)
+                  )
+            log.error(msg)
+            raise CephFSVolumeClientError(msg)
+
+    def _metadata_get(self, path):
+        """
+        Return a deserialized JSON object, or None
+
+        Served from the metadata cache when the file's version (see
+        MetadataCache) shows it hasn't changed since we last read or wrote
+        it, or from our pending write if the file has one in a metadata
+        batch.
+        """
+        pending = self._metadata_pending_writes()
+        if pending and path in pending:
+            return copy.deepcopy(pending[path][1])
+
+        # Taken before the read, the change attribute can only be older
+        # than what we read, which costs a miss next time at worst.
+        statbuf = self._metadata_version(path)
+        if statbuf is not None:
+            hit, data = self._metadata_cache.get(path, statbuf)
+            if hit:
+                return data
+
+        fd = self.fs.open(path, "r")
+        try:
+            fstatbuf = self.fs.fstat(fd)
+            if statbuf is None:
+                statbuf = fstatbuf
+                hit, data = self._metadata_cache.get(path, statbuf)
+                if hit:
+                    return data
+
+            # Read exactly as much as there is, in chunks, rather than
+            # allocating a worst-case buffer for every (usually tiny) file.
+            size = fstatbuf.st_size
+            chunks = []
+            offset = 0
+            while offset < size:
+                chunk = self.fs.read(fd, offset,
+                                     min(self.METADATA_CHUNK_SIZE, size - offset))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+        finally:
+            self.fs.close(fd)
+
+        if chunks:
+            # json can't decode piecemeal, but joining the chunks costs a
+            # single copy of the file.
+            data = json.loads(b"".join(chunks))
+        else:
+            data = None
+        self._metadata_cache.put(path, statbuf, data)
+        return data
+
+    def _metadata_set(self, path, data):
+        serialized = json.dumps(data)
+        if not isinstance(serialized, bytes):
+            serialized = serialized.encode("utf-8")
+
+        pending = self._metadata_pending_writes()
+        if pending is not None:
+            # Superseded by this write, which goes to the back of the queue
+            pending.pop(path, None)
+            pending[path] = (serialized, copy.deepcopy(data))
+            return
+
+        self._metadata_write(path, serialized, data)
+
+    def _metadata_write(self, path, serialized, data):
+        fd = self._open_metadata(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            offset = 0
+            while offset < len(serialized):
+                written = self.fs.write(
+                    fd, serialized[offset:offset + self.METADATA_CHUNK_SIZE], offset)
+                if written <= 0:
+                    raise CephFSVolumeClientError(
+                        "Short write to metadata file {0}".format(path))
+                offset += written
+            self.fs.fsync(fd, 0)
+            statbuf = self._metadata_version(path)
+            if statbuf is None:
+                statbuf = self.fs.fstat(fd)
+            self._metadata_cache.put(path, statbuf, data)
+        finally:
+            self.fs.close(fd)
+
+    def _metadata_version(self, path):
+        """
+        A MetadataVersion for a meta file, or None if the bindings can't
+        statx.
+        """
+        statx = getattr(self.fs, "statx", None)
+        if statx is None:
+            return None
+        result = statx(path, cephfs.CEPH_STATX_INO | cephfs.CEPH_STATX_VERSION, 0)
+        if 'version' not in result:
+            return None
+        return MetadataVersion(result['ino'], result['version'])
+
+    def _metadata_pending_writes(self):
+        """
+        The calling thread's pending metadata writes (an OrderedDict of path
+        to serialized and decoded data, in the order they must hit the
+        disk), or None outside a metadata batch.
+        """
+        return getattr(self._metadata_pending, 'writes', None)
+
+    @contextmanager
+    def _metadata_batch(self):
+        """
+        Hold back this thread's metadata writes, so that a file written
+        several times in a row is written and fsynced once, with its last
+        contents.
+
+        Writes only ever hit the disk in the order they were made, and
+        everything pending is flushed before anything else can observe
+        it: before a mutating Ceph command, before a metadata file is
+        unlinked or an auth ID leaves the dirty index, when a metadata lock
+        is released to another thread or client, and when the batch ends.
+        So recover() sees the same sequence of states as it would without
+        the batch, less the intermediate ones nobody could have acted on.
+
+        Batches nest; the outermost one flushes.
+        """
+        if self._metadata_pending_writes() is not None:
+            yield
+            return
+
+        self._metadata_pending.writes = OrderedDict()
+        try:
+            yield
+        finally:
+            try:
+                self._metadata_flush()
+            finally:
+                self._metadata_pending.writes = None
+
+    def _metadata_flush(self, upto=None):
+        """
+        Write out this thread's pending metadata writes, or only those up
+        to and including the one for path `upto` if it has one.
+        """
+        pending = self._metadata_pending_writes()
+        if not pending or (upto is not None and upto not in pending):
+            return
+
+        while pending:
+            path, (serialized, data) = pending.popitem(last=False)
+            self._metadata_write(path, serialized, data)
+            if path == upto:
+                break
+
+    def _metadata_unlink(self, path):
+        self._metadata_flush()
+        flat_path = self._flat_metadata_path(path)
+        if path != flat_path:
+            # Don't let a flat layout file that was never migrated show
+            # through
+            try:
+                self.fs.unlink(flat_path)
+            except cephfs.ObjectNotFound:
+                pass
+        self.fs.unlink(path)
+
+    @contextmanager
+    def _lock(self, path):
+        with self._lock_table.hold(path):
+            try:
+                yield
+            finally:
+                if self._lock_table.depth(path) == 1:
+                    # About to let go of the file: write out what others
+                    # are entitled to see.
+                    self._metadata_flush(path)
+
+    def _cephfs_lock(self, path):
+        """
+        Take the CephFS lock on a metadata file, returning its fd.  Only
+        the lock table should call this.
+        """
+        while(1):
+            fd = self._open_metadata(path, os.O_CREAT)
+            self.fs.flock(fd, fcntl.LOCK_EX, self._id)
+
+            # The locked file will be cleaned up sometime. It could be
+            # unlinked e.g., by an another manila share instance, before
+            # lock was applied on it. Perform checks to ensure that this
+            # does not happen.
+            if self._cephfs_lock_check(path, fd):
+                return fd
+
+            # Unlinked or replaced by a new file: let go of the old one and
+            # retry
+            self._cephfs_unlock(path, fd)
+
+    def _cephfs_lock_check(self, path, fd):
+        """
+        Whether the locked fd is still the file at path.
+        """
+        try:
+            statbuf = self.fs.stat(path)
+        except cephfs.ObjectNotFound:
+            return False
+        return statbuf.st_ino == self.fs.fstat(fd).st_ino
+
+    def _cephfs_unlock(self, path, fd):
+        try:
+            self.fs.flock(fd, fcntl.LOCK_UN, self._id)
+        finally:
+            self.fs.close(fd)
+
+    def lock_stats(self):
         """
-        Finish clearing up a volume that was previously passed to delete_volume.  This
-        function is idempotent.
+        Counters from the in-process metadata lock table: acquisitions,
+        re-entries, acquisitions that waited for another local thread
+        (and the total time spent waiting), CephFS lock handoffs between
+        local threads, CephFS lock round trips, and the number of paths
+        currently held and threads waiting.
         """
+        return self._lock_table.stats()
 
-        trash = os.path.join(self.volume_prefix, "_deleting")
-        trashed_volume = os.path.join(trash, volume_path.volume_id)
+    @contextmanager
+    def _lock_many(self, paths):
+        """
+        Lock several metadata files at once.  The paths are locked in sorted
+        order, so that two callers locking overlapping sets can't deadlock.
+        """
+        locks = []
+        try:
+            for path in sorted(set(paths)):
+                lock = self._lock(path)
+                lock.__enter__()
+                locks.append(lock)
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.__exit__(None, None, None)
+
+    def _get_meta_layout(self):
+        if self._meta_layout is None:
+            try:
+                self.fs.stat(self._shard_root_path())
+            except cephfs.ObjectNotFound:
+                self._meta_layout = META_LAYOUT_FLAT
+            else:
+                self._meta_layout = META_LAYOUT_SHARDED
+        return self._meta_layout
 
+    def _check_meta_layout(self):
+        """
+        Settle the metadata layout, once, at connect.  A client using the
+        flat layout would lock and write files that the sharded layout's
+        clients never look at, so refuse it once the shard root exists.
+        """
         try:
-            self.fs.stat(trashed_volume)
+            self.fs.stat(self._shard_root_path())
         except cephfs.ObjectNotFound:
-            log.warning("Trying to purge volume '{0}' but it's already been purged".format(
-                trashed_volume))
-            return
+            sharded = False
+        else:
+            sharded = True
 
-        def rmtree(root_path):
-            log.debug("rmtree {0}".format(root_path))
-            dir_handle = self.fs.opendir(root_path)
-            d = self.fs.readdir(dir_handle)
-            while d:
-                if d.d_name not in [".", ".."]:
-                    # Do not use os.path.join because it is sensitive
-                    # to string encoding, we just pass through dnames
-                    # as byte arrays
-                    d_full = "{0}/{1}".format(root_path, d.d_name)
-                    if d.is_dir():
-                        rmtree(d_full)
-                    else:
-                        self.fs.unlink(d_full)
+        if self._meta_layout is None:
+            self._meta_layout = META_LAYOUT_SHARDED if sharded else META_LAYOUT_FLAT
+        elif self._meta_layout == META_LAYOUT_FLAT and sharded:
+            msg = "Metadata layout of {0} is '{1}', not '{2}'".format(
+                self.volume_prefix, META_LAYOUT_SHARDED, META_LAYOUT_FLAT)
+            log.error(msg)
+            raise CephFSVolumeClientError(msg)
+        elif not sharded:
+            # Lets clients using the default layout find out about it
+            self._mkdir_p(self._shard_root_path())
 
-                d = self.fs.readdir(dir_handle)
-            self.fs.closedir(dir_handle)
+    def _shard_root_path(self):
+        return os.path.join(self.volume_prefix, SHARD_DIR_NAME)
 
-            self.fs.rmdir(root_path)
+    def _metadata_file_path(self, filename):
+        """
+        Where the auth or volume meta file `filename` lives.  In the flat
+        layout, that's the volume prefix.  In the sharded layout, it's a
+        directory two levels down the shard root, named after the first
+        two pairs of hex digits of a hash of the file name, so that no
+        one directory grows beyond a few entries per 65536 files.
+        """
+        if self._get_meta_layout() == META_LAYOUT_FLAT:
+            return os.path.join(self.volume_prefix, filename)
 
-        rmtree(trashed_volume)
+        digest = hashlib.sha1(filename.encode("utf-8")).hexdigest()
+        return os.path.join(self._shard_root_path(), digest[0:2], digest[2:4],
+                            filename)
 
-        if data_isolated:
-            pool_name = "{0}{1}".format(self.POOL_PREFIX, volume_path.volume_id)
-            osd_map = self._rados_command("osd dump", {})
-            pool_id = self._get_pool_id(osd_map, pool_name)
-            mds_map = self._rados_command("mds dump", {})
-            if pool_id in mds_map['data_pools']:
-                self._rados_command("mds remove_data_pool", {
-                    'pool': pool_name
-                })
-            self._rados_command("osd pool delete",
-                                {
-                                    "pool": pool_name,
-                                    "pool2": pool_name,
-                                    "sure": "--yes-i-really-really-mean-it"
-                                })
+    def _flat_metadata_path(self, path):
+        """
+        The flat-layout path of a (possibly sharded) meta file path.
+        """
+        return os.path.join(self.volume_prefix, os.path.basename(path))
 
-    def _get_ancestor_xattr(self, path, attr):
+    def _open_metadata(self, path, flags, mode=0o755):
         """
-        Helper for reading layout information: if this xattr is missing
-        on the requested path, keep checking parents until we find it.
+        Open a meta file, creating its shard directory if it doesn't exist
+        yet.
         """
         try:
-            result = self.fs.getxattr(path, attr)
-            if result == "":
-                # Annoying!  cephfs gives us empty instead of an error when attr not found
-                raise cephfs.NoData()
-            else:
-                return result
-        except cephfs.NoData:
-            if path == "/":
+            return self.fs.open(path, flags, mode)
+        except cephfs.ObjectNotFound:
+            if not path.startswith(self._shard_root_path() + os.path.sep):
                 raise
-            else:
-                return self._get_ancestor_xattr(os.path.split(path)[0], attr)
+            self._mkdir_p(os.path.dirname(path))
+            return self.fs.open(path, flags, mode)
 
-    def _check_compat_version(self, compat_version):
-        if self.version < compat_version:
-            msg = ("The current version of CephFSVolumeClient, version {0} "
-                   "does not support the required feature. Need version {1} "
-                   "or greater".format(self.version, compat_version)
-                  )
-            log.error(msg)
-            raise CephFSVolumeClientError(msg)
+    def _layout_metadata_get(self, path):
+        """
+        Call me with the metadata locked!
 
-    def _metadata_get(self, path):
+        _metadata_get for an auth or volume meta file: in the sharded layout,
+        fall back to the flat layout's file for files that haven't been
+        rewritten (or migrated, see migrate_metadata_layout) since the
+        layout changed.  Taking the lock creates an empty sharded file, so
+        empty (or missing) means never written.
         """
-        Return a deserialized JSON object, or None
+        sharded = self._get_meta_layout() == META_LAYOUT_SHARDED
+        try:
+            data = self._metadata_get(path)
+        except cephfs.ObjectNotFound:
+            if not sharded:
+                raise
+            data = None
+        if data is None and sharded:
+            try:
+                data = self._metadata_get(self._flat_metadata_path(path))
+            except cephfs.ObjectNotFound:
+                pass
+        return data
+
+    def _list_metadata_files(self):
         """
-        fd = self.fs.open(path, "r")
-        # TODO iterate instead of assuming file < 4MB
-        read_bytes = self.fs.read(fd, 0, 4096 * 1024)
-        self.fs.close(fd)
-        if read_bytes:
-            return json.loads(read_bytes)
-        else:
-            return None
+        Yield the paths of all the auth and volume meta files, in either
+        layout.  Other files in the volume prefix come out too, so filter
+        by name.
+        """
+        for name in self._readdir(self.volume_prefix):
+            yield os.path.join(self.volume_prefix, name)
+
+        if self._get_meta_layout() == META_LAYOUT_SHARDED:
+            root = self._shard_root_path()
+            for level1 in self._readdir(root):
+                for level2 in self._readdir(os.path.join(root, level1)):
+                    shard = os.path.join(root, level1, level2)
+                    for name in self._readdir(shard):
+                        yield os.path.join(shard, name)
+
+    def _readdir(self, path):
+        """
+        Yield the names in a directory (no "." or ".."), or nothing if it
+        doesn't exist.
+        """
+        try:
+            dir_handle = self.fs.opendir(path)
+        except cephfs.ObjectNotFound:
+            return
 
-    def _metadata_set(self, path, data):
-        serialized = json.dumps(data)
-        fd = self.fs.open(path, "w")
         try:
-            self.fs.write(fd, serialized, 0)
-            self.fs.fsync(fd, 0)
+            d = self.fs.readdir(dir_handle)
+            while d:
+                if d.d_name not in [".", ".."]:
+                    yield d.d_name
+                d = self.fs.readdir(dir_handle)
         finally:
-            self.fs.close(fd)
+            self.fs.closedir(dir_handle)
 
-    def _lock(self, path):
-        @contextmanager
-        def fn():
-            while(1):
-                fd = self.fs.open(path, os.O_CREAT, 0o755)
-                self.fs.flock(fd, fcntl.LOCK_EX, self._id)
-
-                # The locked file will be cleaned up sometime. It could be
-                # unlinked e.g., by an another manila share instance, before
-                # lock was applied on it. Perform checks to ensure that this
-                # does not happen.
+    def migrate_metadata_layout(self, workers=None):
+        """
+        Move the auth and volume meta files left over from the flat layout
+        into the sharded layout, taking each file's lock, so it's safe to
+        run while other (sharded layout) clients carry on.  This function is
+        idempotent.
+
+        :return: the number of files moved
+        """
+        if self._get_meta_layout() != META_LAYOUT_SHARDED:
+            raise CephFSVolumeClientError(
+                "Metadata layout is '{0}', not '{1}'".format(
+                    self._meta_layout, META_LAYOUT_SHARDED))
+
+        regex = re.compile("^[$_].*{0}$".format(re.escape(META_FILE_EXT)))
+        moved = []
+
+        def migrate(filename):
+            flat_path = os.path.join(self.volume_prefix, filename)
+            path = self._metadata_file_path(filename)
+            with self._lock(path):
+                try:
+                    data = self._metadata_get(path)
+                except cephfs.ObjectNotFound:
+                    data = None
+                if data is None:
+                    try:
+                        data = self._metadata_get(flat_path)
+                    except cephfs.ObjectNotFound:
+                        return
+                    if data is not None:
+                        self._metadata_set(path, data)
+                        moved.append(filename)
+                        self._metadata_flush()
+                # Otherwise the sharded file is newer
                 try:
-                    statbuf = self.fs.stat(path)
+                    self.fs.unlink(flat_path)
                 except cephfs.ObjectNotFound:
-                    self.fs.close(fd)
+                    pass
+
+        with WorkerPool(workers if workers else self.RECOVER_WORKERS,
+                        name="migrate") as pool:
+            for filename in self._readdir(self.volume_prefix):
+                if filename in (DIRTY_INDEX_DIR, DIRTY_INDEX_READY,
+                                SHARD_DIR_NAME) or \
+                        not regex.match(filename):
                     continue
+                pool.submit(migrate, filename)
+            pool.wait()
 
-                fstatbuf = self.fs.fstat(fd)
-                if statbuf.st_ino == fstatbuf.st_ino:
-                    break
-
-            try:
-                yield
-            finally:
-                self.fs.flock(fd, fcntl.LOCK_UN, self._id)
-                self.fs.close(fd)
-
-        return fn()
+        log.info("Moved {0} meta files to the sharded layout".format(len(moved)))
+        return len(moved)
 
     def _auth_metadata_path(self, auth_id):
-        return os.path.join(self.volume_prefix, "${0}{1}".format(
+        return self._metadata_file_path("${0}{1}".format(
             auth_id, META_FILE_EXT))
 
     def _auth_lock(self, auth_id):
@@ -830,7 +3155,7 @@ class CephFSVolumeClient(object):
         Return auth metadata that the current version of CephFSVolumeClient
         can decode.
         """
-        auth_metadata = self._metadata_get(self._auth_metadata_path(auth_id))
+        auth_metadata = self._layout_metadata_get(self._auth_metadata_path(auth_id))
 
         if auth_metadata:
             self._check_compat_version(auth_metadata['compat_version'])
@@ -853,103 +3178,289 @@ class CephFSVolumeClient(object):
         return self._metadata_set(self._auth_metadata_path(auth_id), data)
 
     def _volume_metadata_path(self, volume_path):
-        return os.path.join(self.volume_prefix, "_{0}:{1}{2}".format(
+        return self._metadata_file_path("_{0}:{1}{2}".format(
             volume_path.group_id if volume_path.group_id else "",
             volume_path.volume_id,
             META_FILE_EXT
         ))
 
-    def _volume_lock(self, volume_path):
-        """
-        Return a ContextManager which locks the authorization metadata for
-        a particular volume, and persists a flag to the metadata indicating
-        that it is currently locked, so that we can detect dirty situations
-        during recovery.
+    def _volume_lock(self, volume_path):
+        """
+        Return a ContextManager which locks the authorization metadata for
+        a particular volume, and persists a flag to the metadata indicating
+        that it is currently locked, so that we can detect dirty situations
+        during recovery.
+
+        This lock isn't just to make access to the metadata safe: it's also
+        designed to be used over the two-step process of checking the
+        metadata and then responding to an authorization request, to
+        ensure that at the point we respond the metadata hasn't changed
+        in the background.  It's key to how we avoid security holes
+        resulting from races during that problem ,
+        """
+        return self._lock(self._volume_metadata_path(volume_path))
+
+    def _volume_metadata_get(self, volume_path):
+        """
+        Call me with the metadata locked!
+
+        Check whether a volume metadata structure can be decoded by the current
+        version of CephFSVolumeClient.
+
+        Return a volume_metadata structure that the current version of
+        CephFSVolumeClient can decode.
+        """
+        volume_metadata = self._layout_metadata_get(self._volume_metadata_path(volume_path))
+
+        if volume_metadata:
+            self._check_compat_version(volume_metadata['compat_version'])
+
+        return volume_metadata
+
+    def _volume_metadata_set(self, volume_path, data):
+        """
+        Call me with the metadata locked!
+
+        Add two version attributes to the volume metadata,
+        'compat_version', the minimum CephFSVolumeClient version that can
+        decode the metadata and 'version', the CephFSVolumeClient version
+        that encoded the metadata.
+        """
+        data['compat_version'] = 1
+        data['version'] = self.version
+        return self._metadata_set(self._volume_metadata_path(volume_path), data)
+
+    def authorize(self, volume_path, auth_id, readonly=False, tenant_id=None):
+        """
+        Get-or-create a Ceph auth identity for `auth_id` and grant them access
+        to
+        :param volume_path:
+        :param auth_id:
+        :param readonly:
+        :param tenant_id: Optionally provide a stringizable object to
+                          restrict any created cephx IDs to other callers
+                          passing the same tenant ID.
+        :return:
+        """
+
+        with self._auth_lock(auth_id), self._metadata_batch():
+            # Existing meta, or None, to be updated
+            auth_meta = self._auth_metadata_get(auth_id)
+
+            # volume data to be inserted
+            volume_path_str = str(volume_path)
+            volume = {
+                volume_path_str : {
+                    # The access level at which the auth_id is authorized to
+                    # access the volume.
+                    'access_level': 'r' if readonly else 'rw',
+                    'dirty': True,
+                }
+            }
+            if auth_meta is None:
+                sys.stderr.write("Creating meta for ID {0} with tenant {1}\n".format(
+                    auth_id, tenant_id
+                ))
+                log.debug("Authorize: no existing meta")
+                auth_meta = {
+                    'dirty': True,
+                    'tenant_id': tenant_id.__str__() if tenant_id else None,
+                    'volumes': volume
+                }
+
+                # Note: this is *not* guaranteeing that the key doesn't already
+                # exist in Ceph: we are allowing VolumeClient tenants to
+                # 'claim' existing Ceph keys.  In order to prevent VolumeClient
+                # tenants from reading e.g. client.admin keys, you need to
+                # have configured your VolumeClient user (e.g. Manila) to
+                # have mon auth caps that prevent it from accessing those keys
+                # (e.g. limit it to only access keys with a manila.* prefix)
+            else:
+                # Disallow tenants to share auth IDs
+                if auth_meta['tenant_id'].__str__() != tenant_id.__str__():
+                    msg = "auth ID: {0} is already in use".format(auth_id)
+                    log.error(msg)
+                    raise CephFSVolumeClientError(msg)
+
+                if auth_meta['dirty']:
+                    self._recover_auth_meta(auth_id, auth_meta)
+
+                log.debug("Authorize: existing tenant {tenant}".format(
+                    tenant=auth_meta['tenant_id']
+                ))
+                auth_meta['dirty'] = True
+                auth_meta['volumes'].update(volume)
+
+            self._dirty_index_add(auth_id)
+            self._auth_metadata_set(auth_id, auth_meta)
+
+            with self._volume_lock(volume_path):
+                key = self._authorize_volume(volume_path, auth_id, readonly)
+
+            auth_meta['dirty'] = False
+            auth_meta['volumes'][volume_path_str]['dirty'] = False
+            self._auth_metadata_set(auth_id, auth_meta)
+            self._dirty_index_remove([auth_id])
+
+            if tenant_id:
+                return {
+                    'auth_key': key
+                }
+            else:
+                # Caller wasn't multi-tenant aware: be safe and don't give
+                # them a key
+                return {
+                    'auth_key': None
+                }
+
+    def authorize_many(self, volume_path, grants, tenant_id=None):
+        """
+        Authorize many Ceph auth identities for a volume in one pass.
+
+        The auth metadata of every ID and then the volume metadata are each
+        locked once (in the same auth-then-volume order as authorize), each
+        metadata file is written once per state change, and the Ceph caps
+        of the IDs are updated concurrently.
+
+        :param volume_path:
+        :param grants: list of (auth_id, readonly) tuples
+        :param tenant_id: as for authorize
+        :return: dict of auth_id to the dict authorize would return
+        """
+        access_levels = OrderedDict()
+        for auth_id, readonly in grants:
+            access_levels[auth_id] = 'r' if readonly else 'rw'
+        if not access_levels:
+            return {}
+
+        volume_path_str = str(volume_path)
+        auth_ids = list(access_levels.keys())
+
+        with self._lock_many([self._auth_metadata_path(auth_id)
+                              for auth_id in auth_ids]), \
+                self._metadata_batch():
+            # Check every ID before changing anything, so that a tenant
+            # mismatch on one ID doesn't leave the others half-authorized.
+            auth_metas = {}
+            for auth_id in auth_ids:
+                auth_meta = self._auth_metadata_get(auth_id)
+                if auth_meta is not None and \
+                        auth_meta['tenant_id'].__str__() != tenant_id.__str__():
+                    msg = "auth ID: {0} is already in use".format(auth_id)
+                    log.error(msg)
+                    raise CephFSVolumeClientError(msg)
+                auth_metas[auth_id] = auth_meta
+
+            for auth_id in auth_ids:
+                auth_meta = auth_metas[auth_id]
+                if auth_meta is None:
+                    log.debug("Authorize: no existing meta for {0}".format(
+                        auth_id))
+                    auth_meta = auth_metas[auth_id] = {
+                        'tenant_id': tenant_id.__str__() if tenant_id else None,
+                        'volumes': {}
+                    }
+                elif auth_meta['dirty']:
+                    # Takes volume locks of its own, so it must happen
+                    # before we lock this volume below.
+                    self._recover_auth_meta(auth_id, auth_meta)
+
+                auth_meta['dirty'] = True
+                auth_meta['volumes'][volume_path_str] = {
+                    'access_level': access_levels[auth_id],
+                    'dirty': True,
+                }
+                self._dirty_index_add(auth_id)
+                self._auth_metadata_set(auth_id, auth_meta)
+
+            with self._volume_lock(volume_path):
+                keys = self._authorize_volume_many(volume_path, access_levels)
+
+            for auth_id in auth_ids:
+                auth_meta = auth_metas[auth_id]
+                auth_meta['dirty'] = False
+                auth_meta['volumes'][volume_path_str]['dirty'] = False
+                self._auth_metadata_set(auth_id, auth_meta)
+            self._dirty_index_remove(auth_ids)
+
+        # As in authorize, callers that aren't multi-tenant aware don't
+        # get keys.
+        return dict((auth_id, {'auth_key': keys[auth_id] if tenant_id else None})
+                    for auth_id in auth_ids)
+
+    def _authorize_volume_many(self, volume_path, access_levels):
+        """
+        Call me with the volume metadata locked!
+        """
+        vol_meta = self._volume_metadata_get(volume_path)
+        if vol_meta is None:
+            vol_meta = {
+                'auths': {}
+            }
+
+        for auth_id, access_level in access_levels.items():
+            vol_meta['auths'][auth_id] = {
+                'access_level': access_level,
+                'dirty': True,
+            }
+        self._volume_metadata_set(volume_path, vol_meta)
+
+        path = self._get_path(volume_path)
+        pool_name, namespace = self._get_volume_layout(path)
 
-        This lock isn't just to make access to the metadata safe: it's also
-        designed to be used over the two-step process of checking the
-        metadata and then responding to an authorization request, to
-        ensure that at the point we respond the metadata hasn't changed
-        in the background.  It's key to how we avoid security holes
-        resulting from races during that problem ,
-        """
-        return self._lock(self._volume_metadata_path(volume_path))
+        keys = {}
 
-    def _volume_metadata_get(self, volume_path):
-        """
-        Call me with the metadata locked!
+        # Pending writes belong to this thread, so the workers' Ceph
+        # commands can't flush them: the dirty auth and volume metadata must
+        # be on disk before any caps change.
+        self._metadata_flush()
 
-        Check whether a volume metadata structure can be decoded by the current
-        version of CephFSVolumeClient.
+        def authorize_id(auth_id, access_level):
+            keys[auth_id] = self._authorize_ceph_id(
+                auth_id, [(path, pool_name, namespace)], access_level == 'r')
 
-        Return a volume_metadata structure that the current version of
-        CephFSVolumeClient can decode.
-        """
-        volume_metadata = self._metadata_get(self._volume_metadata_path(volume_path))
+        with WorkerPool(min(self.AUTHORIZE_WORKERS, len(access_levels)),
+                        "authorize") as pool:
+            for auth_id, access_level in access_levels.items():
+                pool.submit(authorize_id, auth_id, access_level)
+            pool.wait()
 
-        if volume_metadata:
-            self._check_compat_version(volume_metadata['compat_version'])
+        for auth_id in access_levels:
+            vol_meta['auths'][auth_id]['dirty'] = False
+        self._volume_metadata_set(volume_path, vol_meta)
 
-        return volume_metadata
+        return keys
 
-    def _volume_metadata_set(self, volume_path, data):
+    def authorize_volumes(self, auth_id, volume_paths, readonly=False,
+                          tenant_id=None):
         """
-        Call me with the metadata locked!
+        Grant a Ceph auth identity access to many volumes in one call.
 
-        Add two version attributes to the volume metadata,
-        'compat_version', the minimum CephFSVolumeClient version that can
-        decode the metadata and 'version', the CephFSVolumeClient version
-        that encoded the metadata.
-        """
-        data['compat_version'] = 1
-        data['version'] = self.version
-        return self._metadata_set(self._volume_metadata_path(volume_path), data)
+        The auth metadata is written once per dirty/clean transition for all
+        the volumes, and the caps for every volume are merged into a single
+        Ceph auth update.  Each volume's metadata is updated under its lock,
+        and all the volume locks are held across the Ceph auth update.
 
-    def authorize(self, volume_path, auth_id, readonly=False, tenant_id=None):
-        """
-        Get-or-create a Ceph auth identity for `auth_id` and grant them access
-        to
-        :param volume_path:
         :param auth_id:
+        :param volume_paths: list of VolumePath
         :param readonly:
-        :param tenant_id: Optionally provide a stringizable object to
-                          restrict any created cephx IDs to other callers
-                          passing the same tenant ID.
-        :return:
+        :param tenant_id: as for authorize
+        :return: as for authorize
         """
+        volume_paths = list(OrderedDict(
+            (str(volume_path), volume_path) for volume_path in volume_paths
+        ).values())
+        access_level = 'r' if readonly else 'rw'
 
-        with self._auth_lock(auth_id):
-            # Existing meta, or None, to be updated
+        with self._auth_lock(auth_id), self._metadata_batch():
             auth_meta = self._auth_metadata_get(auth_id)
 
-            # volume data to be inserted
-            volume_path_str = str(volume_path)
-            volume = {
-                volume_path_str : {
-                    # The access level at which the auth_id is authorized to
-                    # access the volume.
-                    'access_level': 'r' if readonly else 'rw',
-                    'dirty': True,
-                }
-            }
             if auth_meta is None:
-                sys.stderr.write("Creating meta for ID {0} with tenant {1}\n".format(
-                    auth_id, tenant_id
-                ))
                 log.debug("Authorize: no existing meta")
                 auth_meta = {
-                    'dirty': True,
                     'tenant_id': tenant_id.__str__() if tenant_id else None,
-                    'volumes': volume
+                    'volumes': {}
                 }
-
-                # Note: this is *not* guaranteeing that the key doesn't already
-                # exist in Ceph: we are allowing VolumeClient tenants to
-                # 'claim' existing Ceph keys.  In order to prevent VolumeClient
-                # tenants from reading e.g. client.admin keys, you need to
-                # have configured your VolumeClient user (e.g. Manila) to
-                # have mon auth caps that prevent it from accessing those keys
-                # (e.g. limit it to only access keys with a manila.* prefix)
             else:
                 # Disallow tenants to share auth IDs
                 if auth_meta['tenant_id'].__str__() != tenant_id.__str__():
@@ -960,20 +3471,52 @@ class CephFSVolumeClient(object):
                 if auth_meta['dirty']:
                     self._recover_auth_meta(auth_id, auth_meta)
 
-                log.debug("Authorize: existing tenant {tenant}".format(
-                    tenant=auth_meta['tenant_id']
-                ))
-                auth_meta['dirty'] = True
-                auth_meta['volumes'].update(volume)
+            if not volume_paths:
+                return {
+                    'auth_key': None
+                }
 
+            auth_meta['dirty'] = True
+            for volume_path in volume_paths:
+                auth_meta['volumes'][str(volume_path)] = {
+                    'access_level': access_level,
+                    'dirty': True,
+                }
+            self._dirty_index_add(auth_id)
             self._auth_metadata_set(auth_id, auth_meta)
 
-            with self._volume_lock(volume_path):
-                key = self._authorize_volume(volume_path, auth_id, readonly)
+            with self._lock_many([self._volume_metadata_path(volume_path)
+                                  for volume_path in volume_paths]):
+                vol_metas = []
+                layouts = []
+                for volume_path in volume_paths:
+                    vol_meta = self._volume_metadata_get(volume_path)
+                    if vol_meta is None:
+                        vol_meta = {
+                            'auths': {}
+                        }
+                    vol_meta['auths'][auth_id] = {
+                        'access_level': access_level,
+                        'dirty': True,
+                    }
+                    self._volume_metadata_set(volume_path, vol_meta)
+                    vol_metas.append(vol_meta)
+
+                    path = self._get_path(volume_path)
+                    pool_name, namespace = self._get_volume_layout(path)
+                    layouts.append((path, pool_name, namespace))
+
+                key = self._authorize_ceph_id(auth_id, layouts, readonly)
+
+                for volume_path, vol_meta in zip(volume_paths, vol_metas):
+                    vol_meta['auths'][auth_id]['dirty'] = False
+                    self._volume_metadata_set(volume_path, vol_meta)
 
             auth_meta['dirty'] = False
-            auth_meta['volumes'][volume_path_str]['dirty'] = False
+            for volume_path in volume_paths:
+                auth_meta['volumes'][str(volume_path)]['dirty'] = False
             self._auth_metadata_set(auth_id, auth_meta)
+            self._dirty_index_remove([auth_id])
 
             if tenant_id:
                 return {
@@ -1014,22 +3557,46 @@ class CephFSVolumeClient(object):
 
     def _authorize_ceph(self, volume_path, auth_id, readonly):
         path = self._get_path(volume_path)
-        log.debug("Authorizing Ceph id '{0}' for path '{1}'".format(
-            auth_id, path
-        ))
+        pool_name, namespace = self._get_volume_layout(path)
+        return self._authorize_ceph_id(
+            auth_id, [(path, pool_name, namespace)], readonly)
 
-        # First I need to work out what the data pool is for this share:
-        # read the layout
+    def _get_volume_layout(self, path):
+        """
+        Return the (data pool, namespace) of a volume's directory.
+        """
         pool_name = self._get_ancestor_xattr(path, "ceph.dir.layout.pool")
         namespace = self.fs.getxattr(path, "ceph.dir.layout.pool_namespace")
+        return pool_name, namespace
+
+    def _authorize_ceph_id(self, auth_id, layouts, readonly):
+        """
+        Grant a Ceph auth ID access to one or more volume directories with
+        at most one cap update.
+
+        :param layouts: list of (path, pool_name, namespace) tuples
+        """
+        log.debug("Authorizing Ceph id '{0}' for paths {1}".format(
+            auth_id, [layout[0] for layout in layouts]
+        ))
 
         # Now construct auth capabilities that give the guest just enough
-        # permissions to access the share
+        # permissions to access the shares
         client_entity = "client.{0}".format(auth_id)
         want_access_level = 'r' if readonly else 'rw'
-        want_mds_cap = 'allow {0} path={1}'.format(want_access_level, path)
-        want_osd_cap = 'allow {0} pool={1} namespace={2}'.format(
-            want_access_level, pool_name, namespace)
+        unwanted_access_level = 'r' if want_access_level is 'rw' else 'rw'
+
+        want_mds_caps = Caps()
+        want_osd_caps = Caps()
+        # Auth caps that if present might conflict with the desired auth caps.
+        unwanted_mds_caps = Caps()
+        unwanted_osd_caps = Caps()
+        for path, pool_name, namespace in layouts:
+            want_mds_caps.add(mds_grant(want_access_level, path))
+            want_osd_caps.add(osd_grant(want_access_level, pool_name, namespace))
+            unwanted_mds_caps.add(mds_grant(unwanted_access_level, path))
+            unwanted_osd_caps.add(osd_grant(unwanted_access_level, pool_name,
+                                            namespace))
 
         try:
             existing = self._rados_command(
@@ -1045,54 +3612,51 @@ class CephFSVolumeClient(object):
                 {
                     'entity': client_entity,
                     'caps': [
-                        'mds', want_mds_cap,
-                        'osd', want_osd_cap,
+                        'mds', want_mds_caps.to_string(),
+                        'osd', want_osd_caps.to_string(),
                         'mon', 'allow r']
                 })
         else:
             # entity exists, update it
             cap = existing[0]
 
-            # Construct auth caps that if present might conflict with the desired
-            # auth caps.
-            unwanted_access_level = 'r' if want_access_level is 'rw' else 'rw'
-            unwanted_mds_cap = 'allow {0} path={1}'.format(unwanted_access_level, path)
-            unwanted_osd_cap = 'allow {0} pool={1} namespace={2}'.format(
-                unwanted_access_level, pool_name, namespace)
-
             def cap_update(orig, want, unwanted):
                 # Updates the existing auth caps such that there is a single
                 # occurrence of wanted auth caps and no occurrence of
-                # conflicting auth caps.
-
-                if not orig:
-                    return want
-
-                cap_tokens = set(orig.split(","))
-
-                cap_tokens.discard(unwanted)
-                cap_tokens.add(want)
+                # conflicting auth caps.  Returns None if the existing caps
+                # already look like that.
+                orig_caps = Caps.parse(orig)
+                caps = orig_caps.copy()
+                caps.difference_update(unwanted)
+                caps.update(want)
+                if caps == orig_caps:
+                    return None
+                return caps.to_string()
 
-                return ",".join(cap_tokens)
+            orig_osd_cap_str = cap['caps'].get('osd', "")
+            orig_mds_cap_str = cap['caps'].get('mds', "")
+            osd_cap_str = cap_update(orig_osd_cap_str, want_osd_caps, unwanted_osd_caps)
+            mds_cap_str = cap_update(orig_mds_cap_str, want_mds_caps, unwanted_mds_caps)
 
-            osd_cap_str = cap_update(cap['caps'].get('osd', ""), want_osd_cap, unwanted_osd_cap)
-            mds_cap_str = cap_update(cap['caps'].get('mds', ""), want_mds_cap, unwanted_mds_cap)
+            if osd_cap_str is None and mds_cap_str is None:
+                log.debug("Ceph id '{0}' already has the wanted caps".format(
+                    auth_id))
+            else:
+                self._rados_command(
+                    'auth caps',
+                    {
+                        'entity': client_entity,
+                        'caps': [
+                            'mds', mds_cap_str if mds_cap_str is not None
+                            else orig_mds_cap_str,
+                            'osd', osd_cap_str if osd_cap_str is not None
+                            else orig_osd_cap_str,
+                            'mon', cap['caps'].get('mon', 'allow r')]
+                    })
 
-            caps = self._rados_command(
-                'auth caps',
-                {
-                    'entity': client_entity,
-                    'caps': [
-                        'mds', mds_cap_str,
-                        'osd', osd_cap_str,
-                        'mon', cap['caps'].get('mon', 'allow r')]
-                })
-            caps = self._rados_command(
-                'auth get',
-                {
-                    'entity': client_entity
-                }
-            )
+            # 'auth caps' doesn't change the key, so the one we've already
+            # read is still good.
+            caps = existing
 
         # Result expected like this:
         # [
@@ -1110,7 +3674,7 @@ class CephFSVolumeClient(object):
         return caps[0]['key']
 
     def deauthorize(self, volume_path, auth_id):
-        with self._auth_lock(auth_id):
+        with self._auth_lock(auth_id), self._metadata_batch():
             # Existing meta, or None, to be updated
             auth_meta = self._auth_metadata_get(auth_id)
 
@@ -1121,7 +3685,7 @@ class CephFSVolumeClient(object):
                     auth_id=auth_id, volume=volume_path.volume_id
                 ))
                 # Clean up the auth meta file of an auth ID
-                self.fs.unlink(self._auth_metadata_path(auth_id))
+                self._metadata_unlink(self._auth_metadata_path(auth_id))
                 return
 
             if volume_path_str not in auth_meta['volumes']:
@@ -1136,6 +3700,7 @@ class CephFSVolumeClient(object):
 
             auth_meta['dirty'] = True
             auth_meta['volumes'][volume_path_str]['dirty'] = True
+            self._dirty_index_add(auth_id)
             self._auth_metadata_set(auth_id, auth_meta)
 
             self._deauthorize_volume(volume_path, auth_id)
@@ -1145,11 +3710,11 @@ class CephFSVolumeClient(object):
 
             # Clean up auth meta file
             if not auth_meta['volumes']:
-                self.fs.unlink(self._auth_metadata_path(auth_id))
-                return
-
-            auth_meta['dirty'] = False
-            self._auth_metadata_set(auth_id, auth_meta)
+                self._metadata_unlink(self._auth_metadata_path(auth_id))
+            else:
+                auth_meta['dirty'] = False
+                self._auth_metadata_set(auth_id, auth_meta)
+            self._dirty_index_remove([auth_id])
 
     def _deauthorize_volume(self, volume_path, auth_id):
         with self._volume_lock(volume_path):
@@ -1188,11 +3753,10 @@ class CephFSVolumeClient(object):
         # The auth_id might have read-only or read-write mount access for the
         # volume path.
         access_levels = ('r', 'rw')
-        want_mds_caps = {'allow {0} path={1}'.format(access_level, path)
-                         for access_level in access_levels}
-        want_osd_caps = {'allow {0} pool={1} namespace={2}'.format(
-                         access_level, pool_name, namespace)
-                         for access_level in access_levels}
+        want_mds_caps = [mds_grant(access_level, path)
+                         for access_level in access_levels]
+        want_osd_caps = [osd_grant(access_level, pool_name, namespace)
+                         for access_level in access_levels]
 
         try:
             existing = self._rados_command(
@@ -1203,8 +3767,9 @@ class CephFSVolumeClient(object):
             )
 
             def cap_remove(orig, want):
-                cap_tokens = set(orig.split(","))
-                return ",".join(cap_tokens.difference(want))
+                caps = Caps.parse(orig)
+                caps.difference_update(want)
+                return caps.to_string()
 
             cap = existing[0]
             osd_cap_str = cap_remove(cap['caps'].get('osd', ""), want_osd_caps)
@@ -1266,6 +3831,10 @@ class CephFSVolumeClient(object):
         if args is None:
             args = {}
 
+        if prefix not in self.READ_ONLY_COMMANDS:
+            # Ceph mustn't change ahead of the metadata describing it
+            self._metadata_flush()
+
         argdict = args.copy()
         argdict['format'] = 'json'
 
@@ -1287,6 +3856,73 @@ class CephFSVolumeClient(object):
             else:
                 return outbuf
 
+    def list_groups(self):
+        """
+        Yield the IDs of the volume groups, as they're read from the
+        directory.  Volumes created with group_id=None aren't in any of
+        them, see list_volumes.
+        """
+        for name in self._readdir(self.volume_prefix):
+            # Everything else we keep in the volume prefix is either
+            # reserved, or named like the meta files, which create_group
+            # doesn't allow.
+            if name in (NO_GROUP_NAME, TRASH_DIR_NAME) or \
+                    name.endswith(META_FILE_EXT):
+                continue
+            yield name
+
+    def list_volumes(self, group_id=None):
+        """
+        Yield a VolumePath for each volume in a group (or not in any
+        group, for group_id=None), as they're read from the directory.
+        """
+        if group_id is None:
+            path = os.path.join(self.volume_prefix, NO_GROUP_NAME)
+        else:
+            path = self._get_group_path(group_id)
+        for name in self._readdir(path):
+            yield VolumePath(group_id, name)
+
+    def _list_all_volumes(self):
+        for volume_path in self.list_volumes(None):
+            yield volume_path
+        for group_id in self.list_groups():
+            for volume_path in self.list_volumes(group_id):
+                yield volume_path
+
+    def _get_usage(self, volume_path):
+        path = self._get_path(volume_path)
+        used_bytes = int(self.fs.getxattr(path, "ceph.dir.rbytes"))
+        try:
+            max_bytes = int(self.fs.getxattr(path, "ceph.quota.max_bytes"))
+        except cephfs.NoData:
+            max_bytes = 0
+        return {
+            'used_bytes': used_bytes,
+            'max_bytes': max_bytes if max_bytes else None
+        }
+
+    def list_volumes_with_usage(self, workers=None):
+        """
+        Yield a (VolumePath, usage) tuple for every volume, grouped or not,
+        where usage is a dict of 'used_bytes' and 'max_bytes' (None if the
+        volume has no quota).
+
+        Directories are read as the results are consumed, and the usage
+        of up to `workers` (LIST_WORKERS by default) volumes is fetched at
+        once; results come out in the order they're fetched.  Volumes
+        deleted while we're listing are left out.
+        """
+        with WorkerPool(workers if workers else self.LIST_WORKERS,
+                        name="list") as pool:
+            for volume_path, usage, error in pool.map_unordered(
+                    self._get_usage, self._list_all_volumes()):
+                if isinstance(error, cephfs.ObjectNotFound):
+                    continue
+                elif error is not None:
+                    raise error
+                yield volume_path, usage
+
     def get_used_bytes(self, volume_path):
         return int(self.fs.getxattr(self._get_path(volume_path), "ceph.dir.rbytes"))
 
@@ -1295,10 +3931,64 @@ class CephFSVolumeClient(object):
                          max_bytes.__str__() if max_bytes is not None else "0",
                          0)
 
+    def get_used_bytes_many(self, volume_paths, workers=None):
+        """
+        get_used_bytes for many volumes, up to `workers` (LIST_WORKERS by
+        default) at once.
+
+        :return: dict mapping each VolumePath to its used bytes, or to the
+                 cephfs.Error raised fetching them
+        """
+        return self._map_volumes(self.get_used_bytes, volume_paths, workers)
+
+    def set_max_bytes_many(self, max_bytes, workers=None):
+        """
+        set_max_bytes for many volumes, up to `workers` (LIST_WORKERS by
+        default) at once.  Volumes whose quota is already right are left
+        alone.
+
+        :param max_bytes: dict mapping VolumePath to max bytes (or None)
+        :return: dict mapping each VolumePath to None on success, or to the
+                 cephfs.Error raised setting its quota
+        """
+        def set_max_bytes(volume_path):
+            path = self._get_path(volume_path)
+            want = int(max_bytes[volume_path] or 0)
+            try:
+                current = int(self.fs.getxattr(path, "ceph.quota.max_bytes"))
+            except cephfs.NoData:
+                current = 0
+            if current != want:
+                self.set_max_bytes(volume_path, max_bytes[volume_path])
+
+        return self._map_volumes(set_max_bytes, list(max_bytes.keys()), workers)
+
+    def _map_volumes(self, fn, volume_paths, workers):
+        results = {}
+        if not volume_paths:
+            return results
+
+        with WorkerPool(min(workers if workers else self.LIST_WORKERS,
+                            len(volume_paths)), name="volumes") as pool:
+            for volume_path, result, error in pool.map_unordered(
+                    fn, volume_paths):
+                if error is not None and not isinstance(error, cephfs.Error):
+                    raise error
+                results[volume_path] = error if error is not None else result
+        return results
+
+    def _snapshot_dir(self, dir_path):
+        return os.path.join(dir_path, self.rados.conf_get('client_snapdir'))
+
     def _snapshot_path(self, dir_path, snapshot_name):
-        return os.path.join(
-            dir_path, self.rados.conf_get('client_snapdir'), snapshot_name
-        )
+        return os.path.join(self._snapshot_dir(dir_path), snapshot_name)
+
+    def _list_snapshots(self, dir_path):
+        """
+        Yield the names of the snapshots of a directory.  Snapshots of its
+        ancestors show up too, named "_<name>_<ancestor inode>".
+        """
+        return self._readdir(self._snapshot_dir(dir_path))
 
     def _snapshot_create(self, dir_path, snapshot_name):
         # TODO: raise intelligible exception for clusters where snaps are disabled
@@ -1333,15 +4023,88 @@ class CephFSVolumeClient(object):
 
         return self._snapshot_destroy(self._get_group_path(group_id), snapshot_name)
 
-    def _cp_r(self, src, dst):
-        # TODO
-        raise NotImplementedError()
+    def _cp_r(self, src, dst, workers=None):
+        """
+        Copy the tree under src into the existing directory dst.
+
+        :return: CopyJob stats
+        """
+        job = CopyJob(self, src, dst, workers if workers else self.COPY_WORKERS)
+        return job.run()
+
+    def clone_volume_to_existing(self, dest_volume_path, src_volume_path, src_snapshot_name,
+                                 workers=None):
+        """
+        Copy the contents of a volume snapshot into another, existing volume.
+
+        The destination keeps its own data pool and namespace; modes, user
+        xattrs and layout striping come from the snapshot.
 
-    def clone_volume_to_existing(self, dest_volume_path, src_volume_path, src_snapshot_name):
+        :return: dict of 'files', 'dirs', 'bytes', 'elapsed' and 'bytes_per_sec'
+        """
         dest_fs_path = self._get_path(dest_volume_path)
         src_snapshot_path = self._snapshot_path(self._get_path(src_volume_path), src_snapshot_name)
 
-        self._cp_r(src_snapshot_path, dest_fs_path)
+        return self._cp_r(src_snapshot_path, dest_fs_path, workers)
+
+    def sync_snapshot_to_local(self, volume_path, snapshot_name, local_dir,
+                               state_path=None, workers=None):
+        """
+        Incrementally copy a volume snapshot into a local directory (see
+        SnapshotSyncJob), for instance to back up each night's snapshot.
+
+        :param local_dir: local directory to update, created if need be
+        :param state_path: local file remembering what the last sync copied,
+                           by default local_dir + ".sync-state"
+        :return: SnapshotSyncJob stats
+        """
+        path = self._get_path(volume_path)
+        src = self._snapshot_path(path, snapshot_name)
+        local_dir = os.path.abspath(local_dir)
+        if state_path is None:
+            state_path = local_dir + ".sync-state"
+        job = SnapshotSyncJob(self, src, local_dir, state_path,
+                              workers if workers else self.COPY_WORKERS,
+                              origin=path)
+        return job.run()
+
+    @contextmanager
+    def _ioctx(self, pool_name):
+        """
+        Use the cached IoCtx for a pool, opening it on first use.  The
+        IoCtx is shared by all threads (librados ioctx operations are
+        thread safe) and stays open until disconnect or until the pool is
+        purged, and even then not before the last thread using it is done.
+        """
+        with self._ioctxs_lock:
+            entry = self._ioctxs.get(pool_name)
+            if entry is None:
+                entry = self._ioctxs[pool_name] = [
+                    self.rados.open_ioctx(pool_name), 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._ioctxs_lock:
+                entry[1] -= 1
+                if entry[1] == 0 and self._ioctxs.get(pool_name) is not entry:
+                    # Dropped by _close_ioctxs while we were using it
+                    entry[0].close()
+
+    def _close_ioctxs(self, pool_name=None):
+        """
+        Drop cached IoCtxs, closing those no thread is using; the others
+        are closed by the last thread to finish with them.
+        """
+        with self._ioctxs_lock:
+            pool_names = [pool_name] if pool_name else list(self._ioctxs.keys())
+            for name in pool_names:
+                entry = self._ioctxs.pop(name, None)
+                if entry is not None and entry[1] == 0:
+                    entry[0].close()
+
+    def _max_object_size(self):
+        return int(self.rados.conf_get('osd_max_write_size')) * 1024 * 1024
 
     def put_object(self, pool_name, object_name, data):
         """
@@ -1354,17 +4117,14 @@ class CephFSVolumeClient(object):
         :param data: data to write
         :type data: bytes
         """
-        ioctx = self.rados.open_ioctx(pool_name)
-        max_size = int(self.rados.conf_get('osd_max_write_size')) * 1024 * 1024
-        if len(data) > max_size:
-            msg = ("Data to be written to object '{0}' exceeds "
-                   "{1} bytes".format(object_name, max_size))
-            log.error(msg)
-            raise CephFSVolumeClientError(msg)
-        try:
+        with self._ioctx(pool_name) as ioctx:
+            max_size = self._max_object_size()
+            if len(data) > max_size:
+                msg = ("Data to be written to object '{0}' exceeds "
+                       "{1} bytes".format(object_name, max_size))
+                log.error(msg)
+                raise CephFSVolumeClientError(msg)
             ioctx.write_full(object_name, data)
-        finally:
-            ioctx.close()
 
     def get_object(self, pool_name, object_name):
         """
@@ -1377,23 +4137,334 @@ class CephFSVolumeClient(object):
 
         :returns: bytes - data read from object
         """
-        ioctx = self.rados.open_ioctx(pool_name)
-        max_size = int(self.rados.conf_get('osd_max_write_size')) * 1024 * 1024
-        try:
+        with self._ioctx(pool_name) as ioctx:
+            max_size = self._max_object_size()
             bytes_read = ioctx.read(object_name, max_size)
             if ((len(bytes_read) == max_size) and
                     (ioctx.read(object_name, 1, offset=max_size))):
                 log.warning("Size of object {0} exceeds '{1}' bytes "
                             "read".format(object_name, max_size))
-        finally:
-            ioctx.close()
-        return bytes_read
+            return bytes_read
 
     def delete_object(self, pool_name, object_name):
-        ioctx = self.rados.open_ioctx(pool_name)
+        with self._ioctx(pool_name) as ioctx:
+            try:
+                ioctx.remove_object(object_name)
+            except rados.ObjectNotFound:
+                log.warn("Object '{0}' was already removed".format(object_name))
+
+    def put_objects(self, pool_name, objects):
+        """
+        Write many objects, pipelining the writes with up to
+        OBJECT_IN_FLIGHT outstanding at once.
+
+        :param pool_name: name of the pool
+        :type pool_name: str
+        :param objects: object name -> data
+        :type objects: dict
+        """
+        with self._ioctx(pool_name) as ioctx:
+            max_size = self._max_object_size()
+            for object_name, data in objects.items():
+                if len(data) > max_size:
+                    msg = ("Data to be written to object '{0}' exceeds "
+                           "{1} bytes".format(object_name, max_size))
+                    log.error(msg)
+                    raise CephFSVolumeClientError(msg)
+
+            in_flight = deque()
+            try:
+                for object_name, data in objects.items():
+                    if len(in_flight) >= self.OBJECT_IN_FLIGHT:
+                        self._aio_wait(*in_flight.popleft())
+                    in_flight.append((ioctx.aio_write_full(object_name, data),
+                                      object_name))
+                while in_flight:
+                    self._aio_wait(*in_flight.popleft())
+            finally:
+                self._aio_drain(in_flight)
+
+    def get_objects(self, pool_name, object_names, size_hint=None):
+        """
+        Read many objects, pipelining the reads with up to
+        OBJECT_IN_FLIGHT outstanding at once.  Each read asks for
+        size_hint bytes; the rest of any object that turns out to be
+        larger is read separately once its size is known.
+
+        :param pool_name: name of the pool
+        :type pool_name: str
+        :param object_names: names of the objects
+        :type object_names: list
+        :param size_hint: expected size of the objects, defaults to
+                          OBJECT_READ_SIZE
+        :type size_hint: int
+
+        :returns: dict - object name -> bytes read, or None if the object
+                  doesn't exist
+        """
+        max_size = self._max_object_size()
+        read_size = min(size_hint if size_hint else self.OBJECT_READ_SIZE,
+                        max_size)
+        results = {}
+
+        with self._ioctx(pool_name) as ioctx:
+            def read(object_name):
+                def oncomplete(completion, data_read):
+                    results[object_name] = data_read
+
+                return (ioctx.aio_read(object_name, read_size, 0, oncomplete),
+                        object_name)
+
+            def wait(completion, object_name):
+                completion.wait_for_complete_and_cb()
+                ret = completion.get_return_value()
+                if ret == -errno.ENOENT:
+                    results[object_name] = None
+                elif ret < 0:
+                    msg = "Asynchronous I/O on object '{0}' failed: {1}".format(
+                        object_name, ret)
+                    log.error(msg)
+                    raise CephFSVolumeClientError(msg)
+                elif (len(results[object_name]) == read_size and
+                      read_size < max_size):
+                    read_rest(object_name)
+
+            def read_rest(object_name):
+                data = results[object_name]
+                size, _ = ioctx.stat(object_name)
+                if size > max_size:
+                    log.warning("Size of object {0} exceeds '{1}' bytes "
+                                "read".format(object_name, max_size))
+                    size = max_size
+                if size > len(data):
+                    results[object_name] = data + ioctx.read(
+                        object_name, size - len(data), offset=len(data))
+
+            in_flight = deque()
+            try:
+                for object_name in object_names:
+                    if len(in_flight) >= self.OBJECT_IN_FLIGHT:
+                        wait(*in_flight.popleft())
+                    in_flight.append(read(object_name))
+                while in_flight:
+                    wait(*in_flight.popleft())
+            finally:
+                self._aio_drain(in_flight)
+
+        return results
+
+    def _stripe_chunk_name(self, object_name, index, generation):
+        return "{0}.{1}.{2:016x}".format(object_name, generation, index)
+
+    def _stripe_chunks_remove(self, ioctx, object_name, chunks, generation):
+        for index in range(chunks):
+            try:
+                ioctx.remove_object(self._stripe_chunk_name(
+                    object_name, index, generation))
+            except rados.ObjectNotFound:
+                pass
+
+    def _stripe_manifest_get(self, ioctx, object_name, stale=False):
+        """
+        Return the manifest of a striped object, or None if object_name
+        doesn't exist or isn't striped.  A striped object's head holds no
+        data, so one overwritten by put_object isn't striped any more,
+        though it keeps the manifest xattr: pass stale=True to get that
+        manifest anyway, to clean up the chunks it names.
+        """
         try:
-            ioctx.remove_object(object_name)
-        except rados.ObjectNotFound:
-            log.warn("Object '{0}' was already removed".format(object_name))
-        finally:
-            ioctx.close()
+            if not stale:
+                size, _ = ioctx.stat(object_name)
+                if size:
+                    return None
+            manifest = ioctx.get_xattr(object_name, self.STRIPE_MANIFEST_XATTR)
+        except (rados.ObjectNotFound, rados.NoData):
+            return None
+        return json.loads(manifest)
+
+    def _aio_wait(self, completion, object_name):
+        # Not just wait_for_complete: the read callbacks fill in the results
+        completion.wait_for_complete_and_cb()
+        ret = completion.get_return_value()
+        if ret < 0:
+            msg = "Asynchronous I/O on object '{0}' failed: {1}".format(
+                object_name, ret)
+            log.error(msg)
+            raise CephFSVolumeClientError(msg)
+
+    def _aio_drain(self, in_flight):
+        """
+        Wait out outstanding completions after a failure, so that the ioctx
+        can be closed safely.
+        """
+        while in_flight:
+            completion, _ = in_flight.popleft()
+            completion.wait_for_complete_and_cb()
+
+    def put_object_striped(self, pool_name, object_name, data, chunk_size=None):
+        """
+        Write data of any size as a striped object: the data goes into
+        chunk objects named <object_name>.<generation>.<16 hex digit index>,
+        written concurrently with at most STRIPE_IN_FLIGHT outstanding, and
+        then a small manifest naming the generation is set as an xattr of
+        object_name itself, which holds no data.  Each write uses a new
+        generation, so an overwrite never touches the chunks the previous
+        manifest points at; those are removed once the new manifest is set.
+        Memory use is bounded by chunk_size * STRIPE_IN_FLIGHT.
+
+        :param pool_name: name of the pool
+        :type pool_name: str
+        :param object_name: name of the object
+        :type object_name: str
+        :param data: data to write, or a file-like object to read it from
+        :type data: bytes or file
+        :param chunk_size: bytes per chunk object, defaults to
+                           STRIPE_CHUNK_SIZE and may not exceed
+                           osd_max_write_size
+        """
+        max_size = self._max_object_size()
+        chunk_size = chunk_size if chunk_size else self.STRIPE_CHUNK_SIZE
+        if chunk_size > max_size:
+            msg = ("Chunk size {0} for object '{1}' exceeds {2} bytes".format(
+                chunk_size, object_name, max_size))
+            log.error(msg)
+            raise CephFSVolumeClientError(msg)
+
+        if hasattr(data, 'read'):
+            def read_chunk(offset):
+                # Raw streams and pipes may return less than asked for, but
+                # every chunk but the last must be full
+                pieces = []
+                remaining = chunk_size
+                while remaining:
+                    piece = data.read(remaining)
+                    if not piece:
+                        break
+                    pieces.append(piece)
+                    remaining -= len(piece)
+                return b"".join(pieces)
+        else:
+            read_chunk = lambda offset: data[offset:offset + chunk_size]
+
+        with self._ioctx(pool_name) as ioctx:
+            old_manifest = self._stripe_manifest_get(ioctx, object_name,
+                                                     stale=True)
+            generation = uuid.uuid4().hex
+
+            in_flight = deque()
+            size = 0
+            chunks = 0
+            try:
+                while True:
+                    chunk = read_chunk(size)
+                    if not chunk:
+                        break
+                    if len(in_flight) >= self.STRIPE_IN_FLIGHT:
+                        self._aio_wait(*in_flight.popleft())
+                    chunk_name = self._stripe_chunk_name(object_name, chunks,
+                                                         generation)
+                    in_flight.append((ioctx.aio_write_full(chunk_name, chunk),
+                                      chunk_name))
+                    size += len(chunk)
+                    chunks += 1
+                while in_flight:
+                    self._aio_wait(*in_flight.popleft())
+            except:
+                self._aio_drain(in_flight)
+                # Nothing points at this generation yet
+                self._stripe_chunks_remove(ioctx, object_name, chunks, generation)
+                raise
+
+            # The manifest goes last: until it is set (and a plain object
+            # it replaces is truncated away), readers still see the previous
+            # version (or nothing).  A crash before then leaves only
+            # unreferenced chunks of the new generation behind.  Setting the
+            # xattr creates the head object if need be.
+            ioctx.set_xattr(object_name, self.STRIPE_MANIFEST_XATTR, json.dumps({
+                'size': size,
+                'chunk_size': chunk_size,
+                'chunks': chunks,
+                'generation': generation,
+            }).encode('utf-8'))
+            ioctx.trunc(object_name, 0)
+
+            if old_manifest:
+                self._stripe_chunks_remove(ioctx, object_name,
+                                           old_manifest['chunks'],
+                                           old_manifest['generation'])
+
+    def get_object_striped(self, pool_name, object_name, out=None):
+        """
+        Read an object written by put_object_striped, fetching up to
+        STRIPE_IN_FLIGHT chunks concurrently.  An object that isn't striped
+        is read as a whole, as get_object would.
+
+        :param pool_name: name of the pool
+        :type pool_name: str
+        :param object_name: name of the object
+        :type object_name: str
+        :param out: optional file-like object to stream the data into,
+                    keeping memory use bounded
+
+        :returns: bytes - data read from object, or the number of bytes
+                  written to out
+        """
+        with self._ioctx(pool_name) as ioctx:
+            manifest = self._stripe_manifest_get(ioctx, object_name)
+            if manifest is None:
+                data = self.get_object(pool_name, object_name)
+                if out is None:
+                    return data
+                out.write(data)
+                return len(data)
+
+            results = {}
+
+            def read_chunk(index):
+                chunk_name = self._stripe_chunk_name(object_name, index,
+                                                     manifest['generation'])
+                length = min(manifest['chunk_size'],
+                             manifest['size'] - index * manifest['chunk_size'])
+
+                def oncomplete(completion, data_read):
+                    results[index] = data_read
+
+                return (ioctx.aio_read(chunk_name, length, 0, oncomplete),
+                        chunk_name)
+
+            pieces = []
+            in_flight = deque()
+            next_index = 0
+            try:
+                for index in range(manifest['chunks']):
+                    while (next_index < manifest['chunks'] and
+                           len(in_flight) < self.STRIPE_IN_FLIGHT):
+                        in_flight.append(read_chunk(next_index))
+                        next_index += 1
+                    self._aio_wait(*in_flight.popleft())
+                    chunk = results.pop(index)
+                    if out is None:
+                        pieces.append(chunk)
+                    else:
+                        out.write(chunk)
+            finally:
+                self._aio_drain(in_flight)
+
+            if out is None:
+                return b"".join(pieces)
+            return manifest['size']
+
+    def delete_object_striped(self, pool_name, object_name):
+        """
+        Remove an object written by put_object_striped, chunks and all.
+        """
+        with self._ioctx(pool_name) as ioctx:
+            manifest = self._stripe_manifest_get(ioctx, object_name, stale=True)
+            # Manifest first, so nobody reads a partially removed object
+            try:
+                ioctx.remove_object(object_name)
+            except rados.ObjectNotFound:
+                log.warn("Object '{0}' was already removed".format(object_name))
+            if manifest:
+                self._stripe_chunks_remove(ioctx, object_name, manifest['chunks'],
+                                           manifest['generation'])
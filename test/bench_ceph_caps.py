@@ -0,0 +1,63 @@
+'''
+benchmark merging path grants into the caps of one entity
+
+usage: python test/bench_ceph_caps.py [max grants]
+
+For each size n, an entity holding n path grants gets n more merged in
+and n removed again, once with the ceph_caps model and once with the
+split/join of the cap string per grant that the cap helpers used to do.
+The per-grant cost of the model should stay flat as n grows.
+'''
+
+import os
+import sys
+import timeit
+
+homedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(homedir, 'py-packages'))
+
+from ceph_caps import Caps, mds_grant
+
+def grants(start, n):
+    return [mds_grant('rw', '/volumes/g/v{0}'.format(i))
+            for i in range(start, start + n)]
+
+def merge_model(existing, add, remove):
+    caps = Caps.parse(existing)
+    caps.update(add)
+    caps.difference_update(remove)
+    return caps.to_string()
+
+def merge_strings(existing, add, remove):
+    # One cap_update/cap_remove call per grant, as before
+    for g in add:
+        tokens = set(existing.split(','))
+        tokens.add(str(g))
+        existing = ','.join(tokens)
+    for g in remove:
+        tokens = set(existing.split(','))
+        tokens.discard(str(g))
+        existing = ','.join(tokens)
+    return existing
+
+def main():
+    max_n = int(sys.argv[1]) if len(sys.argv) > 1 else 1600
+    print('{0:>6} {1:>14} {2:>14}'.format('grants', 'model us/grant',
+                                         'split us/grant'))
+    n = 100
+    while n <= max_n:
+        existing = Caps(grants(0, n)).to_string()
+        add = grants(n, n)
+        remove = grants(0, n)
+        number = max(1, 20000 // n)
+        model = min(timeit.repeat(lambda: merge_model(existing, add, remove),
+                                  number=number, repeat=3)) / number
+        strings = min(timeit.repeat(lambda: merge_strings(existing, add, remove),
+                                    number=max(1, number // 10),
+                                    repeat=3)) / max(1, number // 10)
+        print('{0:>6} {1:>14.2f} {2:>14.2f}'.format(
+            n, model * 1e6 / (2 * n), strings * 1e6 / (2 * n)))
+        n *= 2
+
+if __name__ == '__main__':
+    main()
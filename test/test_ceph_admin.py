@@ -88,3 +88,34 @@ def test_exportuser(suit, capfd):
     assert '"cephconf": null' in out, out
     assert len(err) == 0, err
     deluser(capfd)
+
+def test_compact_caps(suit, capfd):
+    adduser(capfd)
+    sys.argv = [prog,'-vv','-x',prefix,'compact-caps',user,'--dry-run']
+    assert 0 == admin.main()
+    out, err = capfd.readouterr()
+    assert 'compact caps of 0 users (dry run)' in out, out
+    assert len(err) == 0, err
+    deluser(capfd)
+
+def test_getusers(suit, capfd):
+    adduser(capfd)
+    sys.argv = [prog,'-vv','-x',prefix,'get',user,'admin']
+    assert 0 == admin.main()
+    out, err = capfd.readouterr()
+    assert 'user {0}'.format(user) in out, out
+    assert len(err) == 0, err
+    sys.argv = [prog,'-vv','-x',prefix,'get','--all']
+    assert 0 == admin.main()
+    out, err = capfd.readouterr()
+    assert 'user {0}'.format(user) in out, out
+    deluser(capfd)
+
+def test_exportusers(suit, capfd):
+    adduser(capfd)
+    sys.argv = [prog,'-vv','-x',prefix,'export','--all']
+    assert 0 == admin.main()
+    out, err = capfd.readouterr()
+    assert '"name": "{0}"'.format(user) in out, out
+    assert len(err) == 0, err
+    deluser(capfd)
@@ -194,3 +194,70 @@ def test_exportuser(capfd):
     assert prefix in ret
     admin.deluser(user=user, prefix=prefix)
     capfd.readouterr()
+
+def test_compact_paths():
+    admin.set_root_prefix(prefix)
+    assert admin._compact_paths(['/a/b', '/a', '/a/', '/c//d', '/c/d/e',
+        '', '/x/a', '/xa']) == ['/a', '/c/d', '/x/a', '/xa']
+    assert admin._compact_mds('allow rw path=/a, allow rw path=/a/b, '
+        'allow r path=/a/c') == 'allow rw path=/a, allow r path=/a/c'
+    assert admin._compact_mds('allow rw path=/a, allow rw path=/b') is None
+    # group and user paths stay, the caps are their only record
+    assert admin._compact_paths([prefix, prefix + '/group1',
+        prefix + '/x/y']) == [prefix, prefix + '/group1']
+
+def test_adduser_compact(capfd):
+    admin.adduser(user=user,
+            groups=['group1'],
+            prefix=prefix,
+            paths=[prefix, os.path.join(prefix, 'mypath')])
+    capfd.readouterr()
+    key, groups, usage = admin.getuser(user=user, prefix=prefix)
+    assert groups == ['group1'], groups
+    assert len(usage) == 3, usage
+    assert [u[2] for u in usage] == [prefix, '%s/group1'%prefix,
+            '%s/%s'%(prefix,user)], usage
+    admin.deluser(user=user, prefix=prefix)
+    capfd.readouterr()
+
+def test_compact_caps(capfd):
+    admin.adduser(user=user, prefix=prefix)
+    assert 0 == admin.updateuser(user=user,
+            pathadd=[os.path.join(prefix, user, 'sub')],
+            prefix=prefix)
+    ret = admin.compact_caps(users=[user], prefix=prefix)
+    assert ret == [], ret
+    admin.deluser(user=user, prefix=prefix)
+    capfd.readouterr()
+
+def test_getusers(capfd):
+    admin.adduser(user=user, groups=['group1'], prefix=prefix, quota=1)
+    admin.adduser(user='group1', prefix=prefix, quota=5)
+    capfd.readouterr()
+    ret = admin.getusers(users=[user, 'group1'], prefix=prefix)
+    assert len(ret) == 2, ret
+    name, key, groups, usage = ret[0]
+    assert name == user, ret
+    assert len(key)>0, key
+    assert groups == ['group1'], groups
+    assert ('0', '5368709120', '%s/group1'%prefix) in usage, usage
+    assert ('0', '1073741824', '%s/%s'%(prefix,user)) in usage, usage
+    assert ret[1][3] == [('0', '5368709120', '%s/group1'%prefix)], ret
+    ret = admin.getusers(prefix=prefix, showpath=True)
+    assert user in [u for u, _, _ in ret], ret
+    with pytest.raises(admin.GetUserError):
+        admin.getusers(users=[user, 'pytest_nouser'], prefix=prefix)
+    admin.deluser(user=user, prefix=prefix)
+    admin.deluser(user='group1', prefix=prefix)
+    capfd.readouterr()
+
+def test_exportusers(capfd):
+    admin.adduser(user=user, prefix=prefix)
+    ret = admin.exportusers(users=[user], prefix=prefix)
+    assert len(ret) == 1, ret
+    assert ret[0][0] == user, ret
+    info = json.loads(ret[0][1])
+    assert info['name'] == user, info
+    assert info['root'] == '%s/%s'%(prefix,user), info
+    admin.deluser(user=user, prefix=prefix)
+    capfd.readouterr()
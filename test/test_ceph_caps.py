@@ -0,0 +1,60 @@
+import pytest
+import os
+import sys
+
+homedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(homedir, 'py-packages'))
+caps = pytest.importorskip('ceph_caps')
+
+def test_parse_grant():
+    g = caps.Grant.parse('allow  rw   path=/a//b/')
+    assert g.access == 'rw'
+    assert g.path == '/a/b'
+    assert str(g) == 'allow rw path=/a/b'
+    assert g == caps.mds_grant('rw', '/a/b')
+    assert caps.Grant.parse('deny rw') is None
+
+def test_parse_osd_grant():
+    g = caps.Grant.parse('allow r pool=data namespace=ns')
+    assert g.get('pool') == 'data'
+    assert g.get('namespace') == 'ns'
+    assert g.path is None
+    assert g == caps.osd_grant('r', 'data', 'ns')
+
+def test_parse_caps_separators():
+    c = caps.Caps.parse('allow rw path=/a, allow r path=/b,allow rw path=/a')
+    assert len(c) == 2
+    assert c.to_string() == 'allow rw path=/a,allow r path=/b'
+    assert c.to_string(', ') == 'allow rw path=/a, allow r path=/b'
+    assert len(caps.Caps.parse('')) == 0
+    assert len(caps.Caps.parse(None)) == 0
+
+def test_paths():
+    c = caps.Caps.parse('allow rw path=/a, allow r path=/b, allow *, allow rw path=/c/')
+    assert c.paths() == ['/a', '/b', '/c']
+    assert c.paths('rw') == ['/a', '/c']
+
+def test_set_semantics():
+    c = caps.Caps.parse('allow rw path=/a,allow r path=/b')
+    assert 'allow rw  path=/a/' in c
+    assert caps.mds_grant('r', '/b') in c
+    c.discard('allow r path=/b')
+    c.add(caps.mds_grant('rw', '/b'))
+    c.add('allow rw path=/a')
+    assert c.to_string() == 'allow rw path=/a,allow rw path=/b'
+    c.difference_update([caps.mds_grant('rw', '/a'), 'allow rw path=/x'])
+    assert c.to_string() == 'allow rw path=/b'
+
+def test_unparsed_grants_kept():
+    c = caps.Caps.parse('allow rw path=/a, profile  rbd')
+    assert c.to_string() == 'allow rw path=/a,profile rbd'
+    assert c.paths() == ['/a']
+
+def test_equality_ignores_order():
+    a = caps.Caps.parse('allow rw path=/a,allow r path=/b')
+    b = caps.Caps.parse('allow r path=/b, allow rw path=/a')
+    assert a == b
+    c = b.copy()
+    c.add('allow rw path=/c')
+    assert a != c
+    assert len(b) == 2
@@ -0,0 +1,653 @@
+import pytest
+import errno
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+homedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(homedir, 'py-packages'))
+try:
+    import ceph_volume_client as cvc
+except ImportError:
+    # librados/libcephfs are not installed
+    pytest.skip('ceph_volume_client needs the Ceph bindings', allow_module_level=True)
+
+class FakeClock(object):
+    '''
+    time.time/time.sleep stand-ins, sleeping just advances the clock
+    '''
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cvc.time, 'time', clock.time)
+    monkeypatch.setattr(cvc.time, 'sleep', clock.sleep)
+    return clock
+
+def test_rate_limiter_unlimited(clock):
+    for rate in (None, 0):
+        limiter = cvc.RateLimiter(rate)
+        for i in range(1000):
+            limiter.acquire()
+    assert clock.sleeps == []
+
+def test_rate_limiter_burst(clock):
+    limiter = cvc.RateLimiter(10, burst=5)
+    for i in range(5):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+    limiter.acquire(count=2)
+    assert clock.sleeps[1] == pytest.approx(0.2)
+
+def test_rate_limiter_refill(clock):
+    limiter = cvc.RateLimiter(8, burst=4)
+    limiter.acquire(count=4)
+    clock.now += 0.375
+    for i in range(3):
+        limiter.acquire()
+    assert clock.sleeps == []
+    # The bucket never holds more than the burst
+    clock.now += 60
+    limiter.acquire(count=5)
+    assert clock.sleeps == [pytest.approx(0.125)]
+
+class FakeStat(object):
+    def __init__(self, ino=1, size=10, mtime=100.0, ctime=None):
+        self.st_ino = ino
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_ctime = mtime if ctime is None else ctime
+
+def test_metadata_cache_version(clock):
+    cache = cvc.MetadataCache()
+    statbuf = FakeStat()
+    assert cache.get('/a', statbuf) == (False, None)
+    cache.put('/a', statbuf, {'k': 'v'})
+    assert cache.get('/a', FakeStat()) == (True, {'k': 'v'})
+    assert cache.get('/a', FakeStat(size=11)) == (False, None)
+    assert cache.get('/a', FakeStat(ino=2)) == (False, None)
+    assert cache.get('/a', FakeStat(mtime=101.0)) == (False, None)
+    assert cache.get('/a', FakeStat(ctime=101.0)) == (False, None)
+    assert (cache.hits, cache.misses) == (1, 5)
+
+def test_metadata_cache_racy(clock):
+    cache = cvc.MetadataCache()
+    # Modified within the window, the same stat may hide a rewrite
+    statbuf = FakeStat(mtime=clock.now - 1)
+    cache.put('/a', statbuf, {'k': 'v'})
+    clock.now += 60
+    assert cache.get('/a', statbuf) == (False, None)
+    cache.put('/a', statbuf, {'k': 'v'})
+    assert cache.get('/a', statbuf) == (True, {'k': 'v'})
+
+def test_metadata_cache_datetime_stat(clock):
+    cache = cvc.MetadataCache()
+    statbuf = FakeStat(mtime=datetime(2020, 1, 1, 10, 0, 0, 500000))
+    clock.now = time.mktime(datetime(2020, 1, 2).timetuple())
+    cache.put('/a', statbuf, {'k': 'v'})
+    assert cache.get('/a', statbuf) == (True, {'k': 'v'})
+    other = FakeStat(mtime=datetime(2020, 1, 1, 10, 0, 0, 600000))
+    assert cache.get('/a', other) == (False, None)
+
+def test_metadata_cache_copies(clock):
+    cache = cvc.MetadataCache()
+    data = {'auths': {'alice': 'rw'}}
+    cache.put('/a', FakeStat(), data)
+    data['auths']['bob'] = 'r'
+    hit, cached = cache.get('/a', FakeStat())
+    assert cached == {'auths': {'alice': 'rw'}}
+    cached['auths'].clear()
+    assert cache.get('/a', FakeStat()) == (True, {'auths': {'alice': 'rw'}})
+
+def test_metadata_cache_lru(clock):
+    cache = cvc.MetadataCache(max_entries=2)
+    cache.put('/a', FakeStat(), 'a')
+    cache.put('/b', FakeStat(), 'b')
+    assert cache.get('/a', FakeStat()) == (True, 'a')
+    cache.put('/c', FakeStat(), 'c')
+    assert cache.get('/b', FakeStat()) == (False, None)
+    assert cache.get('/a', FakeStat()) == (True, 'a')
+    assert cache.get('/c', FakeStat()) == (True, 'c')
+
+def test_metadata_cache_invalidate(clock):
+    cache = cvc.MetadataCache()
+    cache.put('/a', FakeStat(), 'a')
+    cache.invalidate('/a')
+    cache.invalidate('/b')
+    assert cache.get('/a', FakeStat()) == (False, None)
+
+def test_metadata_cache_change_attr(clock):
+    cache = cvc.MetadataCache()
+    # Just written, but the change attribute can be trusted
+    cache.put('/a', cvc.MetadataVersion(1, 5), 'a')
+    assert cache.get('/a', cvc.MetadataVersion(1, 5)) == (True, 'a')
+    assert cache.get('/a', cvc.MetadataVersion(1, 6)) == (False, None)
+    assert cache.get('/a', cvc.MetadataVersion(2, 5)) == (False, None)
+    assert cache.get('/a', FakeStat()) == (False, None)
+
+class FakeLocks(object):
+    '''
+    acquire/release/check for a LockTable, logging the CephFS lock calls
+    '''
+    def __init__(self):
+        self.log = []
+        self.valid = True
+        self._handles = 0
+
+    def acquire(self, path):
+        self._handles += 1
+        self.log.append(('acquire', path, self._handles))
+        return self._handles
+
+    def release(self, path, handle):
+        self.log.append(('release', path, handle))
+
+    def check(self, path, handle):
+        return self.valid
+
+def make_table(max_handoffs=None):
+    locks = FakeLocks()
+    table = cvc.LockTable(locks.acquire, locks.release, locks.check)
+    if max_handoffs is not None:
+        table.MAX_HANDOFFS = max_handoffs
+    return table, locks
+
+def wait_for_waiters(table, count=1):
+    while table.stats()['waiters'] < count:
+        time.sleep(0.001)
+
+def start_holder(table, path, hold=None):
+    '''
+    take path in a thread, keep it until hold is set
+    '''
+    got = threading.Event()
+    def run():
+        table.acquire(path)
+        got.set()
+        if hold is not None:
+            hold.wait()
+        table.release(path)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, got
+
+def test_lock_table_reentrant():
+    table, locks = make_table()
+    table.acquire('/a')
+    table.acquire('/a')
+    assert table.depth('/a') == 2
+    table.release('/a')
+    assert table.depth('/a') == 1
+    assert locks.log == [('acquire', '/a', 1)]
+    table.release('/a')
+    assert table.depth('/a') == 0
+    assert locks.log == [('acquire', '/a', 1), ('release', '/a', 1)]
+    stats = table.stats()
+    assert stats['acquisitions'] == 2
+    assert stats['reentries'] == 1
+    assert stats['cephfs_acquisitions'] == 1
+    assert stats['held'] == 0
+
+def test_lock_table_handoff():
+    table, locks = make_table()
+    table.acquire('/a')
+    thread, got = start_holder(table, '/a')
+    wait_for_waiters(table)
+    table.release('/a')
+    thread.join()
+    assert got.is_set()
+    # The waiter got the CephFS lock without a round trip
+    assert locks.log == [('acquire', '/a', 1), ('release', '/a', 1)]
+    stats = table.stats()
+    assert stats['handoffs'] == 1
+    assert stats['contended'] == 1
+    assert stats['cephfs_acquisitions'] == 1
+
+def test_lock_table_max_handoffs():
+    table, locks = make_table(max_handoffs=1)
+    table.acquire('/a')
+    hold = threading.Event()
+    first, first_got = start_holder(table, '/a', hold)
+    wait_for_waiters(table)
+    table.release('/a')
+    first_got.wait()
+    second, _ = start_holder(table, '/a')
+    wait_for_waiters(table)
+    hold.set()
+    first.join()
+    second.join()
+    # The second handoff in a row lets go of the CephFS lock
+    assert locks.log == [('acquire', '/a', 1), ('release', '/a', 1),
+                         ('acquire', '/a', 2), ('release', '/a', 2)]
+    assert table.stats()['handoffs'] == 1
+
+def test_lock_table_stale_handoff():
+    table, locks = make_table()
+    table.acquire('/a')
+    thread, _ = start_holder(table, '/a')
+    wait_for_waiters(table)
+    # e.g. the holder unlinked the locked file
+    locks.valid = False
+    table.release('/a')
+    thread.join()
+    assert locks.log == [('acquire', '/a', 1), ('release', '/a', 1),
+                         ('acquire', '/a', 2), ('release', '/a', 2)]
+    assert table.stats()['stale_handoffs'] == 1
+
+def test_lock_table_acquire_error():
+    def acquire(path):
+        raise IOError('boom')
+    table = cvc.LockTable(acquire, None)
+    with pytest.raises(IOError):
+        table.acquire('/a')
+    assert table.depth('/a') == 0
+    assert table.stats()['held'] == 0
+
+class FakeDirEntry(object):
+    def __init__(self, name, is_dir):
+        self.d_name = name
+        self._is_dir = is_dir
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_file(self):
+        return not self._is_dir
+
+    def is_symbol_file(self):
+        return False
+
+class FakeFS(object):
+    '''
+    Just enough of cephfs.LibCephFS for metadata files, logging what
+    reaches the disk (fsynced contents and unlinks) and the flocks
+    '''
+    def __init__(self):
+        self.files = {}
+        self.dirs = set(['/'])
+        self.log = []
+        self._fds = {}
+        self._ino = 0
+
+    @staticmethod
+    def _path(path):
+        return '/' + path.strip('/')
+
+    def _not_found(self, path):
+        return cvc.cephfs.ObjectNotFound(errno.ENOENT, path)
+
+    def writes(self):
+        return [entry[1:] for entry in self.log if entry[0] == 'write']
+
+    def mkdir(self, path, mode):
+        self.dirs.add(self._path(path))
+
+    def stat(self, path):
+        path = self._path(path)
+        if path in self.dirs:
+            return FakeStat(ino=0, size=0)
+        if path not in self.files:
+            raise self._not_found(path)
+        return self._stat(self.files[path])
+
+    def _stat(self, node):
+        return FakeStat(ino=node['ino'], size=len(node['data']),
+                        mtime=float(node['mtime']))
+
+    def open(self, path, flags, mode=0o755):
+        path = self._path(path)
+        if flags == 'r':
+            flags = os.O_RDONLY
+        node = self.files.get(path)
+        if node is None:
+            if not flags & os.O_CREAT or os.path.dirname(path) not in self.dirs:
+                raise self._not_found(path)
+            self._ino += 1
+            node = self.files[path] = {'ino': self._ino, 'data': b'',
+                                       'mtime': self._ino}
+        if flags & os.O_TRUNC:
+            node['data'] = b''
+        fd = 3
+        while fd in self._fds:
+            fd += 1
+        self._fds[fd] = (path, node)
+        return fd
+
+    def close(self, fd):
+        del self._fds[fd]
+
+    def fstat(self, fd):
+        return self._stat(self._fds[fd][1])
+
+    def read(self, fd, offset, length):
+        return self._fds[fd][1]['data'][offset:offset + length]
+
+    def write(self, fd, data, offset):
+        node = self._fds[fd][1]
+        node['data'] = node['data'][:offset] + data
+        self._ino += 1
+        node['mtime'] = self._ino
+        return len(data)
+
+    def fsync(self, fd, syncdataonly):
+        path, node = self._fds[fd]
+        self.log.append(('write', path, json.loads(node['data'])))
+
+    def flock(self, fd, operation, owner):
+        self.log.append(('unlock' if operation == fcntl.LOCK_UN else 'lock',
+                         self._fds[fd][0]))
+
+    def unlink(self, path):
+        path = self._path(path)
+        if self.files.pop(path, None) is None:
+            raise self._not_found(path)
+        self.log.append(('unlink', path))
+
+    def opendir(self, path):
+        path = self._path(path)
+        if path not in self.dirs:
+            raise self._not_found(path)
+        prefix = path.rstrip('/') + '/'
+        entries = []
+        for child in sorted(self.dirs | set(self.files)):
+            name = child[len(prefix):]
+            if child.startswith(prefix) and name and '/' not in name:
+                entries.append(FakeDirEntry(name, child in self.dirs))
+        return entries
+
+    def readdir(self, dir_handle):
+        return dir_handle.pop(0) if dir_handle else None
+
+    def closedir(self, dir_handle):
+        pass
+
+    def shutdown(self):
+        pass
+
+@pytest.fixture
+def volume_client(monkeypatch):
+    fs = FakeFS()
+
+    def json_command(cluster, prefix=None, argdict=None, timeout=None):
+        fs.log.append(('mon', prefix))
+        return 0, b'', ''
+
+    monkeypatch.setattr(cvc, 'json_command', json_command)
+    volume_client = cvc.CephFSVolumeClient('manila', None, 'ceph')
+    volume_client.fs = fs
+    fs.mkdir(volume_client.volume_prefix, 0o755)
+    return volume_client
+
+def test_metadata_batch_order(volume_client):
+    fs = volume_client.fs
+    a, b = '/volumes/$a.meta', '/volumes/$b.meta'
+    with volume_client._metadata_batch():
+        volume_client._metadata_set(a, {'n': 1})
+        volume_client._metadata_set(b, {'n': 1})
+        volume_client._metadata_set(a, {'n': 2})
+        assert fs.writes() == []
+        # Reads see the pending write
+        assert volume_client._metadata_get(a) == {'n': 2}
+    # Each file once, with its last contents, in the order of the last writes
+    assert fs.writes() == [(b, {'n': 1}), (a, {'n': 2})]
+
+def test_metadata_batch_mon_commands(volume_client):
+    fs = volume_client.fs
+    a = '/volumes/$a.meta'
+    with volume_client._metadata_batch():
+        volume_client._metadata_set(a, {'dirty': True})
+        volume_client._rados_command('auth get', {'entity': 'client.a'})
+        assert fs.log == [('mon', 'auth get')]
+        volume_client._rados_command('auth caps', {'entity': 'client.a'})
+        volume_client._metadata_set(a, {'dirty': False})
+    assert fs.log == [('mon', 'auth get'),
+                      ('write', a, {'dirty': True}),
+                      ('mon', 'auth caps'),
+                      ('write', a, {'dirty': False})]
+
+def test_metadata_batch_lock_release(volume_client):
+    fs = volume_client.fs
+    a, b = '/volumes/$a.meta', '/volumes/$b.meta'
+    with volume_client._metadata_batch():
+        with volume_client._lock(a):
+            volume_client._metadata_set(a, {'n': 1})
+            with volume_client._lock(a):
+                volume_client._metadata_set(a, {'n': 2})
+            # Still held
+            assert fs.writes() == []
+            volume_client._metadata_set(b, {'n': 1})
+        # a was flushed before its lock was let go, b is still pending
+        events = [entry for entry in fs.log if entry[0] != 'lock']
+        assert events == [('write', a, {'n': 2}), ('unlock', a)]
+    assert fs.writes() == [(a, {'n': 2}), (b, {'n': 1})]
+
+def test_metadata_batch_unlink(volume_client):
+    fs = volume_client.fs
+    a, b = '/volumes/$a.meta', '/volumes/$b.meta'
+    volume_client._metadata_set(a, {'n': 1})
+    with volume_client._metadata_batch():
+        volume_client._metadata_set(b, {'n': 1})
+        volume_client._metadata_unlink(a)
+    assert fs.log == [('write', a, {'n': 1}), ('write', b, {'n': 1}),
+                      ('unlink', a)]
+
+class StatxFS(FakeFS):
+    '''
+    A FakeFS with statx, giving every change to a file a new version
+    '''
+    def __init__(self):
+        FakeFS.__init__(self)
+        self.opens = 0
+
+    def open(self, path, flags, mode=0o755):
+        self.opens += 1
+        fd = FakeFS.open(self, path, flags, mode)
+        if flags != 'r' and flags & os.O_TRUNC:
+            self._ino += 1
+            self._fds[fd][1]['mtime'] = self._ino
+        return fd
+
+    def statx(self, path, mask, flag):
+        assert mask & cvc.cephfs.CEPH_STATX_VERSION
+        node = self.files.get(self._path(path))
+        if node is None:
+            raise self._not_found(path)
+        return {'ino': node['ino'], 'version': node['mtime']}
+
+def test_metadata_cache_statx(volume_client, monkeypatch):
+    monkeypatch.setattr(cvc.cephfs, 'CEPH_STATX_INO', 0x100, raising=False)
+    monkeypatch.setattr(cvc.cephfs, 'CEPH_STATX_VERSION', 0x1000,
+                        raising=False)
+    fs = volume_client.fs = StatxFS()
+    fs.mkdir('/volumes', 0o755)
+    cache = volume_client._metadata_cache
+    a = '/volumes/$a.meta'
+    volume_client._metadata_set(a, {'n': 1})
+    opens = fs.opens
+    # Written through to the cache, and found without opening the file
+    assert volume_client._metadata_get(a) == {'n': 1}
+    assert (cache.hits, fs.opens) == (1, opens)
+
+    # Changed behind our back, within the same second
+    fd = fs.open(a, os.O_WRONLY | os.O_TRUNC)
+    fs.write(fd, b'{"n": 2}', 0)
+    fs.close(fd)
+    assert volume_client._metadata_get(a) == {'n': 2}
+    assert cache.misses == 1
+    assert volume_client._metadata_get(a) == {'n': 2}
+    assert cache.hits == 2
+
+def test_sharded_layout(volume_client):
+    fs = volume_client.fs
+    volume_client._meta_layout = cvc.META_LAYOUT_SHARDED
+    volume_client._check_meta_layout()
+    with volume_client._auth_lock('a'):
+        volume_client._auth_metadata_set('a', {'dirty': False, 'volumes': {}})
+    # Locked and written in its shard, nothing in the volume prefix itself
+    path = volume_client._auth_metadata_path('a')
+    assert path.startswith('/volumes/_shards.meta/')
+    assert ('lock', path) in fs.log
+    assert fs.writes() == [(path, {'dirty': False, 'volumes': {},
+                                   'compat_version': 1,
+                                   'version': volume_client.version})]
+    assert list(volume_client._readdir('/volumes')) == [cvc.SHARD_DIR_NAME]
+
+    default = cvc.CephFSVolumeClient('manila', None, 'ceph')
+    default.fs = fs
+    default._check_meta_layout()
+    assert default._get_meta_layout() == cvc.META_LAYOUT_SHARDED
+    flat = cvc.CephFSVolumeClient('manila', None, 'ceph',
+                                  meta_layout=cvc.META_LAYOUT_FLAT)
+    flat.fs = fs
+    with pytest.raises(cvc.CephFSVolumeClientError):
+        flat._check_meta_layout()
+
+def test_migrate_metadata_layout(volume_client):
+    volume_client._check_meta_layout()
+    assert volume_client._get_meta_layout() == cvc.META_LAYOUT_FLAT
+    with volume_client._auth_lock('a'):
+        volume_client._auth_metadata_set('a', {'dirty': False, 'volumes': {}})
+
+    volume_client._meta_layout = cvc.META_LAYOUT_SHARDED
+    volume_client._check_meta_layout()
+    # Not migrated yet: read from the flat layout's file
+    with volume_client._auth_lock('a'):
+        assert volume_client._auth_metadata_get('a')['volumes'] == {}
+
+    assert volume_client.migrate_metadata_layout() == 1
+    assert list(volume_client._readdir('/volumes')) == [cvc.SHARD_DIR_NAME]
+    with volume_client._auth_lock('a'):
+        assert volume_client._auth_metadata_get('a')['volumes'] == {}
+    assert volume_client.migrate_metadata_layout() == 0
+
+def test_recover_full_scan_interrupted(volume_client):
+    # Dirty auth IDs left by a client that kept no dirty index
+    for auth_id in ('a', 'b', 'c'):
+        with volume_client._auth_lock(auth_id):
+            volume_client._auth_metadata_set(auth_id, {
+                'dirty': True, 'volumes': {'g/v': {'dirty': True}}})
+
+    state = {'fail': True}
+
+    def recover_auth_meta(auth_id, auth_meta):
+        if auth_id == 'b' and state['fail']:
+            raise RuntimeError('boom')
+        auth_meta['dirty'] = False
+        volume_client._auth_metadata_set(auth_id, auth_meta)
+
+    volume_client._recover_auth_meta = recover_auth_meta
+    with pytest.raises(RuntimeError):
+        volume_client.recover()
+    # b has no marker, so the index can't be trusted yet
+    assert not volume_client._dirty_index_ready()
+
+    state['fail'] = False
+    volume_client.recover()
+    with volume_client._auth_lock('b'):
+        assert not volume_client._auth_metadata_get('b')['dirty']
+    assert volume_client._dirty_index_ready()
+    assert volume_client._dirty_index_get() == []
+
+def test_map_volumes_by_value(volume_client):
+    paths = [cvc.VolumePath(None, 'v{0}'.format(i)) for i in range(4)]
+    results = volume_client._map_volumes(
+        lambda p: p.volume_id, paths, 2)
+    # Looked up with fresh VolumePaths, not the ones passed in
+    for i in range(4):
+        assert results[cvc.VolumePath(None, 'v{0}'.format(i))] == 'v{0}'.format(i)
+    assert cvc.VolumePath('g', 'v0') not in results
+    assert cvc.VolumePath(None, 'v0') != cvc.VolumePath('g', 'v0')
+
+def test_map_unordered_results():
+    with cvc.WorkerPool(4) as pool:
+        results = list(pool.map_unordered(lambda x: x * x, range(20)))
+    assert sorted(results) == [(x, x * x, None) for x in range(20)]
+
+def test_map_unordered_errors():
+    def fn(x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+    with cvc.WorkerPool(2) as pool:
+        results = list(pool.map_unordered(fn, range(6)))
+        # The errors were yielded, not left for wait() to raise
+        pool.wait()
+    assert sorted(r[0] for r in results) == list(range(6))
+    for item, result, error in results:
+        if item % 2:
+            assert result is None
+            assert isinstance(error, ValueError)
+        else:
+            assert (result, error) == (item, None)
+
+def test_map_unordered_in_flight():
+    lock = threading.Lock()
+    state = {'running': 0, 'most': 0, 'drawn': 0}
+
+    def items():
+        for x in range(20):
+            state['drawn'] += 1
+            yield x
+
+    def fn(x):
+        with lock:
+            state['running'] += 1
+            state['most'] = max(state['most'], state['running'])
+        time.sleep(0.005)
+        with lock:
+            state['running'] -= 1
+        return x
+
+    with cvc.WorkerPool(8) as pool:
+        results = pool.map_unordered(fn, items(), in_flight=2)
+        next(results)
+        # The generator is only drawn on as results are consumed
+        assert state['drawn'] <= 3
+        rest = list(results)
+    assert len(rest) == 19
+    assert state['most'] <= 2
+
+def test_retain_hourly():
+    start = datetime(2020, 1, 1, 10, 0)
+    stamps = [start + timedelta(minutes=15 * i) for i in range(12)]
+    keep = cvc.SnapshotScheduler.retain(stamps, 2, 0, 0)
+    assert keep == set([datetime(2020, 1, 1, 12, 45),
+                        datetime(2020, 1, 1, 11, 45)])
+
+def test_retain_skips_empty_periods():
+    stamps = [datetime(2020, 1, 1, 1, 0), datetime(2020, 1, 1, 5, 30),
+              datetime(2020, 1, 1, 5, 0)]
+    keep = cvc.SnapshotScheduler.retain(stamps, 2, 0, 0)
+    assert keep == set([datetime(2020, 1, 1, 5, 30),
+                        datetime(2020, 1, 1, 1, 0)])
+
+def test_retain_union():
+    # 2020-01-05 is a Sunday, so the 6th starts a new ISO week
+    stamps = [datetime(2020, 1, d, h) for d in (3, 4, 5, 6) for h in (8, 20)]
+    keep = cvc.SnapshotScheduler.retain(stamps, 1, 2, 2)
+    assert keep == set([datetime(2020, 1, 6, 20),
+                        datetime(2020, 1, 5, 20)])
+    keep = cvc.SnapshotScheduler.retain(stamps, 3, 0, 0)
+    assert keep == set([datetime(2020, 1, 6, 20), datetime(2020, 1, 6, 8),
+                        datetime(2020, 1, 5, 20)])
+
+def test_retain_nothing():
+    stamps = [datetime(2020, 1, 1, h) for h in range(3)]
+    assert cvc.SnapshotScheduler.retain(stamps, 0, 0, 0) == set()
+    assert cvc.SnapshotScheduler.retain([], 4, 4, 4) == set()